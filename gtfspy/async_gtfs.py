@@ -0,0 +1,176 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from gtfspy.gtfs_pool import GTFSPool
+
+
+class _Job(object):
+    """
+    A query running in the executor; allows interrupting the sqlite statement it is executing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self.cancelled = False
+
+    def run(self, pool, method_name, args, kwargs):
+        with pool.gtfs() as G:
+            with self._lock:
+                if self.cancelled:
+                    raise asyncio.CancelledError()
+                self._conn = G.conn
+            try:
+                return getattr(G, method_name)(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._conn = None
+
+    def interrupt(self):
+        with self._lock:
+            self.cancelled = True
+            if self._conn is not None:
+                self._conn.interrupt()
+
+
+class AsyncGTFS(object):
+    """
+    Asyncio facade for querying a GTFS database without blocking the event loop.
+
+    Queries are GTFS method calls that are run by a bounded thread pool over pooled read-only connections
+    (see gtfspy.gtfs_pool.GTFSPool). Identical calls (same method and arguments) that are in flight at the
+    same time are coalesced into one query: all but one of its callers get copies of the result (if the result
+    has a copy method), so that results can be modified in place.
+    Cancelling a call interrupts the underlying query once no caller waits for it.
+
+    Usage
+    -----
+    async with AsyncGTFS("city.sqlite", max_workers=8) as G:
+        stops = await G.stops()
+        closest = await G.gather([("get_closest_stop", (lat, lon)) for lat, lon in points])
+    """
+
+    def __init__(self, fname_or_pool, max_workers=None, coalesce=True, **pool_kwargs):
+        """
+        Parameters
+        ----------
+        fname_or_pool: str | gtfspy.gtfs_pool.GTFSPool
+            path to the gtfs database, or an existing pool (which is then not closed by close())
+        max_workers: int, optional
+            number of queries run simultaneously, by default the size of the pool
+        coalesce: bool
+            whether to coalesce identical in-flight calls
+        pool_kwargs:
+            passed to GTFSPool, if a path is given
+        """
+        if isinstance(fname_or_pool, GTFSPool):
+            self.pool = fname_or_pool
+            self._own_pool = False
+        else:
+            if max_workers is not None:
+                pool_kwargs.setdefault("size", max_workers)
+            self.pool = GTFSPool(fname_or_pool, **pool_kwargs)
+            self._own_pool = True
+        self.max_workers = max_workers if max_workers is not None else self.pool.size
+        self.coalesce = coalesce
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # call key -> [future, number of waiters, job]
+        self._in_flight = {}
+        self.n_queries = 0
+        self.n_coalesced = 0
+
+    @staticmethod
+    def _call_key(method_name, args, kwargs):
+        key = (method_name, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    async def call(self, method_name, *args, **kwargs):
+        """
+        Call GTFS.<method_name>(*args, **kwargs) in the executor.
+        """
+        loop = asyncio.get_running_loop()
+        key = self._call_key(method_name, args, kwargs) if self.coalesce else None
+        entry = self._in_flight.get(key) if key is not None else None
+        if entry is None:
+            job = _Job()
+            future = loop.run_in_executor(self._executor, job.run, self.pool, method_name, args, kwargs)
+            self.n_queries += 1
+            entry = [future, 0, job]
+            if key is not None:
+                self._in_flight[key] = entry
+                future.add_done_callback(lambda _: self._forget(key, entry))
+        else:
+            self.n_coalesced += 1
+        future, _, job = entry
+        entry[1] += 1
+        try:
+            result = await asyncio.shield(future)
+            # the original result goes to the last waiter to resume, so that no caller
+            # can modify it before the others have copied it
+            if entry[1] > 1 and hasattr(result, "copy"):
+                result = result.copy()
+            return result
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not future.done():
+                self._forget(key, entry)
+                future.cancel()
+                job.interrupt()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _forget(self, key, entry):
+        if key is not None and self._in_flight.get(key) is entry:
+            del self._in_flight[key]
+
+    async def gather(self, calls, return_exceptions=False):
+        """
+        Run many calls concurrently.
+
+        Parameters
+        ----------
+        calls: iterable
+            of (method_name, args) or (method_name, args, kwargs) tuples
+        return_exceptions: bool
+            see asyncio.gather
+
+        Returns
+        -------
+        results: list
+            in the order of calls
+        """
+        coroutines = []
+        for call in calls:
+            method_name, args = call[0], call[1]
+            kwargs = call[2] if len(call) > 2 else {}
+            coroutines.append(self.call(method_name, *args, **kwargs))
+        return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
+    async def stops(self):
+        return await self.call("stops")
+
+    async def get_closest_stop(self, lat, lon):
+        return await self.call("get_closest_stop", lat, lon)
+
+    async def get_transit_events(self, start_time_ut=None, end_time_ut=None, route_type=None):
+        return await self.call("get_transit_events", start_time_ut=start_time_ut, end_time_ut=end_time_ut,
+                               route_type=route_type)
+
+    async def get_tripIs_within_range_by_dsut(self, start_time_ut, end_time_ut):
+        return await self.call("get_tripIs_within_range_by_dsut", start_time_ut, end_time_ut)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._own_pool:
+            self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -1,7 +1,14 @@
+import csv
+import gzip
+import io
 import json
 import os
 import shutil
+import tempfile
 import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import networkx
 import pandas
@@ -9,8 +16,8 @@ import pandas
 from gtfspy import route_types
 from gtfspy.gtfs import GTFS
 from gtfspy import util
-from gtfspy.networks import stop_to_stop_networks_by_type, temporal_network, \
-    combined_stop_to_stop_transit_network
+from gtfspy.networks import stop_to_stop_networks_by_type, temporal_network_batches, \
+    combined_stop_to_stop_transit_network, TEMPORAL_NETWORK_COLUMNS
 from gtfspy.route_types import ROUTE_TYPE_TO_ZORDER
 
 
@@ -135,7 +142,7 @@ def write_static_networks(gtfs, output_dir, fmt=None):
             _write_stop_to_stop_network_edges(net, file_name, fmt=fmt)
 
 
-def write_temporal_networks_by_route_type(gtfs, extract_output_dir):
+def write_temporal_networks_by_route_type(gtfs, extract_output_dir, fmt=None):
     """
     Write temporal networks by route type to disk.
 
@@ -143,17 +150,26 @@ def write_temporal_networks_by_route_type(gtfs, extract_output_dir):
     ----------
     gtfs: gtfspy.GTFS
     extract_output_dir: str
+    fmt: str, optional
+        "csv" (default, written as ".tnet" files), "csv.gz" (".tnet.gz") or "parquet" (".parquet")
     """
+    if fmt is None:
+        fmt = "csv"
+    extension = {"csv": ".tnet", "csv.gz": ".tnet.gz", "parquet": ".parquet"}[fmt]
     util.makedirs(extract_output_dir)
     for route_type in route_types.TRANSIT_ROUTE_TYPES:
-        pandas_data_frame = temporal_network(gtfs, start_time_ut=None, end_time_ut=None, route_type=route_type)
+        batches = temporal_network_batches(gtfs, start_time_ut=None, end_time_ut=None, route_type=route_type)
         tag = route_types.ROUTE_TYPE_TO_LOWERCASE_TAG[route_type]
-        out_file_name = os.path.join(extract_output_dir, tag + ".tnet")
-        pandas_data_frame.to_csv(out_file_name, encoding='utf-8', index=False)
+        out_file_name = os.path.join(extract_output_dir, tag + extension)
+        _write_temporal_network_batches(batches, out_file_name, fmt)
 
 
-def write_temporal_network(gtfs, output_filename, start_time_ut=None, end_time_ut=None):
+def write_temporal_network(gtfs, output_filename, start_time_ut=None, end_time_ut=None, fmt=None,
+                           batch_duration=None):
     """
+    Write the temporal network to disk, one batch of events at a time
+    (see gtfspy.networks.temporal_network_batches).
+
     Parameters
     ----------
     gtfs : gtfspy.GTFS
@@ -163,10 +179,58 @@ def write_temporal_network(gtfs, output_filename, start_time_ut=None, end_time_u
         start time of the extract in unixtime (seconds after epoch)
     end_time_ut: int | None
         end time of the extract in unixtime (seconds after epoch)
+    fmt: str, optional
+        "csv", "csv.gz" (gzip-compressed csv) or "parquet" (requires pyarrow).
+        By default, inferred from the extension of output_filename, falling back to "csv".
+    batch_duration: int, optional
+        the span of trip start times (in seconds) covered by each batch, defaults to one day
     """
+    if fmt is None:
+        if output_filename.endswith(".gz"):
+            fmt = "csv.gz"
+        elif output_filename.endswith(".parquet"):
+            fmt = "parquet"
+        else:
+            fmt = "csv"
     util.makedirs(os.path.dirname(os.path.abspath(output_filename)))
-    pandas_data_frame = temporal_network(gtfs, start_time_ut=start_time_ut, end_time_ut=end_time_ut)
-    pandas_data_frame.to_csv(output_filename, encoding='utf-8', index=False)
+    batches = temporal_network_batches(gtfs, start_time_ut=start_time_ut, end_time_ut=end_time_ut,
+                                       batch_duration=batch_duration)
+    _write_temporal_network_batches(batches, output_filename, fmt)
+
+
+def _write_temporal_network_batches(batches, output_filename, fmt):
+    """
+    Write batches of temporal network events into a single file.
+
+    Parameters
+    ----------
+    batches: iterable[pandas.DataFrame]
+    output_filename: str
+    fmt: str
+        "csv", "csv.gz" or "parquet"
+    """
+    if fmt == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+        # All columns are integers. With a fixed schema, all batches (and an empty network) get the same types.
+        schema = pyarrow.schema([(column, pyarrow.int64()) for column in TEMPORAL_NETWORK_COLUMNS])
+        with pyarrow.parquet.ParquetWriter(output_filename, schema) as writer:
+            for batch in batches:
+                writer.write_table(pyarrow.Table.from_pandas(batch, schema=schema, preserve_index=False))
+    elif fmt in ("csv", "csv.gz"):
+        if fmt == "csv.gz":
+            f = gzip.open(output_filename, 'wt', encoding='utf-8', newline='')
+        else:
+            f = open(output_filename, 'w', encoding='utf-8', newline='')
+        with f:
+            header = True
+            for batch in batches:
+                batch.to_csv(f, header=header, index=False)
+                header = False
+            if header:
+                pandas.DataFrame(columns=TEMPORAL_NETWORK_COLUMNS).to_csv(f, index=False)
+    else:
+        raise ValueError("Unknown temporal network format: " + str(fmt))
 
 
 def _write_stop_to_stop_network_edges(net, file_name, data=True, fmt=None):
@@ -277,112 +341,238 @@ def write_routes_geojson(G, output_file):
 
 
 
-def write_gtfs(gtfs, output):
+def write_trip_trajectories_geojson_lines(G, output_file, start_time_ut, end_time_ut, use_shapes=True,
+                                          filter_name=None):
+    """
+    Write the trip trajectories within a timespan as line-delimited GeoJSON: one LineString Feature per line.
+    The trips are streamed from GTFS.iter_trip_trajectories_within_timespan, and written as they are produced.
+
+    Parameters
+    ----------
+    G: gtfspy.GTFS
+    output_file: file-like or path to file
+    start_time_ut: int
+    end_time_ut: int
+    use_shapes: bool, optional
+    filter_name: str, optional
+        pick only routes having this name
+
+    Returns
+    -------
+    n_trips: int
+        number of written trips
+    """
+    def _write(f):
+        n_trips = 0
+        for trip in G.iter_trip_trajectories_within_timespan(start_time_ut, end_time_ut,
+                                                             use_shapes=use_shapes, filter_name=filter_name):
+            feature = {"type": "Feature",
+                       "geometry": {
+                           "type": "LineString",
+                           "coordinates": list(zip(trip['lons'], trip['lats']))
+                       },
+                       "properties": {
+                           "name": trip['name'],
+                           "route_type": trip['route_type'],
+                           "times": trip['times']
+                       }}
+            f.write(json.dumps(feature) + "\n")
+            n_trips += 1
+        return n_trips
+
+    if hasattr(output_file, "write"):
+        return _write(output_file)
+    else:
+        with open(output_file, 'w') as f:
+            return _write(f)
+
+
+def write_gtfs(gtfs, output, n_threads=None):
     """
     Write out the database according to the GTFS format.
 
+    Each table is streamed from a database cursor directly into its output file
+    (or, when writing a ZIP-file, into its entry of the ZIP-file).
+
     Parameters
     ----------
     gtfs: gtfspy.GTFS
     output: str
         Path where to put the GTFS files
         if output ends with ".zip" a ZIP-file is created instead.
+    n_threads: int, optional
+        Number of tables written in parallel, each thread using its own database connection.
+        Defaults to the number of CPUs. Tables of in-memory databases are always written one at a time.
 
     Returns
     -------
     None
     """
     output = os.path.abspath(output)
-    uuid_str = "tmp_" + str(uuid.uuid1())
+    database_path = gtfs.get_main_database_path()
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    if not database_path:
+        n_threads = 1
+    n_threads = max(1, min(n_threads, len(GTFS_TABLE_TO_WRITER)))
+
+    def write_table(table, output_file):
+        writer = GTFS_TABLE_TO_WRITER[table]
+        if n_threads == 1:
+            writer(gtfs, output_file)
+        else:
+            # sqlite connections can not be shared between threads
+            thread_gtfs = GTFS(database_path)
+            try:
+                writer(thread_gtfs, output_file)
+            finally:
+                thread_gtfs.conn.close()
+
     if output[-4:] == '.zip':
-        zip = True
         out_basepath = os.path.dirname(os.path.abspath(output))
         if not os.path.exists(out_basepath):
             raise IOError(out_basepath + " does not exist, cannot write gtfs as a zip")
-        tmp_dir = os.path.join(out_basepath, str(uuid_str))
-        # zip_file_na,e = ../out_basedir + ".zip
+        with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            if n_threads == 1:
+                for table in GTFS_TABLE_TO_WRITER:
+                    with zip_file.open(table + '.txt', 'w') as entry:
+                        _write_text(entry, lambda f: write_table(table, f))
+            else:
+                # only one ZIP-file entry can be written at a time: the tables are first written into
+                # temporary files (kept in memory when small) and copied into the ZIP-file in order
+                def write_table_to_tmp_file(table):
+                    tmp_file = tempfile.SpooledTemporaryFile(max_size=2 ** 25)
+                    _write_text(tmp_file, lambda f: write_table(table, f))
+                    tmp_file.seek(0)
+                    return tmp_file
+
+                with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                    futures = [(table, executor.submit(write_table_to_tmp_file, table))
+                               for table in GTFS_TABLE_TO_WRITER]
+                    for table, future in futures:
+                        with future.result() as tmp_file, zip_file.open(table + '.txt', 'w') as entry:
+                            shutil.copyfileobj(tmp_file, entry)
     else:
-        zip = False
         out_basepath = output
-        tmp_dir = os.path.join(out_basepath + "_" + str(uuid_str))
-
-    os.makedirs(tmp_dir, exist_ok=True)
-
-    gtfs_table_to_writer = {
-        "agency": _write_gtfs_agencies,
-        "calendar": _write_gtfs_calendar,
-        "calendar_dates": _write_gtfs_calendar_dates,
-        # fare attributes and fare_rules omitted (seldomly used)
-        "feed_info": _write_gtfs_feed_info,
-        # "frequencies": not written, as they are incorporated into trips and routes,
-        # Frequencies table is expanded into other tables on initial import. -> Thus frequencies.txt is not created
-        "routes": _write_gtfs_routes,
-        "shapes": _write_gtfs_shapes,
-        "stops": _write_gtfs_stops,
-        "stop_times": _write_gtfs_stop_times,
-        "transfers": _write_gtfs_transfers,
-        "trips": _write_gtfs_trips,
-    }
+        tmp_dir = os.path.join(out_basepath + "_tmp_" + str(uuid.uuid1()))
+        os.makedirs(tmp_dir, exist_ok=True)
 
-    for table, writer in gtfs_table_to_writer.items():
-        fname_to_write = os.path.join(tmp_dir, table + '.txt')
-        print(fname_to_write)
-        writer(gtfs, open(os.path.join(tmp_dir, table + '.txt'), 'w'))
+        def write_table_to_dir(table):
+            with open(os.path.join(tmp_dir, table + '.txt'), 'w', encoding='utf-8', newline='') as f:
+                write_table(table, f)
 
-    if zip:
-        shutil.make_archive(output[:-4], 'zip', tmp_dir)
-        shutil.rmtree(tmp_dir)
-    else:
-        print("moving " + str(tmp_dir) + " to " + out_basepath)
+        if n_threads == 1:
+            for table in GTFS_TABLE_TO_WRITER:
+                write_table_to_dir(table)
+        else:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                list(executor.map(write_table_to_dir, GTFS_TABLE_TO_WRITER))
         os.rename(tmp_dir, out_basepath)
 
 
-
-def _remove_I_columns(df):
+def _write_text(binary_file, write_func):
+    """
+    Call write_func with a utf-8 text wrapper of binary_file, leaving binary_file open.
     """
-    Remove columns ending with I from a pandas.DataFrame
+    text_file = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+    try:
+        write_func(text_file)
+        text_file.flush()
+    finally:
+        text_file.detach()
 
-    Parameters
-    ----------
-    df: dataFrame
+
+def _I_to_id(gtfs, table, I_column, id_column):
+    """
+    Preload the mapping from an integer key (e.g. stop_I) to the corresponding GTFS id (e.g. stop_id).
 
     Returns
     -------
-    None
+    ids: list
+        ids[I] is the id of I, or None if there is no such I
     """
-    all_columns = list(filter(lambda el: el[-2:] == "_I", df.columns))
-    for column in all_columns:
-        del df[column]
+    rows = gtfs.conn.execute("SELECT {I}, {id} FROM {table}".format(I=I_column, id=id_column, table=table)).fetchall()
+    ids = [None] * (max([I for I, _ in rows if I is not None], default=-1) + 1)
+    for I, id_ in rows:
+        if I is not None:
+            ids[I] = id_
+    return ids
 
 
-def __replace_I_with_id(gtfs, current_table, from_table_name, old_column_current, old_column_from, new_column_in_from,
-                        new_column_name=None):
-    if new_column_name is None:
-        new_column_name = new_column_in_from
-    from_table = gtfs.get_table(from_table_name)
-    merged = pandas.merge(current_table, from_table, how="left",
-                          left_on=old_column_current, right_on=old_column_from)
-    series = pandas.Series(merged[new_column_in_from], index=current_table.index)
-    current_table[new_column_name] = series
+def _write_gtfs_table(gtfs, output_file, table, columns_to_change=None, I_columns_to_id=None,
+                      columns_to_delete=None, column_to_converter=None, remove_I_columns=True):
+    """
+    Stream a database table into a GTFS csv file.
+
+    Parameters
+    ----------
+    gtfs: gtfspy.GTFS
+    output_file: file-like
+        opened in text mode
+    table: str
+        name of the database table
+    columns_to_change: dict, optional
+        renaming of the database columns to GTFS columns
+    I_columns_to_id: list[tuple], optional
+        (I_column, new_column, ids) tuples: new_column (appended to the end of the columns) gets the value
+        ids[I] of each I in I_column (see _I_to_id), or is left empty if there is no such id
+    columns_to_delete: list[str], optional
+        (renamed) columns not to write
+    column_to_converter: dict, optional
+        functions to apply to the (non-null) values of the (renamed) columns
+    remove_I_columns: bool, optional
+        whether to omit all columns ending with "_I"
+    """
+    names = [row[1] for row in gtfs.conn.execute("PRAGMA table_info(" + table + ")")]
+    columns = [columns_to_change.get(name, name) if columns_to_change else name for name in names]
+    if columns_to_delete is None:
+        columns_to_delete = []
+    if column_to_converter is None:
+        column_to_converter = {}
+    if I_columns_to_id is None:
+        I_columns_to_id = []
+    kept = [i for i, column in enumerate(columns)
+            if column not in columns_to_delete and not (remove_I_columns and column[-2:] == "_I")]
+    kept_columns = [columns[i] for i in kept]
+    converters = [(kept_columns.index(column), converter)
+                  for column, converter in column_to_converter.items() if column in kept_columns]
+    # only the needed columns are read: first the written ones, then those to be replaced by ids
+    selected = kept + [columns.index(I_column) for I_column, _, _ in I_columns_to_id]
+    cursor = gtfs.conn.execute("SELECT " + ", ".join('"' + names[i] + '"' for i in selected) + " FROM " + table)
+    lookups = [(len(kept) + i, ids, len(ids)) for i, (_, _, ids) in enumerate(I_columns_to_id)]
+    n_kept = len(kept)
+
+    csv_writer = csv.writer(output_file, lineterminator='\n')
+    csv_writer.writerow(kept_columns + [new_column for _, new_column, _ in I_columns_to_id])
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        if converters or lookups:
+            out_rows = []
+            for row in rows:
+                out_row = list(row[:n_kept])
+                for index, converter in converters:
+                    if out_row[index] is not None:
+                        out_row[index] = converter(out_row[index])
+                for I_index, ids, n_ids in lookups:
+                    I = row[I_index]
+                    out_row.append(ids[I] if I is not None and 0 <= I < n_ids else None)
+                out_rows.append(out_row)
+            rows = out_rows
+        csv_writer.writerows(rows)
 
 
 def _write_gtfs_agencies(gtfs, output_file):
-    # remove agency_I
-    agencies_table = gtfs.get_table("agencies")
-    assert (isinstance(agencies_table, pandas.DataFrame))
     columns_to_change = {'name': 'agency_name',
                          'url': 'agency_url',
                          'timezone': 'agency_timezone',
                          'lang': 'agency_lang',
                          'phone': 'agency_phone'}
-    agencies_table = agencies_table.rename(columns=columns_to_change)
-    _remove_I_columns(agencies_table)
-    agencies_table.to_csv(output_file, index=False)
+    _write_gtfs_table(gtfs, output_file, "agencies", columns_to_change)
 
 
 def _write_gtfs_stops(gtfs, output_file):
-    stops_table = gtfs.get_table("stops")
-    assert (isinstance(stops_table, pandas.DataFrame))
     columns_to_change = {'name': 'stop_name',
                          'url': 'stop_url',
                          'lat': 'stop_lat',
@@ -390,24 +580,12 @@ def _write_gtfs_stops(gtfs, output_file):
                          'code': 'stop_code',
                          'desc': 'stop_desc'
                          }
-    stops_table = stops_table.rename(columns=columns_to_change)
-
-    # Remove stop_I
-    stop_I_to_id = {row.stop_I: row.stop_id for row in stops_table.itertuples()}
-    parent_stations = []
-    for stop_row in stops_table.itertuples():
-        try:
-            parent_station = stop_I_to_id[stop_row.parent_I]
-        except KeyError:
-            parent_station = ""
-        parent_stations.append(parent_station)
-    stops_table['parent_station'] = pandas.Series(parent_stations, index=stops_table.index)
-    _remove_I_columns(stops_table)
-    stops_table.to_csv(output_file, index=False)
+    stop_ids = _I_to_id(gtfs, "stops", "stop_I", "stop_id")
+    _write_gtfs_table(gtfs, output_file, "stops", columns_to_change,
+                      I_columns_to_id=[("parent_I", "parent_station", stop_ids)])
 
 
 def _write_gtfs_routes(gtfs, output_file):
-    routes_table = gtfs.get_table("routes")
     columns_to_change = {'name': 'route_short_name',
                          'long_name': 'route_long_name',
                          'url': 'route_url',
@@ -416,59 +594,38 @@ def _write_gtfs_routes(gtfs, output_file):
                          'color': 'route_color',
                          'text_color': 'route_text_color'
                          }
-    routes_table = routes_table.rename(columns=columns_to_change)
-
-    # replace agency_I
-    agencies_table = gtfs.get_table("agencies")
-    agency_ids = pandas.merge(routes_table, agencies_table, how="left", on='agency_I')['agency_id']
-    routes_table['agency_id'] = pandas.Series(agency_ids, index=routes_table.index)
-    _remove_I_columns(routes_table)
-    routes_table.to_csv(output_file, index=False)
+    agency_ids = _I_to_id(gtfs, "agencies", "agency_I", "agency_id")
+    _write_gtfs_table(gtfs, output_file, "routes", columns_to_change,
+                      I_columns_to_id=[("agency_I", "agency_id", agency_ids)])
 
 
 def _write_gtfs_trips(gtfs, output_file):
-    trips_table = gtfs.get_table("trips")
     columns_to_change = {
         'headsign': 'trip_headsign',
     }
-    trips_table = trips_table.rename(columns=columns_to_change)
-
-    __replace_I_with_id(gtfs, trips_table, 'routes', 'route_I', 'route_I', 'route_id')
-    __replace_I_with_id(gtfs, trips_table, 'calendar', 'service_I', 'service_I', 'service_id')
-
-    _remove_I_columns(trips_table)
-    del [trips_table['start_time_ds']]
-    del [trips_table['end_time_ds']]
-
-    trips_table.to_csv(output_file, index=False)
+    route_ids = _I_to_id(gtfs, "routes", "route_I", "route_id")
+    service_ids = _I_to_id(gtfs, "calendar", "service_I", "service_id")
+    _write_gtfs_table(gtfs, output_file, "trips", columns_to_change,
+                      I_columns_to_id=[("route_I", "route_id", route_ids),
+                                       ("service_I", "service_id", service_ids)],
+                      columns_to_delete=['start_time_ds', 'end_time_ds'])
 
 
 def _write_gtfs_stop_times(gtfs, output_file):
-    stop_times_table = gtfs.get_table('stop_times')
-
     columns_to_change = {
         'seq': 'stop_sequence',
         'arr_time': 'arrival_time',
         'dep_time': 'departure_time'
     }
-    stop_times_table = stop_times_table.rename(columns=columns_to_change)
-
-    # replace trip_I with trip_id
-    __replace_I_with_id(gtfs, stop_times_table, 'trips', 'trip_I', 'trip_I', 'trip_id')
-    __replace_I_with_id(gtfs, stop_times_table, 'stops', 'stop_I', 'stop_I', 'stop_id')
-
-    # delete unneeded columns:
-    del [stop_times_table['arr_time_hour']]
-    del [stop_times_table['arr_time_ds']]
-    del [stop_times_table['dep_time_ds']]
-    del [stop_times_table['shape_break']]
-    _remove_I_columns(stop_times_table)
-
-    stop_times_table.to_csv(output_file, index=False)
+    trip_ids = _I_to_id(gtfs, "trips", "trip_I", "trip_id")
+    stop_ids = _I_to_id(gtfs, "stops", "stop_I", "stop_id")
+    _write_gtfs_table(gtfs, output_file, "stop_times", columns_to_change,
+                      I_columns_to_id=[("trip_I", "trip_id", trip_ids),
+                                       ("stop_I", "stop_id", stop_ids)],
+                      columns_to_delete=['arr_time_hour', 'arr_time_ds', 'dep_time_ds', 'shape_break'])
 
 
 def _write_gtfs_calendar(gtfs, output_file):
-    calendar_table = gtfs.get_table('calendar')
     columns_to_change = {
         'm': 'monday',
         't': 'tuesday',
@@ -478,34 +635,34 @@ def _write_gtfs_calendar(gtfs, output_file):
         's': 'saturday',
         'su': 'sunday'
     }
-    calendar_table = calendar_table.rename(columns=columns_to_change)
-    calendar_table['start_date'] = [date.replace("-", "") for date in calendar_table['start_date']]
-    calendar_table['end_date'] = [date.replace("-", "") for date in calendar_table['end_date']]
-    _remove_I_columns(calendar_table)
-    calendar_table.to_csv(output_file, index=False)
+    _write_gtfs_table(gtfs, output_file, "calendar", columns_to_change,
+                      column_to_converter={'start_date': _remove_dashes, 'end_date': _remove_dashes})
 
 
 def _write_gtfs_calendar_dates(gtfs, output_file):
-    calendar_dates_table = gtfs.get_table('calendar_dates')
-    __replace_I_with_id(gtfs, calendar_dates_table, 'calendar', 'service_I', 'service_I', 'service_id')
-    _remove_I_columns(calendar_dates_table)
-    calendar_dates_table.to_csv(output_file, index=False)
+    service_ids = _I_to_id(gtfs, "calendar", "service_I", "service_id")
+    _write_gtfs_table(gtfs, output_file, "calendar_dates",
+                      I_columns_to_id=[("service_I", "service_id", service_ids)],
+                      column_to_converter={'date': _remove_dashes})
+
+
+def _remove_dashes(date):
+    # dates are stored as YYYY-MM-DD, but written as YYYYMMDD in GTFS
+    return date.replace("-", "")
 
 
 def _write_gtfs_shapes(gtfs, ouput_file):
-    shapes_table = gtfs.get_table('shapes')
     columns_to_change = {
         'lat': 'shape_pt_lat',
         'lon': 'shape_pt_lon',
         'seq': 'shape_pt_sequence',
         'd': 'shape_dist_traveled'
     }
-    shapes_table = shapes_table.rename(columns=columns_to_change)
-    shapes_table.to_csv(ouput_file, index=False)
+    _write_gtfs_table(gtfs, ouput_file, "shapes", columns_to_change, remove_I_columns=False)
 
 
 def _write_gtfs_feed_info(gtfs, output_file):
-    gtfs.get_table('feed_info').to_csv(output_file, index=False)
+    _write_gtfs_table(gtfs, output_file, "feed_info", remove_I_columns=False)
 
 
 def _write_gtfs_frequencies(gtfs, output_file):
@@ -513,21 +670,35 @@ def _write_gtfs_frequencies(gtfs, output_file):
 
 
 def _write_gtfs_transfers(gtfs, output_file):
-    transfers_table = gtfs.get_table('transfers')
-    __replace_I_with_id(gtfs, transfers_table, 'stops', 'from_stop_I', 'stop_I', 'stop_id', 'from_stop_id')
-    __replace_I_with_id(gtfs, transfers_table, 'stops', 'to_stop_I', 'stop_I', 'stop_id', 'to_stop_id')
-    _remove_I_columns(transfers_table)
-    transfers_table.to_csv(output_file, index=False)
+    stop_ids = _I_to_id(gtfs, "stops", "stop_I", "stop_id")
+    _write_gtfs_table(gtfs, output_file, "transfers",
+                      I_columns_to_id=[("from_stop_I", "from_stop_id", stop_ids),
+                                       ("to_stop_I", "to_stop_id", stop_ids)])
 
 
 def _write_gtfs_stop_distances(gtfs, output_file):
-    stop_distances = gtfs.get_table('stop_distances')
-    __replace_I_with_id(gtfs, stop_distances, 'stops', 'from_stop_I', 'stop_I', 'stop_id', 'from_stop_id')
-    __replace_I_with_id(gtfs, stop_distances, 'stops', 'to_stop_I', 'stop_I', 'stop_id', 'to_stop_id')
-    _remove_I_columns(stop_distances)
-    del stop_distances['min_transfer_time']
-    del stop_distances['timed_transfer']
-    stop_distances.to_csv(output_file, index=False)
+    stop_ids = _I_to_id(gtfs, "stops", "stop_I", "stop_id")
+    _write_gtfs_table(gtfs, output_file, "stop_distances",
+                      I_columns_to_id=[("from_stop_I", "from_stop_id", stop_ids),
+                                       ("to_stop_I", "to_stop_id", stop_ids)],
+                      columns_to_delete=['min_transfer_time', 'timed_transfer'])
+
+
+GTFS_TABLE_TO_WRITER = OrderedDict([
+    ("agency", _write_gtfs_agencies),
+    ("calendar", _write_gtfs_calendar),
+    ("calendar_dates", _write_gtfs_calendar_dates),
+    # fare attributes and fare_rules omitted (seldomly used)
+    ("feed_info", _write_gtfs_feed_info),
+    # "frequencies": not written, as they are incorporated into trips and routes,
+    # Frequencies table is expanded into other tables on initial import. -> Thus frequencies.txt is not created
+    ("routes", _write_gtfs_routes),
+    ("shapes", _write_gtfs_shapes),
+    ("stops", _write_gtfs_stops),
+    ("stop_times", _write_gtfs_stop_times),
+    ("transfers", _write_gtfs_transfers),
+    ("trips", _write_gtfs_trips),
+])
 
 
 # for row in stop_times_table.itertuples():
@@ -2,27 +2,34 @@ import time
 import os
 import shutil
 import logging
+import multiprocessing
 import sqlite3
 import datetime
 
+import numpy
 import pandas
 
 import gtfspy
 from gtfspy import util
 from gtfspy.gtfs import GTFS
-from gtfspy.import_loaders.day_loader import recreate_days_table
-from gtfspy.import_loaders.day_trips_materializer import recreate_day_trips2_table
+from gtfspy.import_loaders.day_loader import DayLoader, recreate_days_table
+from gtfspy.import_loaders.day_trips_materializer import DayTripsMaterializer, recreate_day_trips2_table
 from gtfspy.import_loaders.stop_times_loader import resequence_stop_times_seq_values
+from gtfspy.import_loaders.table_loader import create_temp_id_table
 from gtfspy.import_loaders.trip_loader import update_trip_travel_times_ds
-from gtfspy.util import wgs84_distance, set_process_timezone
+from gtfspy.util import wgs84_distance, wgs84_distances, set_process_timezone
 from gtfspy import stats
 from gtfspy import gtfs
 
 FILTERED = True
 NOT_FILTERED = False
+INCREMENTAL_UPDATE_MAX_TRIP_FRACTION = 0.2
+# spatial filtering uses window functions (SQLite 3.25) and row values (SQLite 3.15)
+MIN_SQLITE_VERSION_FOR_SPATIAL_FILTERING = (3, 25, 0)
 
 DELETE_FREQUENCIES_NOT_REFERENCED_IN_TRIPS_SQL = "DELETE FROM frequencies WHERE trip_I NOT IN (SELECT DISTINCT trip_I FROM trips)"
-DELETE_SHAPES_NOT_REFERENCED_IN_TRIPS_SQL = 'DELETE FROM shapes WHERE shape_id NOT IN (SELECT shape_id FROM trips)'
+DELETE_SHAPES_NOT_REFERENCED_IN_TRIPS_SQL = 'DELETE FROM shapes WHERE shape_id NOT IN ' \
+                                            '(SELECT shape_id FROM trips WHERE shape_id IS NOT NULL)'
 DELETE_ROUTES_NOT_PRESENT_IN_TRIPS_SQL = 'DELETE FROM routes WHERE route_I NOT IN (SELECT route_I FROM trips)'
 DELETE_DAYS_ENTRIES_NOT_PRESENT_IN_TRIPS_SQL = "DELETE FROM days WHERE trip_I NOT IN (SELECT trip_I FROM trips)"
 DELETE_DAY_TRIPS2_ENTRIES_NOT_PRESENT_IN_TRIPS_SQL = "DELETE FROM day_trips2 WHERE trip_I NOT IN (SELECT trip_I FROM trips)"
@@ -50,7 +57,8 @@ class FilterExtract(object):
                  start_date=None,
                  end_date=None,
                  agency_ids_to_preserve=None,
-                 agency_distance=None):
+                 agency_distance=None,
+                 build_forward=False):
         """
         Copy a database, and then based on various filters.
         Only method `create_filtered_copy` is provided as we do not want to take the risk of
@@ -86,6 +94,13 @@ class FilterExtract(object):
             Longitude of the buffer zone center
         buffer_distance : float
             Distance from the buffer zone center (in kilometers)
+        build_forward : bool, optional
+            If True, instead of copying the whole database and deleting rows from the copy,
+            create an empty database with the same schema and copy over only the rows related
+            to trips that can survive the date, agency and spatial filters.
+            The rest of the filtering is then done on the (much smaller) extract.
+            The resulting extract is the same as with the default copy-then-delete approach,
+            but much less data is written when extracting a small part of a large database.
 
         Returns
         -------
@@ -116,6 +131,10 @@ class FilterExtract(object):
         self.buffer_lon = buffer_lon
         self.buffer_distance_km = buffer_distance_km
         self.update_metadata = update_metadata
+        self.build_forward = build_forward
+        # trips whose stop_times have been modified (or which have been created) during the filtering,
+        # for updating the secondary data (trips travel times, stop_times seq, days, day_trips2) incrementally
+        self._changed_trip_Is = set()
 
         if agency_distance is not None:
             raise NotImplementedError
@@ -130,8 +149,12 @@ class FilterExtract(object):
         # this with statement
         # is used to ensure that no corrupted/uncompleted files get created in case of problems
         with util.create_file(self.copy_db_path) as tempfile:
-            logging.info("copying database")
-            shutil.copy(self.this_db_path, tempfile)
+            if self.build_forward:
+                logging.info("copying rows of the surviving trips")
+                self._build_forward_copy(tempfile)
+            else:
+                logging.info("copying database")
+                shutil.copy(self.this_db_path, tempfile)
             self.copy_db_conn = sqlite3.connect(tempfile)
             assert isinstance(self.copy_db_conn, sqlite3.Connection)
 
@@ -144,11 +167,114 @@ class FilterExtract(object):
             filtered = self._filter_spatially() or filtered
             self.copy_db_conn.commit()
             if filtered:
-                update_secondary_data_copies(db_conn=self.copy_db_conn)
+                update_secondary_data_copies(db_conn=self.copy_db_conn, trip_Is=self._changed_trip_Is)
             if self.update_metadata:
                 self._update_metadata()
         return
 
+    def _build_forward_copy(self, copy_db_path):
+        """
+        Create the schema of the original database into copy_db_path, and copy into it only those
+        rows of the large trip-dependent tables (trips, stop_times, shapes, days, day_trips2,
+        stop_distances) that can be part of the final extract.
+
+        The trips to copy are selected so that running the usual deletion steps on the copy
+        gives the same result as when running them on a full copy of the database.
+        Smaller tables are copied as such.
+        """
+        conn = sqlite3.connect(copy_db_path)
+        try:
+            conn.execute("ATTACH DATABASE ? AS source", (self.this_db_path,))
+            schema = conn.execute("SELECT type, name, sql FROM source.sqlite_master "
+                                  "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                                  "ORDER BY rowid").fetchall()
+            tables = [name for type_, name, _ in schema if type_ == "table"]
+            for type_, _, sql in schema:
+                if type_ == "table":
+                    conn.execute(sql)
+
+            conn.execute("CREATE TEMP TABLE forward_trip_Is (trip_I INTEGER PRIMARY KEY)")
+            conn.execute("INSERT INTO forward_trip_Is " + self._forward_trip_Is_sql(conn))
+            trip_condition = "trip_I IN (SELECT trip_I FROM temp.forward_trip_Is)"
+
+            dates_filtered = self._dates_filtered()
+            spatially_filtered = self._spatially_filtered()
+            for table in tables:
+                if table == "days" and dates_filtered:
+                    DayLoader.copy(conn, condition=trip_condition, **self._forward_ut_range())
+                elif table == "day_trips2" and dates_filtered:
+                    DayTripsMaterializer.copy(conn, condition=trip_condition, **self._forward_ut_range())
+                elif table in ("trips", "stop_times", "days", "day_trips2"):
+                    conn.execute("INSERT INTO {table} SELECT * FROM source.{table} WHERE {condition}"
+                                 .format(table=table, condition=trip_condition))
+                elif table == "shapes":
+                    conn.execute("INSERT INTO shapes SELECT * FROM source.shapes WHERE shape_id IN "
+                                 "(SELECT shape_id FROM source.trips WHERE " + trip_condition + ")")
+                elif table == "stop_distances" and (dates_filtered or spatially_filtered):
+                    # only stops used by the copied trips (or their parent stops) can survive the filtering
+                    stop_Is_sql = ("SELECT stop_I FROM source.stop_times WHERE " + trip_condition + " "
+                                   "UNION "
+                                   "SELECT parent_I FROM source.stops WHERE parent_I IS NOT NULL")
+                    conn.execute("INSERT INTO stop_distances SELECT * FROM source.stop_distances "
+                                 "WHERE from_stop_I IN ({stop_Is}) AND to_stop_I IN ({stop_Is})"
+                                 .format(stop_Is=stop_Is_sql))
+                else:
+                    conn.execute("INSERT INTO {table} SELECT * FROM source.{table}".format(table=table))
+            conn.commit()
+            # indices are faster to build after the data has been inserted
+            for type_, _, sql in schema:
+                if type_ != "table":
+                    conn.execute(sql)
+            conn.execute("DROP TABLE temp.forward_trip_Is")
+            conn.commit()
+            conn.execute("DETACH DATABASE source")
+        finally:
+            conn.close()
+
+    def _dates_filtered(self):
+        return (self.start_date is not None) and (self.end_date is not None)
+
+    def _spatially_filtered(self):
+        return not (self.buffer_lat is None or self.buffer_lon is None or self.buffer_distance_km is None)
+
+    def _forward_agency_filtered(self):
+        # The date filtering preserves the stops of all trips running within the time span,
+        # also those of the agencies that are later filtered out.
+        # The spatial filtering removes such stops again.
+        return self.agency_ids_to_preserve is not None and (self._spatially_filtered() or not self._dates_filtered())
+
+    def _forward_ut_range(self):
+        return {"start_ut": self.gtfs.get_day_start_ut(self.start_date),
+                "end_ut": self.gtfs.get_day_start_ut(self.end_date)}
+
+    def _forward_trip_Is_sql(self, conn):
+        """
+        SQL selecting the trip_Is whose rows are to be copied in the build-forward mode.
+        """
+        conditions = []
+        if self._dates_filtered():
+            conditions.append("trip_I IN (SELECT trip_I FROM source.days "
+                              "WHERE day_start_ut >= {start_ut} AND day_start_ut < {end_ut})"
+                              .format(**self._forward_ut_range()))
+        if self._forward_agency_filtered():
+            agency_ids = list(self.agency_ids_to_preserve)
+            agency_ids_sql = ",".join("'" + str(agency_id).replace("'", "''") + "'" for agency_id in agency_ids)
+            conditions.append("route_I IN (SELECT route_I FROM source.routes WHERE agency_I IN "
+                              "(SELECT agency_I FROM source.agencies WHERE agency_id IN (" + agency_ids_sql + ")))")
+        if self._spatially_filtered():
+            distance_function_str = add_wgs84_distance_function_to_db(conn)
+            conditions.append(
+                "trip_I IN (SELECT trip_I FROM source.stop_times WHERE stop_I IN "
+                "(SELECT stop_I FROM source.stops WHERE CAST(" + distance_function_str +
+                "(lat, lon, {lat}, {lon}) AS INT) < {d_m}))".format(lat=float(self.buffer_lat),
+                                                                    lon=float(self.buffer_lon),
+                                                                    d_m=int(1000 * self.buffer_distance_km))
+            )
+        sql = "SELECT trip_I FROM source.trips"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql
+
     def _delete_rows_by_start_and_end_date(self):
         """
         Removes rows from the sqlite database copy that are out of the time span defined by start_date and end_date
@@ -242,6 +368,8 @@ class FilterExtract(object):
         if (self.start_date is not None) and (self.end_date is not None):
             logging.info("Making date extract")
 
+            # Clipping the service periods to the extract's time span does not change the days
+            # within it, so the services are not marked as changed (see update_secondary_data_copies).
             start_date_query = "UPDATE calendar " \
                                "SET start_date='{start_date}' " \
                                "WHERE start_date<'{start_date}' ".format(start_date=self.start_date)
@@ -298,8 +426,7 @@ class FilterExtract(object):
                                       'trip_I NOT IN (SELECT trip_I FROM trips)')
             self.copy_db_conn.execute('DELETE FROM stop_times WHERE '
                                       'trip_I NOT IN (SELECT trip_I FROM trips)')
-            self.copy_db_conn.execute('DELETE FROM shapes WHERE '
-                                      'shape_id NOT IN (SELECT shape_id FROM trips)')
+            self.copy_db_conn.execute(DELETE_SHAPES_NOT_REFERENCED_IN_TRIPS_SQL)
             self.copy_db_conn.execute('DELETE FROM day_trips2 WHERE '
                                       'trip_I NOT IN (SELECT trip_I FROM trips)')
             self.copy_db_conn.commit()
@@ -320,6 +447,7 @@ class FilterExtract(object):
         """
         if self.buffer_lat is None or self.buffer_lon is None or self.buffer_distance_km is None:
             return NOT_FILTERED
+        _assert_sqlite_version(self.copy_db_conn, MIN_SQLITE_VERSION_FOR_SPATIAL_FILTERING, "Spatial filtering")
 
         print("filtering with lat: " + str(self.buffer_lat) +
               " lon: " + str(self.buffer_lon) +
@@ -331,79 +459,60 @@ class FilterExtract(object):
                                               update_secondary_data=False)
         logging.info("Making spatial extract")
 
-        find_distance_func_name = add_wgs84_distance_function_to_db(self.copy_db_conn)
-        assert find_distance_func_name == "find_distance"
-
-        # select all stops that are within the buffer and have some stop_times assigned.
-        stop_distance_filter_sql_base = (
-            "SELECT DISTINCT stops.stop_I FROM stops, stop_times" +
-            "    WHERE CAST(find_distance(lat, lon, {buffer_lat}, {buffer_lon}) AS INT) < {buffer_distance_meters}" +
-            "     AND stops.stop_I=stop_times.stop_I"
-        )
-        stops_within_buffer_sql = stop_distance_filter_sql_base.format(
-            buffer_lat=float(self.buffer_lat),
-            buffer_lon=float(self.buffer_lon),
-            buffer_distance_meters=int(self.buffer_distance_km * 1000)
-        )
-        stops_within_buffer = set(row[0] for row in self.copy_db_conn.execute(stops_within_buffer_sql))
+        # Flag all stops within the buffer.
+        _create_stops_within_buffer_table(self.copy_db_conn,
+                                          self.buffer_lat,
+                                          self.buffer_lon,
+                                          int(self.buffer_distance_km * 1000))
 
         # For each trip_I, find smallest (min_seq) and largest (max_seq) stop sequence numbers that
         # are within the soft buffer_distance from the buffer_lon and buffer_lat, and add them into the
         # list of stops to preserve.
         # Note that if a trip is OUT-IN-OUT-IN-OUT, this process preserves (at least) the part IN-OUT-IN of the trip.
-        # Repeat until no more stops are found.
-
-        stops_within_buffer_string = "(" +",".join(str(stop_I) for stop_I in stops_within_buffer) +  ")"
-        trip_min_max_include_seq_sql =  (
-            'SELECT trip_I, min(seq) AS min_seq, max(seq) AS max_seq FROM stop_times, stops '
-                    'WHERE stop_times.stop_I = stops.stop_I '
-                    ' AND stops.stop_I IN {stop_I_list}'
-                    ' GROUP BY trip_I'
-        ).format(stop_I_list=stops_within_buffer_string)
-        trip_I_min_seq_max_seq_df = pandas.read_sql(trip_min_max_include_seq_sql, self.copy_db_conn)
-
-        for trip_I_seq_row in trip_I_min_seq_max_seq_df.itertuples():
-            trip_I = trip_I_seq_row.trip_I
-            min_seq = trip_I_seq_row.min_seq
-            max_seq = trip_I_seq_row.max_seq
-            # DELETE FROM STOP_TIMES
-            if min_seq == max_seq:
-                # Only one entry in stop_times to be left, remove whole trip.
-                self.copy_db_conn.execute("DELETE FROM stop_times WHERE trip_I={trip_I}".format(trip_I=trip_I))
-                self.copy_db_conn.execute("DELETE FROM trips WHERE trip_i={trip_I}".format(trip_I=trip_I))
-            else:
-                # DELETE STOP_TIME ENTRIES BEFORE ENTERING AND AFTER DEPARTING THE BUFFER AREA
-                DELETE_STOP_TIME_ENTRIES_SQL = \
-                    "DELETE FROM stop_times WHERE trip_I={trip_I} AND (seq<{min_seq} OR seq>{max_seq})"\
-                    .format(trip_I=trip_I, max_seq=max_seq, min_seq=min_seq)
-                self.copy_db_conn.execute(DELETE_STOP_TIME_ENTRIES_SQL)
-
-                STOPS_NOT_WITHIN_BUFFER__FOR_TRIP_SQL = \
-                    "SELECT seq, stop_I IN {stops_within_hard_buffer} AS within FROM stop_times WHERE trip_I={trip_I} ORDER BY seq"\
-                    .format(stops_within_hard_buffer=stops_within_buffer_string, trip_I=trip_I)
-                stop_times_within_buffer_df = pandas.read_sql(STOPS_NOT_WITHIN_BUFFER__FOR_TRIP_SQL, self.copy_db_conn)
-                if stop_times_within_buffer_df['within'].all():
-                    continue
-                else:
-                    _split_trip(self.copy_db_conn, trip_I, stop_times_within_buffer_df)
-
+        self.copy_db_conn.execute("DROP TABLE IF EXISTS temp.trip_buffer_seqs")
+        self.copy_db_conn.execute(
+            "CREATE TEMP TABLE trip_buffer_seqs AS "
+            "SELECT trip_I, min(seq) AS min_seq, max(seq) AS max_seq FROM stop_times "
+            "WHERE stop_I IN (SELECT stop_I FROM temp.stops_within_buffer) "
+            "GROUP BY trip_I"
+        )
+        # The trip_I values of the split trips are given as if they were inserted one by one.
+        max_trip_I = self.copy_db_conn.execute("SELECT max(trip_I) FROM trips").fetchone()[0]
+
+        # Only one entry in stop_times to be left, remove whole trip.
+        single_stop_trip_Is_sql = "SELECT trip_I FROM temp.trip_buffer_seqs WHERE min_seq = max_seq"
+        self.copy_db_conn.execute("DELETE FROM stop_times WHERE trip_I IN (" + single_stop_trip_Is_sql + ")")
+        self.copy_db_conn.execute("DELETE FROM trips WHERE trip_I IN (" + single_stop_trip_Is_sql + ")")
+        # Delete stop_time entries before entering and after departing the buffer area.
+        stop_times_outside_seq_range_sql = (
+            "SELECT stop_times.trip_I, seq FROM stop_times, temp.trip_buffer_seqs AS b "
+            "WHERE stop_times.trip_I = b.trip_I AND min_seq < max_seq AND (seq < min_seq OR seq > max_seq)"
+        )
+        self._changed_trip_Is.update(row[0] for row in self.copy_db_conn.execute(
+            "SELECT DISTINCT trip_I FROM (" + stop_times_outside_seq_range_sql + ")"))
+        self.copy_db_conn.execute("DELETE FROM stop_times WHERE (trip_I, seq) IN (" +
+                                  stop_times_outside_seq_range_sql + ")")
+        self._changed_trip_Is.update(_split_trips_leaving_buffer(self.copy_db_conn, max_trip_I))
+        self.copy_db_conn.execute("DROP TABLE temp.trip_buffer_seqs")
 
         # Delete all shapes that are not fully within the buffer to avoid shapes going outside
         # the buffer area in a some cases.
         # This could probably be done in some more sophisticated way though (per trip)
-        SHAPE_IDS_NOT_WITHIN_BUFFER_SQL = \
-            "SELECT DISTINCT shape_id FROM SHAPES " \
-            "WHERE CAST(find_distance(lat, lon, {buffer_lat}, {buffer_lon}) AS INT) > {buffer_distance_meters}" \
-            .format(buffer_lat=self.buffer_lat,
-                    buffer_lon=self.buffer_lon,
-                    buffer_distance_meters=self.buffer_distance_km * 1000)
-        DELETE_ALL_SHAPE_IDS_NOT_WITHIN_BUFFER_SQL = "DELETE FROM shapes WHERE shape_id IN (" \
-                                                          + SHAPE_IDS_NOT_WITHIN_BUFFER_SQL + ")"
-        self.copy_db_conn.execute(DELETE_ALL_SHAPE_IDS_NOT_WITHIN_BUFFER_SQL)
-        SET_SHAPE_ID_TO_NULL_FOR_HARD_BUFFER_FILTERED_SHAPE_IDS = \
-            "UPDATE trips SET shape_id=NULL WHERE trips.shape_id IN (" + SHAPE_IDS_NOT_WITHIN_BUFFER_SQL + ")"
-        self.copy_db_conn.execute(SET_SHAPE_ID_TO_NULL_FOR_HARD_BUFFER_FILTERED_SHAPE_IDS)
-
+        shape_points = pandas.read_sql("SELECT shape_id, lat, lon FROM shapes", self.copy_db_conn)
+        distances = wgs84_distances(shape_points["lat"].values, shape_points["lon"].values,
+                                    self.buffer_lat, self.buffer_lon)
+        shape_ids_not_within_buffer = shape_points["shape_id"].values[
+            numpy.floor(distances) > self.buffer_distance_km * 1000]
+        self.copy_db_conn.execute("DROP TABLE IF EXISTS temp.shapes_not_within_buffer")
+        self.copy_db_conn.execute("CREATE TEMP TABLE shapes_not_within_buffer (shape_id TEXT PRIMARY KEY)")
+        self.copy_db_conn.executemany("INSERT INTO temp.shapes_not_within_buffer VALUES (?)",
+                                      ((shape_id,) for shape_id in set(shape_ids_not_within_buffer)))
+        shape_ids_not_within_buffer_sql = "SELECT shape_id FROM temp.shapes_not_within_buffer"
+        self.copy_db_conn.execute("DELETE FROM shapes WHERE shape_id IN (" + shape_ids_not_within_buffer_sql + ")")
+        self.copy_db_conn.execute("UPDATE trips SET shape_id=NULL "
+                                  "WHERE trips.shape_id IN (" + shape_ids_not_within_buffer_sql + ")")
+        self.copy_db_conn.execute("DROP TABLE temp.shapes_not_within_buffer")
+        self.copy_db_conn.execute("DROP TABLE temp.stops_within_buffer")
 
         # Delete trips with only one stop
         self.copy_db_conn.execute('DELETE FROM stop_times WHERE '
@@ -472,6 +581,64 @@ class FilterExtract(object):
             self.copy_db_conn.commit()
         return
 
+def create_filtered_copies(G, extract_specs, n_processes=None):
+    """
+    Create several filtered extracts of one database.
+
+    The extracts are written in parallel in the build-forward mode (see FilterExtract),
+    each worker process writing its own database.
+
+    Parameters
+    ----------
+    G: gtfspy.gtfs.GTFS
+        the original database
+    extract_specs: list[dict]
+        keyword arguments of FilterExtract for each extract (copy_db_path, start_date, end_date,
+        buffer_lat, buffer_lon, buffer_distance_km, agency_ids_to_preserve, update_metadata)
+    n_processes: int, optional
+        number of worker processes, defaults to the number of CPUs.
+        With n_processes=1 the extracts are written in this process.
+
+    Returns
+    -------
+    copy_db_paths: list[str]
+        paths of the created extracts, in the order of extract_specs
+    """
+    source_db_path = G.get_main_database_path()
+    extract_specs = [dict(spec, build_forward=True) for spec in extract_specs]
+    # validate the specs before doing anything else
+    filter_extracts = [FilterExtract(G, **spec) for spec in extract_specs]
+    copy_db_paths = [filter_extract.copy_db_path for filter_extract in filter_extracts]
+    if len(set(os.path.abspath(path) for path in copy_db_paths)) != len(copy_db_paths):
+        raise ValueError("Each extract should have its own copy_db_path")
+
+    jobs = [(source_db_path, spec) for spec in extract_specs]
+    if n_processes == 1:
+        for job in jobs:
+            _create_filtered_copy_worker(job)
+    else:
+        n_processes = min(n_processes or multiprocessing.cpu_count(), len(jobs))
+        with multiprocessing.Pool(max(n_processes, 1)) as pool:
+            for _ in pool.imap_unordered(_create_filtered_copy_worker, jobs):
+                pass
+    return copy_db_paths
+
+
+def _create_filtered_copy_worker(job):
+    source_db_path, spec = job
+    filter_extract = FilterExtract(GTFS(source_db_path), **spec)
+    filter_extract.create_filtered_copy()
+    return filter_extract.copy_db_path
+
+
+def _assert_sqlite_version(conn, min_version, feature):
+    version_string = conn.execute("SELECT sqlite_version()").fetchone()[0]
+    version = tuple(int(part) for part in version_string.split("."))
+    if version < tuple(min_version):
+        raise RuntimeError(feature + " requires SQLite " + ".".join(str(part) for part in min_version) +
+                           " or newer, but the sqlite3 module uses SQLite " + version_string)
+
+
 def delete_stops_not_in_stop_times_and_not_as_parent_stop(conn):
     _STOPS_REFERENCED_IN_STOP_TIMES_OR_AS_PARENT_STOP_I_SQL = \
         "SELECT DISTINCT stop_I FROM stop_times " \
@@ -492,6 +659,19 @@ def add_wgs84_distance_function_to_db(conn):
     return function_name
 
 
+def _create_stops_within_buffer_table(conn, center_lat, center_lon, buffer_distance_meters):
+    """
+    Create (or replace) the temporary table stops_within_buffer(stop_I) listing all stops
+    that are less than buffer_distance_meters (rounded down to full meters) from the buffer center.
+    """
+    stops = pandas.read_sql("SELECT stop_I, lat, lon FROM stops", conn)
+    distances = wgs84_distances(stops["lat"].values, stops["lon"].values, center_lat, center_lon)
+    stop_Is = stops["stop_I"].values[numpy.floor(distances) < buffer_distance_meters]
+    conn.execute("DROP TABLE IF EXISTS temp.stops_within_buffer")
+    conn.execute("CREATE TEMP TABLE stops_within_buffer (stop_I INTEGER PRIMARY KEY)")
+    conn.executemany("INSERT INTO temp.stops_within_buffer VALUES (?)", ((int(stop_I),) for stop_I in stop_Is))
+
+
 def remove_all_trips_fully_outside_buffer(db_conn, center_lat, center_lon, buffer_km, update_secondary_data=True):
     """
     Not used in the regular filter process for the time being.
@@ -504,18 +684,16 @@ def remove_all_trips_fully_outside_buffer(db_conn, center_lat, center_lon, buffe
     center_lon: float
     buffer_km: float
     """
-    distance_function_str = add_wgs84_distance_function_to_db(db_conn)
-    stops_within_buffer_query_sql = "SELECT stop_I FROM stops WHERE CAST(" + distance_function_str + \
-                                "(lat, lon, {lat} , {lon}) AS INT) < {d_m}"\
-        .format(lat=float(center_lat), lon=float(center_lon), d_m=int(1000*buffer_km))
-    select_all_trip_Is_where_stop_I_is_within_buffer_sql = "SELECT distinct(trip_I) FROM stop_times WHERE stop_I IN (" + stops_within_buffer_query_sql + ")"
-    trip_Is_to_remove_sql = "SELECT trip_I FROM trips WHERE trip_I NOT IN ( " + select_all_trip_Is_where_stop_I_is_within_buffer_sql + ")"
-    trip_Is_to_remove = pandas.read_sql(trip_Is_to_remove_sql, db_conn)["trip_I"].values
-    trip_Is_to_remove_string = ",".join([str(trip_I) for trip_I in trip_Is_to_remove])
-    remove_all_trips_fully_outside_buffer_sql = "DELETE FROM trips WHERE trip_I IN (" + trip_Is_to_remove_string + ")"
-    remove_all_stop_times_where_trip_I_fully_outside_buffer_sql = "DELETE FROM stop_times WHERE trip_I IN (" + trip_Is_to_remove_string  + ")"
-    db_conn.execute(remove_all_trips_fully_outside_buffer_sql)
-    db_conn.execute(remove_all_stop_times_where_trip_I_fully_outside_buffer_sql)
+    _create_stops_within_buffer_table(db_conn, float(center_lat), float(center_lon), int(1000 * buffer_km))
+    db_conn.execute("DROP TABLE IF EXISTS temp.trips_outside_buffer")
+    db_conn.execute("CREATE TEMP TABLE trips_outside_buffer AS "
+                    "SELECT trip_I FROM trips WHERE trip_I NOT IN "
+                    "(SELECT DISTINCT trip_I FROM stop_times "
+                    " WHERE stop_I IN (SELECT stop_I FROM temp.stops_within_buffer))")
+    db_conn.execute("DELETE FROM trips WHERE trip_I IN (SELECT trip_I FROM temp.trips_outside_buffer)")
+    db_conn.execute("DELETE FROM stop_times WHERE trip_I IN (SELECT trip_I FROM temp.trips_outside_buffer)")
+    db_conn.execute("DROP TABLE temp.trips_outside_buffer")
+    db_conn.execute("DROP TABLE temp.stops_within_buffer")
     delete_stops_not_in_stop_times_and_not_as_parent_stop(db_conn)
     db_conn.execute(DELETE_ROUTES_NOT_PRESENT_IN_TRIPS_SQL)
     db_conn.execute(DELETE_SHAPES_NOT_REFERENCED_IN_TRIPS_SQL)
@@ -526,7 +704,8 @@ def remove_all_trips_fully_outside_buffer(db_conn, center_lat, center_lon, buffe
     db_conn.execute(DELETE_FREQUENCIES_ENTRIES_NOT_PRESENT_IN_TRIPS)
     db_conn.execute(DELETE_AGENCIES_NOT_REFERENCED_IN_ROUTES_SQL)
     if update_secondary_data:
-        update_secondary_data_copies(db_conn)
+        # only whole trips have been removed
+        update_secondary_data_copies(db_conn, trip_Is=())
 
 
 def remove_dangling_shapes(db_conn):
@@ -561,55 +740,107 @@ def remove_dangling_shapes_references(db_conn):
     db_conn.execute(remove_danging_shapes_references_sql)
 
 
-def _split_trip(copy_db_conn, orig_trip_I, stop_times_within_buffer_df):
-    blocks = []
-    next_block = []
-    for row in stop_times_within_buffer_df.itertuples():
-        if row.within:
-            next_block.append(row.seq)
-        else:
-            if len(next_block) > 1:
-                blocks.append(next_block)
-            next_block = []
-    if len(next_block) > 1:
-        blocks.append(next_block)
-    orig_trip_df = pandas.read_sql("SELECT * FROM trips WHERE trip_I={trip_I}".format(trip_I=orig_trip_I), copy_db_conn)
-    orig_trip_dict = orig_trip_df.to_dict(orient="records")[0]
-    for i, seq_block in enumerate(blocks):
-        # create new trip for each block,
-        # with mostly same trip information as the original
-        trip_id_generated = orig_trip_dict['trip_id'] + "_splitted_part_" + str(i)
-        insert_generated_trip_sql = \
-            "INSERT INTO trips (trip_id, route_I, service_I, direction_id, " \
-            "shape_id, headsign, start_time_ds, end_time_ds) " \
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
-        values = [trip_id_generated, orig_trip_dict['route_I'],
-                  orig_trip_dict['service_I'], orig_trip_dict['direction_id'],
-                  None, orig_trip_dict['headsign'], None, None]
-        copy_db_conn.execute(insert_generated_trip_sql, values)
-        block_trip_I = copy_db_conn.execute("SELECT trip_I from trips WHERE trips.trip_id=?",
-                                            [trip_id_generated]).fetchone()[0]
-        # alter the trip_I values in the stop_times table for
-        seq_values_to_update_str = "(" + ",".join(str(seq) for seq in seq_block) + ")"
-        stop_times_update_sql = \
-            "UPDATE stop_times SET trip_I={trip_I_generated} WHERE trip_I={orig_trip_I} AND seq IN {seq_block}".format(
-                trip_I_generated=block_trip_I,
-                orig_trip_I=orig_trip_I,
-                seq_block=seq_values_to_update_str
-            )
-        copy_db_conn.execute(stop_times_update_sql)
+def _split_trips_leaving_buffer(copy_db_conn, max_trip_I):
+    """
+    Split all trips that leave the buffer (temp.stops_within_buffer) and then come back.
 
-    copy_db_conn.execute("DELETE FROM trips WHERE trip_I={orig_trip_I}".format(orig_trip_I=orig_trip_I))
-    copy_db_conn.execute("DELETE from stop_times WHERE trip_I={orig_trip_I}".format(orig_trip_I=orig_trip_I))
-    copy_db_conn.execute("DELETE FROM shapes WHERE shape_id IN "
-                         " (SELECT DISTINCT shapes.shape_id FROM shapes, trips "
-                         "     WHERE trip_I={orig_trip_I} AND shapes.shape_id=trips.shape_id)"
-                         .format(orig_trip_I=orig_trip_I))
+    Each block of at least two consecutive stops within the buffer becomes a new trip, with mostly the
+    same trip information as the original, and the stop_times of the block are moved to the new trip.
+    New trip_I values are assigned in the order of (original trip_I, block) starting from max_trip_I + 1.
+    The original trips are then removed.
+
+    Returns
+    -------
+    new_trip_Is: list[int]
+    """
+    copy_db_conn.execute("DROP TABLE IF EXISTS temp.trips_leaving_buffer")
+    copy_db_conn.execute("CREATE TEMP TABLE trips_leaving_buffer AS "
+                         "SELECT DISTINCT trip_I FROM stop_times "
+                         "WHERE stop_I NOT IN (SELECT stop_I FROM temp.stops_within_buffer)")
+    # number the blocks of consecutive stops within the buffer by the count of preceding stops outside it
+    copy_db_conn.execute("DROP TABLE IF EXISTS temp.split_stop_times")
+    copy_db_conn.execute(
+        "CREATE TEMP TABLE split_stop_times AS "
+        "SELECT trip_I, seq, block FROM "
+        "(SELECT trip_I, seq, within, sum(1 - within) OVER (PARTITION BY trip_I ORDER BY seq) AS block FROM "
+        " (SELECT trip_I, seq, stop_I IN (SELECT stop_I FROM temp.stops_within_buffer) AS within "
+        "  FROM stop_times WHERE trip_I IN (SELECT trip_I FROM temp.trips_leaving_buffer))) "
+        "WHERE within"
+    )
+    copy_db_conn.execute("DROP TABLE IF EXISTS temp.split_trips")
+    copy_db_conn.execute(
+        "CREATE TEMP TABLE split_trips AS "
+        "SELECT trip_I, block, "
+        "row_number() OVER (PARTITION BY trip_I ORDER BY block) - 1 AS part, "
+        "{max_trip_I} + row_number() OVER (ORDER BY trip_I, block) AS new_trip_I "
+        "FROM split_stop_times GROUP BY trip_I, block HAVING count(*) > 1".format(max_trip_I=int(max_trip_I or 0))
+    )
+    copy_db_conn.execute(
+        "INSERT INTO trips (trip_I, trip_id, route_I, service_I, direction_id, "
+        "shape_id, headsign, start_time_ds, end_time_ds) "
+        "SELECT new_trip_I, trip_id || '_splitted_part_' || part, route_I, service_I, direction_id, "
+        "NULL, headsign, NULL, NULL "
+        "FROM temp.split_trips, trips WHERE split_trips.trip_I = trips.trip_I ORDER BY new_trip_I"
+    )
+    new_trip_Is = [row[0] for row in copy_db_conn.execute("SELECT new_trip_I FROM temp.split_trips")]
+    copy_db_conn.execute("DROP TABLE IF EXISTS temp.split_stop_time_trip_Is")
+    copy_db_conn.execute("CREATE TEMP TABLE split_stop_time_trip_Is "
+                         "(trip_I INT, seq INT, new_trip_I INT, PRIMARY KEY (trip_I, seq))")
+    copy_db_conn.execute(
+        "INSERT INTO temp.split_stop_time_trip_Is "
+        "SELECT s.trip_I, s.seq, t.new_trip_I FROM temp.split_stop_times AS s, temp.split_trips AS t "
+        "WHERE s.trip_I = t.trip_I AND s.block = t.block"
+    )
+    copy_db_conn.execute(
+        "UPDATE stop_times SET trip_I = "
+        "(SELECT new_trip_I FROM temp.split_stop_time_trip_Is AS s "
+        " WHERE s.trip_I = stop_times.trip_I AND s.seq = stop_times.seq) "
+        "WHERE (trip_I, seq) IN (SELECT trip_I, seq FROM temp.split_stop_time_trip_Is)"
+    )
+    copy_db_conn.execute("DELETE FROM trips WHERE trip_I IN (SELECT trip_I FROM temp.trips_leaving_buffer)")
+    copy_db_conn.execute("DELETE FROM stop_times WHERE trip_I IN (SELECT trip_I FROM temp.trips_leaving_buffer)")
+    for table in ["trips_leaving_buffer", "split_stop_times", "split_trips", "split_stop_time_trip_Is"]:
+        copy_db_conn.execute("DROP TABLE temp." + table)
+    return new_trip_Is
+
+
+def update_secondary_data_copies(db_conn, trip_Is=None, service_Is=None):
+    """
+    Update the data derived from the primary GTFS tables (trips.start_time_ds, trips.end_time_ds,
+    stop_times.seq, days and day_trips2).
 
-def update_secondary_data_copies(db_conn):
+    Parameters
+    ----------
+    db_conn: sqlite3.Connection
+    trip_Is: iterable of ints, optional
+        The trips whose stop_times, or service, have been modified or which have been added.
+        If given, only the data of these trips is recomputed, and the data of removed trips
+        (and of removed days) is deleted.
+        By default everything is recomputed.
+    service_Is: iterable of ints, optional
+        The services whose calendar or calendar_dates entries have been modified.
+        The data of all trips of these services is recomputed.
+
+    If the changed trips are more than INCREMENTAL_UPDATE_MAX_TRIP_FRACTION of all trips,
+    everything is recomputed.
+    """
     G = gtfspy.gtfs.GTFS(db_conn)
     G.set_current_process_time_zone()
-    update_trip_travel_times_ds(db_conn)
-    resequence_stop_times_seq_values(db_conn)
-    recreate_days_table(db_conn)
-    recreate_day_trips2_table(db_conn)
+    if trip_Is is not None or service_Is is not None:
+        trip_Is = set(trip_Is or ())
+        if service_Is is not None:
+            create_temp_id_table(db_conn, "changed_service_Is", "service_I", service_Is)
+            trip_Is.update(row[0] for row in db_conn.execute(
+                "SELECT trip_I FROM trips WHERE service_I IN (SELECT service_I FROM temp.changed_service_Is)"))
+            db_conn.execute("DROP TABLE temp.changed_service_Is")
+        # Updating a large part of the tables row by row (with the indices in place)
+        # is slower than recomputing them.
+        n_trips = db_conn.execute("SELECT count(*) FROM trips").fetchone()[0]
+        if len(trip_Is) > INCREMENTAL_UPDATE_MAX_TRIP_FRACTION * n_trips:
+            trip_Is = None
+    update_trip_travel_times_ds(db_conn, trip_Is)
+    resequence_stop_times_seq_values(db_conn, trip_Is)
+    recreate_days_table(db_conn, trip_Is)
+    recreate_day_trips2_table(db_conn, trip_Is)
+    gtfs.bump_data_version(db_conn)
+    db_conn.commit()
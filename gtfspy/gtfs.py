@@ -6,7 +6,7 @@ import sqlite3
 import sys
 import time
 import warnings
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from datetime import timedelta
 
 import numpy
@@ -22,6 +22,9 @@ from gtfspy.util import wgs84_distance, wgs84_width, wgs84_height, set_process_t
 
 class GTFS(object):
 
+    # maximum number of shapes kept in the shape points cache
+    shape_points_cache_size = 1000
+
     def __init__(self, fname_or_conn):
         """Open a GTFS object
 
@@ -50,12 +53,17 @@ class GTFS(object):
         assert self.conn.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchone() is not None
         self.meta = GTFSMetadata(self.conn)
 
+        # opt-in cache for metadata lookups, see enable_cache
+        self._lookup_cache = None
+
         # Bind functions
         self.conn.create_function("find_distance", 4, wgs84_distance)
 
         # Set timezones
         self._timezone = pytz.timezone(self.get_timezone_name())
 
+        self._shape_points_cache = OrderedDict()
+
     def __del__(self):
         if not getattr(self, '_dont_close', False) and hasattr(self, "conn"):
             self.conn.close()
@@ -220,6 +228,118 @@ class GTFS(object):
     def get_timezone_pytz(self):
         return self._timezone
 
+    def enable_cache(self, time_cache_size=10000, shared_with=None):
+        """
+        Cache frequently used metadata lookups that would otherwise query the database (or pytz) on each call.
+
+        When enabled, stops(), get_stop_coordinates(), get_route_name_and_type_of_tripI() and
+        get_timezone_name() are served from lookup tables loaded once from the database, and the results of
+        day_start_ut(), get_day_start_ut() and increment_day_start_ut() are kept in a size-bounded LRU cache.
+        The cache is cleared by the methods of this class that modify stops
+        (add_stop, update_stop_coordinates, replace_stop_i_with_stop_pair_i); call clear_cache()
+        if the database is modified by other means.
+
+        Parameters
+        ----------
+        time_cache_size: int
+            maximum number of cached date/time conversions
+        shared_with: GTFS, optional
+            use the (enabled) cache of another GTFS object of the same database instead of a new one,
+            e.g. for the GTFS objects of a gtfspy.gtfs_pool.GTFSPool
+        """
+        if shared_with is not None:
+            assert shared_with._lookup_cache is not None, "the cache of shared_with is not enabled"
+            self._lookup_cache = shared_with._lookup_cache
+        else:
+            self._lookup_cache = _LookupCache(time_cache_size)
+
+    def disable_cache(self):
+        self._lookup_cache = None
+
+    def clear_cache(self):
+        if self._lookup_cache is not None:
+            self._lookup_cache.clear()
+
+    def get_route_names_and_types_of_tripIs(self, trip_Is):
+        """
+        Get route short names and types of many trips at once (uses the metadata cache).
+
+        Parameters
+        ----------
+        trip_Is: array-like of int
+
+        Returns
+        -------
+        names: numpy.ndarray (of objects)
+            None for unknown trips
+        types: numpy.ndarray (of ints)
+            -1 for unknown trips
+        """
+        names, types = self._get_trip_lookup()
+        trip_Is = numpy.asarray(trip_Is, dtype=int)
+        valid = (trip_Is >= 0) & (trip_Is < len(types))
+        result_names = numpy.full(len(trip_Is), None, dtype=object)
+        result_types = numpy.full(len(trip_Is), -1, dtype=int)
+        result_names[valid] = names[trip_Is[valid]]
+        result_types[valid] = types[trip_Is[valid]]
+        return result_names, result_types
+
+    def get_stop_coordinates_of_stop_Is(self, stop_Is):
+        """
+        Get the coordinates of many stops at once (uses the metadata cache).
+
+        Parameters
+        ----------
+        stop_Is: array-like of int
+
+        Returns
+        -------
+        lats: numpy.ndarray
+        lons: numpy.ndarray
+            nan for unknown stops
+        """
+        lats, lons = self._get_stop_lookup()
+        stop_Is = numpy.asarray(stop_Is, dtype=int)
+        valid = (stop_Is >= 0) & (stop_Is < len(lats))
+        result_lats = numpy.full(len(stop_Is), numpy.nan)
+        result_lons = numpy.full(len(stop_Is), numpy.nan)
+        result_lats[valid] = lats[stop_Is[valid]]
+        result_lons[valid] = lons[stop_Is[valid]]
+        return result_lats, result_lons
+
+    def _get_cache(self):
+        if self._lookup_cache is None:
+            # bulk lookups use a temporary cache when caching is not enabled
+            return _LookupCache(0)
+        return self._lookup_cache
+
+    def _get_trip_lookup(self):
+        cache = self._get_cache()
+        if cache.trip_lookup is None:
+            rows = self.conn.execute("SELECT trip_I, name, type FROM trips JOIN routes USING(route_I)").fetchall()
+            size = max(row[0] for row in rows) + 1 if rows else 0
+            names = numpy.full(size, None, dtype=object)
+            types = numpy.full(size, -1, dtype=int)
+            for trip_I, name, route_type in rows:
+                names[trip_I] = u"%s" % str(name)
+                types[trip_I] = route_type
+            cache.trip_lookup = names, types
+        return cache.trip_lookup
+
+    def _get_stop_lookup(self):
+        cache = self._get_cache()
+        if cache.stop_lookup is None:
+            rows = numpy.array(self.conn.execute("SELECT stop_I, lat, lon FROM stops").fetchall(),
+                               dtype=float).reshape(-1, 3)
+            size = int(rows[:, 0].max()) + 1 if len(rows) else 0
+            lats = numpy.full(size, numpy.nan)
+            lons = numpy.full(size, numpy.nan)
+            stop_Is = rows[:, 0].astype(int)
+            lats[stop_Is] = rows[:, 1]
+            lons[stop_Is] = rows[:, 2]
+            cache.stop_lookup = lats, lons
+        return cache.stop_lookup
+
     def get_timezone_name(self):
         """
         Get name of the GTFS timezone
@@ -229,6 +349,14 @@ class GTFS(object):
         timezone_name : str
             name of the time zone, e.g. "Europe/Helsinki"
         """
+        cache = self._lookup_cache
+        if cache is not None:
+            if cache.timezone_name is None:
+                cache.timezone_name = self._get_timezone_name()
+            return cache.timezone_name
+        return self._get_timezone_name()
+
+    def _get_timezone_name(self):
         tz_name = self.conn.execute('SELECT timezone FROM agencies LIMIT 1').fetchone()
         if tz_name is None:
             raise ValueError("This database does not have a timezone defined.")
@@ -314,6 +442,12 @@ class GTFS(object):
         if isinstance(date, string_types):
             date = datetime.datetime.strptime(date, '%Y-%m-%d')
 
+        if self._lookup_cache is not None:
+            return self._lookup_cache.get_time(("get_day_start_ut", date.year, date.month, date.day),
+                                               lambda: self._get_day_start_ut(date))
+        return self._get_day_start_ut(date)
+
+    def _get_day_start_ut(self, date):
         date_noon = datetime.datetime(date.year, date.month, date.day, 12, 0, 0)
         ut_noon = self.unlocalized_datetime_to_ut_seconds(date_noon)
         return ut_noon - 12 * 60 * 60  # this comes from GTFS: noon-12 hrs
@@ -343,75 +477,127 @@ class GTFS(object):
                 el['times'] -- list of passage_times
                 el['route_type'] -- type of vehicle as specified by GTFS
                 el['name'] -- name of the route
+                el['trip_I'] -- index of the trip
+        """
+        trips = list(self.iter_trip_trajectories_within_timespan(start, end, use_shapes, filter_name))
+        return {"trips": trips}
+
+    def iter_trip_trajectories_within_timespan(self, start, end, use_shapes=True, filter_name=None):
         """
-        trips = []
-        trip_df = self.get_tripIs_active_in_range(start, end)
-        print("gtfs_viz.py: fetched " + str(len(trip_df)) + " trip ids")
-        shape_cache = {}
-
-        # loop over all trips:
-        for row in trip_df.itertuples():
-            trip_I = row.trip_I
-            day_start_ut = row.day_start_ut
-            shape_id = row.shape_id
-
-            trip = {}
-
-            name, route_type = self.get_route_name_and_type_of_tripI(trip_I)
-            trip['route_type'] = int(route_type)
-            trip['name'] = str(name)
-
-            if filter_name and (name != filter_name):
-                continue
-
-            stop_lats = []
-            stop_lons = []
-            stop_dep_times = []
-            shape_breaks = []
-            stop_seqs = []
-
-            # get stop_data and store it:
-            stop_time_df = self.get_trip_stop_time_data(trip_I, day_start_ut)
-            for stop_row in stop_time_df.itertuples():
-                stop_lats.append(float(stop_row.lat))
-                stop_lons.append(float(stop_row.lon))
-                stop_dep_times.append(float(stop_row.dep_time_ut))
-                try:
-                    stop_seqs.append(int(stop_row.seq))
-                except TypeError:
-                    stop_seqs.append(None)
-                if use_shapes:
-                    try:
-                        shape_breaks.append(int(stop_row.shape_break))
-                    except (TypeError, ValueError):
-                        shape_breaks.append(None)
+        Generator version of get_trip_trajectories_within_timespan, yielding the trips one by one.
+
+        The stop times of all trips active within the timespan are fetched with a single query.
+        Shape data are cached across calls (see get_shape_points_cached).
+
+        Parameters
+        ----------
+        start: number
+        end: number
+        use_shapes: bool, optional
+        filter_name: str, optional
 
+        Yields
+        ------
+        trip: dict
+            with keys 'lats', 'lons', 'times', 'route_type', 'name' (see get_trip_trajectories_within_timespan)
+        """
+        query = "SELECT day_trips2.rowid AS day_trip_row, trip_I, trips.shape_id, routes.name, routes.type, " \
+                "day_trips2.day_start_ut + stop_times.dep_time_ds AS dep_time_ut, stops.lat, stops.lon, " \
+                "stop_times.shape_break " \
+                "FROM day_trips2 " \
+                "JOIN trips USING(trip_I) " \
+                "JOIN routes USING(route_I) " \
+                "JOIN stop_times USING(trip_I) " \
+                "JOIN stops USING(stop_I) " \
+                "WHERE day_trips2.end_time_ut > ? AND day_trips2.start_time_ut < ? "
+        params = [start, end]
+        if filter_name:
+            query += "AND routes.name = ? "
+            params.append(filter_name)
+        query += "ORDER BY day_trips2.rowid, stop_times.seq"
+        stop_times = pd.read_sql_query(query, self.conn, params=params)
+        if len(stop_times) == 0:
+            return
+
+        day_trip_rows = stop_times["day_trip_row"].values
+        trip_starts = numpy.nonzero(numpy.r_[True, day_trip_rows[1:] != day_trip_rows[:-1]])[0]
+        trip_ends = numpy.r_[trip_starts[1:], len(day_trip_rows)]
+        trip_Is = stop_times["trip_I"].values
+        shape_ids = stop_times["shape_id"].values
+        names = stop_times["name"].values
+        route_types = stop_times["type"].values
+        dep_time_uts = stop_times["dep_time_ut"].values.astype(float)
+        lats = stop_times["lat"].values.astype(float)
+        lons = stop_times["lon"].values.astype(float)
+        shape_breaks = stop_times["shape_break"].values
+
+        for trip_start, trip_end in zip(trip_starts, trip_ends):
+            trip = {'trip_I': int(trip_Is[trip_start]),
+                    'route_type': int(route_types[trip_start]),
+                    'name': str(names[trip_start])}
+            stop_dep_times = dep_time_uts[trip_start:trip_end]
+            trip_shape_data = None
             if use_shapes:
-                # get shape data (from cache, if possible)
-                if shape_id not in shape_cache:
-                    shape_cache[shape_id] = shapes.get_shape_points2(self.conn.cursor(), shape_id)
-                shape_data = shape_cache[shape_id]
-                # noinspection PyBroadException
-                try:
-                    trip['times'] = shapes.interpolate_shape_times(shape_data['d'], shape_breaks, stop_dep_times)
-                    trip['lats'] = shape_data['lats']
-                    trip['lons'] = shape_data['lons']
-                    start_break = shape_breaks[0]
-                    end_break = shape_breaks[-1]
-                    trip['times'] = trip['times'][start_break:end_break + 1]
-                    trip['lats'] = trip['lats'][start_break:end_break + 1]
-                    trip['lons'] = trip['lons'][start_break:end_break + 1]
-                except:
-                    # In case interpolation fails:
-                    trip['times'] = stop_dep_times
-                    trip['lats'] = stop_lats
-                    trip['lons'] = stop_lons
+                shape_points = self.get_shape_points_cached(shape_ids[trip_start])
+                trip_shape_data = shapes.interpolate_shape_times_vectorized(shape_points['d'],
+                                                                            shape_breaks[trip_start:trip_end],
+                                                                            stop_dep_times)
+            if trip_shape_data is not None:
+                times, start_break, end_break = trip_shape_data
+                trip['times'] = times.tolist()
+                trip['lats'] = shape_points['lats'][start_break:end_break + 1]
+                trip['lons'] = shape_points['lons'][start_break:end_break + 1]
             else:
-                trip['times'] = stop_dep_times
-                trip['lats'] = stop_lats
-                trip['lons'] = stop_lons
-            trips.append(trip)
-        return {"trips": trips}
+                # no shapes, or the interpolation is not possible:
+                trip['times'] = stop_dep_times.tolist()
+                trip['lats'] = lats[trip_start:trip_end].tolist()
+                trip['lons'] = lons[trip_start:trip_end].tolist()
+            yield trip
+
+    def get_vehicle_positions(self, start, end, use_shapes=True):
+        """
+        Precompute vehicle trajectories within a timespan for fast "where is every vehicle at time t" queries.
+
+        Parameters
+        ----------
+        start: number
+            start of the timespan (unix time)
+        end: number
+            end of the timespan (unix time)
+        use_shapes: bool, optional
+            whether vehicles should move along shapes (if available)
+
+        Returns
+        -------
+        vehicle_positions: gtfspy.vehicle_positions.VehiclePositions
+            see VehiclePositions.positions_at and VehiclePositions.positions_over
+        """
+        from gtfspy.vehicle_positions import VehiclePositions
+        return VehiclePositions(self.iter_trip_trajectories_within_timespan(start, end, use_shapes=use_shapes))
+
+    def get_shape_points_cached(self, shape_id):
+        """
+        Get the points of a shape (see shapes.get_shape_points2), using a size-bounded LRU cache
+        that is kept over calls.
+
+        Parameters
+        ----------
+        shape_id: str
+
+        Returns
+        -------
+        shape_points: dict of lists
+            dict contains keys 'seqs', 'lats', 'lons', and 'd'
+        """
+        cache = self._shape_points_cache
+        if shape_id in cache:
+            cache.move_to_end(shape_id)
+            return cache[shape_id]
+        shape_points = shapes.get_shape_points2(self.conn.cursor(), shape_id)
+        cache[shape_id] = shape_points
+        if len(cache) > self.shape_points_cache_size:
+            cache.popitem(last=False)
+        return shape_points
 
     def get_stop_count_data(self, start_ut, end_ut):
         """
@@ -432,21 +618,16 @@ class GTFS(object):
             with data types
                 (int, int, float, float, str)
         """
-        # TODO! this function could perhaps be made a single sql query now with the new tables?
-        trips_df = self.get_tripIs_active_in_range(start_ut, end_ut)
-        # stop_I -> count, lat, lon, name
-        stop_counts = Counter()
-
-        # loop over all trips:
-        for row in trips_df.itertuples():
-            # get stop_data and store it:
-            stops_seq = self.get_trip_stop_time_data(row.trip_I, row.day_start_ut)
-            for stop_time_row in stops_seq.itertuples(index=False):
-                if (stop_time_row.dep_time_ut >= start_ut) and (stop_time_row.dep_time_ut <= end_ut):
-                    stop_counts[stop_time_row.stop_I] += 1
+        query = "SELECT stop_I, count(*) AS count " \
+                "FROM day_trips2 JOIN stop_times USING(trip_I) " \
+                "WHERE day_trips2.end_time_ut > ? AND day_trips2.start_time_ut < ? " \
+                "AND day_trips2.day_start_ut + stop_times.dep_time_ds >= ? " \
+                "AND day_trips2.day_start_ut + stop_times.dep_time_ds <= ? " \
+                "GROUP BY stop_I"
+        stop_counts = dict(self.conn.execute(query, (start_ut, end_ut, start_ut, end_ut)).fetchall())
 
         all_stop_data = self.stops()
-        counts = [stop_counts[stop_I] for stop_I in all_stop_data["stop_I"].values]
+        counts = [stop_counts.get(stop_I, 0) for stop_I in all_stop_data["stop_I"].values]
 
         all_stop_data.loc[:, "count"] = pd.Series(counts, index=all_stop_data.index)
         return all_stop_data
@@ -472,43 +653,56 @@ class GTFS(object):
                 "trip_I", "lats", "lons", "shape_id", "stop_seqs", "shape_breaks"
         """
         cur = self.conn.cursor()
-        # get all possible trip_ids that take place between start and end
-        trips_df = self.get_tripIs_active_in_range(start, end)
-        # stop_I -> count, lat, lon, name
-        segment_counts = Counter()
+        # fetch the stop times of all trips active between start and end at once
+        query = "SELECT day_trips2.trip_I, day_trips2.day_start_ut, stop_I, " \
+                "day_trips2.day_start_ut + stop_times.dep_time_ds AS dep_time_ut, seq, shape_break " \
+                "FROM day_trips2 JOIN stop_times USING(trip_I) " \
+                "WHERE day_trips2.end_time_ut > ? AND day_trips2.start_time_ut < ? " \
+                "ORDER BY day_trips2.day_start_ut, day_trips2.trip_I, seq"
+        stop_times = pd.read_sql_query(query, self.conn, params=(start, end))
+        trip_Is = stop_times["trip_I"].values
+        day_start_uts = stop_times["day_start_ut"].values
+        dep_time_uts = stop_times["dep_time_ut"].values
+        # row i and row i + 1 form a segment, if they belong to the same trip (on the same day) and
+        # the segment is _contained_ in the interval
+        # overlap would read:
+        #   (dep_time_ut <= end) and (start <= dep_time_ut_n)
+        is_segment = (trip_Is[:-1] == trip_Is[1:]) & (day_start_uts[:-1] == day_start_uts[1:]) & \
+                     (dep_time_uts[:-1] >= start) & (dep_time_uts[1:] <= end)
+        first_rows = numpy.nonzero(is_segment)[0]
+
+        stop_Is = stop_times["stop_I"].values
+        segments = numpy.column_stack([stop_Is[first_rows], stop_Is[first_rows + 1]])
+        if len(segments) > 0:
+            unique_segments, first_occurrences, seg_counts = numpy.unique(segments, axis=0,
+                                                                          return_index=True, return_counts=True)
+        else:
+            unique_segments, first_occurrences, seg_counts = segments, [], []
+
+        stops_df = self.stops().set_index("stop_I")
+        stop_names = stops_df["name"].to_dict()
+        stop_lats = stops_df["lat"].to_dict()
+        stop_lons = stops_df["lon"].to_dict()
+        seqs = stop_times["seq"].values
+        shape_break_values = stop_times["shape_break"].values
+
+        def _value_or_none(value):
+            return None if pd.isnull(value) else int(value)
+
+        segment_counts = {}
         seg_to_info = {}
-        # tripI_to_seq = "inverted segToShapeData"
-        tripI_to_seq = defaultdict(list)
-
-        # loop over all trips:
-        for row in trips_df.itertuples():
-            # get stop_data and store it:
-            stops_df = self.get_trip_stop_time_data(row.trip_I, row.day_start_ut)
-            for i in range(len(stops_df) - 1):
-                (stop_I, dep_time_ut, s_lat, s_lon, s_seq, shape_break) = stops_df.iloc[i]
-                (stop_I_n, dep_time_ut_n, s_lat_n, s_lon_n, s_seq_n, shape_break_n) = stops_df.iloc[i + 1]
-                # test if _contained_ in the interval
-                # overlap would read:
-                #   (dep_time_ut <= end) and (start <= dep_time_ut_n)
-                if (dep_time_ut >= start) and (dep_time_ut_n <= end):
-                    seg = (stop_I, stop_I_n)
-                    segment_counts[seg] += 1
-                    if seg not in seg_to_info:
-                        seg_to_info[seg] = {
-                            u"trip_I": row.trip_I,
-                            u"lats": [s_lat, s_lat_n],
-                            u"lons": [s_lon, s_lon_n],
-                            u"shape_id": row.shape_id,
-                            u"stop_seqs": [s_seq, s_seq_n],
-                            u"shape_breaks": [shape_break, shape_break_n]
-                        }
-                        tripI_to_seq[row.trip_I].append(seg)
-
-        stop_names = {}
-        for (stop_I, stop_J) in segment_counts.keys():
-            for s in [stop_I, stop_J]:
-                if s not in stop_names:
-                    stop_names[s] = self.stop(s)[u'name'].values[0]
+        for (stop_I, stop_I_n), first_occurrence, count in zip(unique_segments.tolist(), first_occurrences,
+                                                                 seg_counts):
+            i = first_rows[first_occurrence]
+            seg = (stop_I, stop_I_n)
+            segment_counts[seg] = int(count)
+            seg_to_info[seg] = {
+                u"trip_I": int(trip_Is[i]),
+                u"lats": [stop_lats[stop_I], stop_lats[stop_I_n]],
+                u"lons": [stop_lons[stop_I], stop_lons[stop_I_n]],
+                u"stop_seqs": [_value_or_none(seqs[i]), _value_or_none(seqs[i + 1])],
+                u"shape_breaks": [_value_or_none(shape_break_values[i]), _value_or_none(shape_break_values[i + 1])]
+            }
 
         seg_data = []
         for seg, count in segment_counts.items():
@@ -618,7 +812,8 @@ class GTFS(object):
         trip_counts : pandas.DataFrame
             Has columns "date_str" (dtype str) "trip_counts" (dtype int)
         """
-        query = "SELECT date, count(*) AS number_of_trips FROM day_trips GROUP BY date"
+        # day_trips2 (when it exists) has one row per trip and day, and its date index covers this query
+        query = "SELECT date, count(*) AS number_of_trips FROM " + self._get_day_trips_table_name() + " GROUP BY date"
         # this yields the actual data
         trip_counts_per_day = pd.read_sql_query(query, self.conn, index_col="date")
         # the rest is simply code for filling out "gaps" in the time span
@@ -830,6 +1025,10 @@ class GTFS(object):
         return min_stop_I
 
     def get_stop_coordinates(self, stop_I):
+        if self._lookup_cache is not None:
+            lats, lons = self._get_stop_lookup()
+            if 0 <= stop_I < len(lats) and not numpy.isnan(lats[stop_I]):
+                return float(lats[stop_I]), float(lons[stop_I])
         cur = self.conn.cursor()
         results = cur.execute("SELECT lat, lon FROM stops WHERE stop_I={stop_I}".format(stop_I=stop_I))
         lat, lon = results.fetchone()
@@ -875,6 +1074,10 @@ class GTFS(object):
         type: int
             route_type according to the GTFS standard
         """
+        if self._lookup_cache is not None:
+            names, types = self._get_trip_lookup()
+            if 0 <= trip_I < len(types) and types[trip_I] != -1:
+                return names[trip_I], int(types[trip_I])
         cur = self.conn.cursor()
         results = cur.execute("SELECT name, type FROM routes JOIN trips USING(route_I) WHERE trip_I={trip_I}"
                               .format(trip_I=trip_I))
@@ -1104,6 +1307,11 @@ class GTFS(object):
         ut: int
             Unixtime corresponding to start of day
         """
+        if self._lookup_cache is not None:
+            return self._lookup_cache.get_time(("day_start_ut", ut), lambda: self._day_start_ut(ut))
+        return self._day_start_ut(ut)
+
+    def _day_start_ut(self, ut):
         # set timezone to the one of gtfs
         old_tz = self.set_current_process_time_zone()
         ut = time.mktime(time.localtime(ut)[:3] + (12, 00, 0, 0, 0, -1)) - 43200
@@ -1122,6 +1330,12 @@ class GTFS(object):
         n_days: int
             number of days to increment
         """
+        if self._lookup_cache is not None:
+            return self._lookup_cache.get_time(("increment_day_start_ut", day_start_ut, n_days),
+                                               lambda: self._increment_day_start_ut(day_start_ut, n_days))
+        return self._increment_day_start_ut(day_start_ut, n_days)
+
+    def _increment_day_start_ut(self, day_start_ut, n_days):
         old_tz = self.set_current_process_time_zone()
         day0 = time.localtime(day_start_ut + 43200)  # time of noon
         dayN = time.mktime(day0[:2] +  # YYYY, MM
@@ -1161,49 +1375,54 @@ class GTFS(object):
             # 7 hours:
             max_time_overnight = 7 * 60 * 60
 
-        # sanity checks for the timezone parameter
-        # assert timezone < 14
-        # assert timezone > -14
-        # tz_seconds = int(timezone*3600)
         assert start_ut < end_ut
-        start_day_ut = self.day_start_ut(start_ut)
-        # start_day_ds = int(start_ut+tz_seconds) % seconds_in_a_day  #??? needed?
-        start_day_ds = start_ut - start_day_ut
-        # assert (start_day_ut+tz_seconds) % seconds_in_a_day == 0
-        end_day_ut = self.day_start_ut(end_ut)
-        # end_day_ds = int(end_ut+tz_seconds) % seconds_in_a_day    #??? needed?
-        # end_day_ds = end_ut - end_day_ut
-        # assert (end_day_ut+tz_seconds) % seconds_in_a_day == 0
+        start_date = self._ut_to_local_date(start_ut)
+        end_date = self._ut_to_local_date(end_ut)
+        start_day_ut = self._get_day_start_uts_of_dates(pd.DatetimeIndex([start_date]))[0]
 
         # If we are early enough in a day that we might have trips from
         # the previous day still running, decrement the start day.
-        if start_day_ds < max_time_overnight:
-            start_day_ut = self.increment_day_start_ut(start_day_ut, n_days=-1)
-
-        # day_start_times_ut = range(start_day_ut, end_day_ut+seconds_in_a_day, seconds_in_a_day)
-
-        # Create a list of all possible day start times.  This is roughly
-        # range(day_start_ut, day_end_ut+1day, 1day).
-        day_start_times_ut = [start_day_ut]
-        while day_start_times_ut[-1] < end_day_ut:
-            day_start_times_ut.append(self.increment_day_start_ut(day_start_times_ut[-1]))
-
-        start_times_ds = []
-        end_times_ds = []
-        # For every possible day start:
-        for dsut in day_start_times_ut:
-            # start day_seconds starts at either zero, or time - daystart
-            day_start_ut = max(0, start_ut - dsut)
-            start_times_ds.append(day_start_ut)
-            # end day_seconds is time-day_start
-            day_end_ut = end_ut - dsut
-            end_times_ds.append(day_end_ut)
-        # Return three tuples which can be zip:ped together.
-        return day_start_times_ut, start_times_ds, end_times_ds
+        if start_ut - start_day_ut < max_time_overnight:
+            start_date -= pd.Timedelta(days=1)
+
+        # All possible day start times, one per date:
+        day_start_times_ut = self._get_day_start_uts_of_dates(pd.date_range(start_date, end_date, freq="D"))
+        # start day_seconds is either zero, or time - daystart
+        start_times_ds = numpy.maximum(0, start_ut - day_start_times_ut)
+        # end day_seconds is time - daystart
+        end_times_ds = end_ut - day_start_times_ut
+        # Return three lists which can be zip:ped together.
+        # day start times are floats, as returned by day_start_ut and increment_day_start_ut
+        return day_start_times_ut.astype(float).tolist(), start_times_ds.tolist(), end_times_ds.tolist()
+
+    def _ut_to_local_date(self, ut):
+        """
+        The date (as a timezone-naive pandas.Timestamp at midnight) of a unix time in the GTFS timezone.
+        """
+        return pd.Timestamp(ut, unit="s", tz="UTC").tz_convert(self._timezone).tz_localize(None).normalize()
+
+    def _get_day_start_uts_of_dates(self, dates):
+        """
+        Vectorized get_day_start_ut.
+
+        Parameters
+        ----------
+        dates: pandas.DatetimeIndex
+            timezone-naive dates
+
+        Returns
+        -------
+        day_start_uts: numpy.ndarray
+            (noon - 12 hours) of each date, in unix time
+        """
+        noons = (dates.normalize() + pd.Timedelta(hours=12)).tz_localize(self._timezone)
+        noons_ut = (noons - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+        return numpy.asarray(noons_ut, dtype=numpy.int64) - 12 * 60 * 60
 
     def get_tripIs_within_range_by_dsut(self,
                                         start_time_ut,
-                                        end_time_ut):
+                                        end_time_ut,
+                                        as_dataframe=False):
         """
         Obtain a list of trip_Is that take place during a time interval.
         The trip needs to be only partially overlapping with the given time interval.
@@ -1216,38 +1435,44 @@ class GTFS(object):
             start of the time interval in unix time (seconds)
         end_time_ut: int
             end of the time interval in unix time (seconds)
+        as_dataframe: bool, optional
+            return a pandas.DataFrame with columns day_start_ut and trip_I instead of a dict
 
         Returns
         -------
         trip_I_dict: dict
             keys: day_start_times to list of integers (trip_Is)
         """
-        cur = self.conn.cursor()
         assert start_time_ut <= end_time_ut
         dst_ut, st_ds, et_ds = \
             self._get_possible_day_starts(start_time_ut, end_time_ut, 7)
-        # noinspection PyTypeChecker
-        assert len(dst_ut) >= 0
+        # All candidate day starts are joined in a single query.
+        # The values are numbers computed above, so they can be embedded in the query.
+        values = ", ".join("(%d, %r, %r)" % row for row in zip(dst_ut, st_ds, et_ds))
+        query = """
+                    WITH candidate_days(day_start_ut, start_ds, end_ds) AS (VALUES {values})
+                    SELECT DISTINCT candidate_days.day_start_ut, trip_I
+                    FROM candidate_days
+                        JOIN days
+                        ON days.day_start_ut = candidate_days.day_start_ut
+                        JOIN trips
+                        USING(trip_I)
+                    WHERE
+                        (trips.start_time_ds <= candidate_days.end_ds)
+                        AND
+                        (trips.end_time_ds >= candidate_days.start_ds)
+                    ORDER BY candidate_days.day_start_ut, trip_I
+                    """.format(values=values)
+        df = pd.read_sql_query(query, self.conn)
+        if as_dataframe:
+            return df
         trip_I_dict = {}
-        for day_start_ut, start_ds, end_ds in \
-                zip(dst_ut, st_ds, et_ds):
-            query = """
-                        SELECT distinct(trip_I)
-                        FROM days
-                            JOIN trips
-                            USING(trip_I)
-                        WHERE
-                            (days.day_start_ut == ?)
-                            AND (
-                                    (trips.start_time_ds <= ?)
-                                    AND
-                                    (trips.end_time_ds >= ?)
-                                )
-                        """
-            params = (day_start_ut, end_ds, start_ds)
-            trip_Is = [el[0] for el in cur.execute(query, params)]
-            if len(trip_Is) > 0:
-                trip_I_dict[day_start_ut] = trip_Is
+        if len(df) > 0:
+            day_start_uts = df["day_start_ut"].values
+            trip_Is = df["trip_I"].values
+            boundaries = numpy.flatnonzero(numpy.diff(day_start_uts)) + 1
+            for day_trip_Is in numpy.split(numpy.arange(len(df)), boundaries):
+                trip_I_dict[float(day_start_uts[day_trip_Is[0]])] = trip_Is[day_trip_Is].tolist()
         return trip_I_dict
 
     def stops(self):
@@ -1258,6 +1483,11 @@ class GTFS(object):
         -------
         df: pandas.DataFrame
         """
+        cache = self._lookup_cache
+        if cache is not None:
+            if cache.stops is None:
+                cache.stops = self.get_table("stops")
+            return cache.stops.copy()
         return self.get_table("stops")
 
     def stop(self, stop_I):
@@ -1349,7 +1579,7 @@ class GTFS(object):
         for row in df.itertuples():
             yield row
 
-    def get_transit_events(self, start_time_ut=None, end_time_ut=None, route_type=None):
+    def get_transit_events(self, start_time_ut=None, end_time_ut=None, route_type=None, trip_start_time_span=None):
         """
         Obtain a list of events that take place during a time interval.
         Each event needs to be only partially overlap the given time interval.
@@ -1363,6 +1593,9 @@ class GTFS(object):
             end of the time interval in unix time (seconds)
         route_type: int
             consider only events for this route_type
+        trip_start_time_span: tuple(int, int), optional
+            consider only the events of trips (on a given day) starting within [trip_start_time_span[0],
+            trip_start_time_span[1]) in unix time
 
         Returns
         -------
@@ -1398,6 +1631,9 @@ class GTFS(object):
         if route_type is not None:
             assert route_type in ALL_ROUTE_TYPES
             where_clauses.append("routes.type={route_type}".format(route_type=route_type))
+        if trip_start_time_span is not None:
+            where_clauses.append(table_name + ".start_time_ut >= {0} AND ".format(int(trip_start_time_span[0])) +
+                                 table_name + ".start_time_ut < {0}".format(int(trip_start_time_span[1])))
         if len(where_clauses) > 0:
             event_query += " WHERE "
             for i, where_clause in enumerate(where_clauses):
@@ -1405,7 +1641,11 @@ class GTFS(object):
                     event_query += " AND "
                 event_query += where_clause
         # ordering is required for later stages
-        event_query += " ORDER BY trip_I, day_start_ut+dep_time_ds;"
+        if trip_start_time_span is None:
+            event_query += " ORDER BY trip_I, day_start_ut+dep_time_ds;"
+        else:
+            # (+trip_I keeps SQLite from scanning all day trips in trip_I order instead of using the start time index)
+            event_query += " ORDER BY +trip_I, day_start_ut+dep_time_ds;"
         events_result = pd.read_sql_query(event_query, self.conn)
         # 'filter' results so that only real "events" are taken into account
         from_indices = numpy.nonzero(
@@ -1415,26 +1655,24 @@ class GTFS(object):
         to_indices = from_indices + 1
         # these should have same trip_ids
         assert (events_result['trip_I'][from_indices].values == events_result['trip_I'][to_indices].values).all()
-        trip_Is = events_result['trip_I'][from_indices]
-        from_stops = events_result['stop_I'][from_indices]
-        to_stops = events_result['stop_I'][to_indices]
-        shape_ids = events_result['shape_id'][from_indices]
-        dep_times = events_result['dep_time_ut'][from_indices]
-        arr_times = events_result['arr_time_ut'][to_indices]
-        route_types = events_result['route_type'][from_indices]
-        route_ids = events_result['route_id'][from_indices]
-        route_Is = events_result['route_I'][from_indices]
-        durations = arr_times.values - dep_times.values
+        from_events = events_result.iloc[from_indices].reset_index(drop=True)
+        to_events = events_result.iloc[to_indices].reset_index(drop=True)
+        durations = to_events['arr_time_ut'].values - from_events['dep_time_ut'].values
         assert (durations >= 0).all()
-        from_seqs = events_result['seq'][from_indices]
-        to_seqs = events_result['seq'][to_indices]
-        data_tuples = zip(from_stops, to_stops, dep_times, arr_times,
-                          shape_ids, route_types, route_ids, trip_Is,
-                          durations, from_seqs, to_seqs, route_Is)
-        columns = ["from_stop_I", "to_stop_I", "dep_time_ut", "arr_time_ut",
-                   "shape_id", "route_type", "route_id", "trip_I",
-                   "duration", "from_seq", "to_seq", "route_I"]
-        df = pd.DataFrame.from_records(data_tuples, columns=columns)
+        df = pd.DataFrame({
+            "from_stop_I": from_events['stop_I'],
+            "to_stop_I": to_events['stop_I'],
+            "dep_time_ut": from_events['dep_time_ut'],
+            "arr_time_ut": to_events['arr_time_ut'],
+            "shape_id": from_events['shape_id'],
+            "route_type": from_events['route_type'],
+            "route_id": from_events['route_id'],
+            "trip_I": from_events['trip_I'],
+            "duration": durations,
+            "from_seq": from_events['seq'],
+            "to_seq": to_events['seq'],
+            "route_I": from_events['route_I']
+        })
         return df
 
     def get_route_difference_with_other_db(self, other_gtfs, start_time, end_time, uniqueness_threshold=None,
@@ -1688,6 +1926,7 @@ class GTFS(object):
         cur.executemany(query_update_row, rows_to_update_self)
         cur.executemany(query_add_row.replace("stops", "other.stops"), rows_to_add_to_other)
         cur.executemany(query_update_row.replace("stops", "other.stops"), rows_to_update_other)
+        bump_data_version(self.conn)
         self.conn.commit()
         print("finished")
 
@@ -1736,7 +1975,9 @@ class GTFS(object):
             "CREATE INDEX idx_stops_sid ON stops (stop_I)"]
         for query in queries:
             cur.execute(query)
+        bump_data_version(self.conn)
         self.conn.commit()
+        self.clear_cache()
 
     def regenerate_parent_stop_I(self):
         raise NotImplementedError
@@ -1759,7 +2000,9 @@ class GTFS(object):
         query_add_row = 'INSERT INTO stops( stop_id, code, name, desc, lat, lon) ' \
                         'VALUES (?, ?, ?, ?, ?, ?)'
         cur.executemany(query_add_row, [[stop_id, code, name, desc, lat, lon]])
+        bump_data_version(self.conn)
         self.conn.commit()
+        self.clear_cache()
 
     def recalculate_stop_distances(self, max_distance):
         from gtfspy.calc_transfers import calc_transfers
@@ -1781,7 +2024,67 @@ class GTFS(object):
 
         stop_values = [(values.lat, values.lon, values.stop_id) for values in stop_updates.itertuples()]
         cur.executemany("""UPDATE stops SET lat = ?, lon = ? WHERE stop_id = ?""", stop_values)
+        bump_data_version(self.conn)
         self.conn.commit()
+        self.clear_cache()
+
+
+class _LookupCache(object):
+    """
+    State of the opt-in metadata cache of a GTFS object (see GTFS.enable_cache).
+    A cache can be shared by GTFS objects used from different threads: concurrent misses
+    may compute the same value twice, but never fail.
+    """
+
+    def __init__(self, time_cache_size):
+        self.time_cache_size = time_cache_size
+        self.clear()
+
+    def clear(self):
+        self.trip_lookup = None
+        self.stop_lookup = None
+        self.stops = None
+        self.timezone_name = None
+        self.times = OrderedDict()
+
+    def get_time(self, key, compute):
+        times = self.times
+        try:
+            value = times[key]
+            times.move_to_end(key)
+            return value
+        except KeyError:
+            # not cached, or evicted by another thread in between
+            pass
+        value = compute()
+        times[key] = value
+        while len(times) > self.time_cache_size:
+            try:
+                times.popitem(last=False)
+            except KeyError:
+                break
+        return value
+
+
+DATA_VERSION_KEY = 'data_version'
+
+
+def bump_data_version(conn):
+    """
+    Increment the data version counter stored in the metadata table (does not commit).
+
+    The write paths of gtfspy (import, filtering, the modifying methods of GTFS)
+    call this, so that results derived from the data and stored into the database
+    can detect also in-place updates of rows (see stats._source_tables_signature).
+    Call this also after modifying the database by other means.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+    """
+    conn.execute('INSERT OR REPLACE INTO metadata (key, value) '
+                 'VALUES (?, COALESCE((SELECT CAST(value AS INT) FROM metadata WHERE key=?), 0) + 1)',
+                 (DATA_VERSION_KEY, DATA_VERSION_KEY))
 
 
 class GTFSMetadata(object):
@@ -0,0 +1,226 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from gtfspy.gtfs import GTFS
+
+
+def connect_read_only(fname, immutable=True, check_same_thread=False):
+    """
+    Open a read-only connection to a GTFS sqlite database.
+
+    Parameters
+    ----------
+    fname: str
+        path to the database
+    immutable: bool
+        if True, sqlite assumes that the file can not change while it is open, and skips all locking
+        (do not use for databases that are being written to)
+    check_same_thread: bool
+        passed to sqlite3.connect, by default connections can be used from any thread
+
+    Returns
+    -------
+    conn: sqlite3.Connection
+    """
+    if not os.path.isfile(fname):
+        raise FileNotFoundError("File " + fname + " missing")
+    uri = "file:" + quote(os.path.abspath(fname)) + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    return sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+
+
+class GTFSPool(object):
+    """
+    A pool of read-only GTFS objects backed by the same database file.
+
+    Opening a GTFS object (connecting, setting pragmas, reading the metadata and the timezone) is relatively
+    costly compared to a small query. The pool opens at most `size` read-only connections, each wrapped
+    into a GTFS object once, and hands them out to one user at a time. The pool itself is thread-safe, so it
+    can be shared by the workers of a thread pool or of an asyncio executor.
+    By default, the pooled GTFS objects share one metadata cache (see GTFS.enable_cache), so that the
+    timezone, the stops and the other lookup tables are read once per pool instead of once per connection.
+
+    Usage
+    -----
+    pool = GTFSPool("city.sqlite", size=8)
+    with pool.gtfs() as G:
+        stops = G.stops()
+    pool.close()
+
+    Notes
+    -----
+    Only read-only queries are possible through pooled GTFS objects.
+    Methods that temporarily change the process timezone (e.g. GTFS.set_current_process_time_zone)
+    are not safe to call from several threads at once.
+    """
+
+    def __init__(self, fname, size=4, immutable=True, mmap_size=1000000000, cache_size=-200000,
+                 enable_cache=True, time_cache_size=10000):
+        """
+        Parameters
+        ----------
+        fname: str
+            path to the gtfs database
+        size: int
+            maximum number of simultaneously open connections
+        immutable: bool
+            see connect_read_only
+        mmap_size: int
+            memory-mapped IO size per connection, in bytes
+        cache_size: int
+            page cache size per connection (negative: in KiB)
+        enable_cache: bool
+            share a metadata cache between the pooled GTFS objects
+        time_cache_size: int
+            see GTFS.enable_cache
+        """
+        if size < 1:
+            raise ValueError("Pool size should be at least 1")
+        if not os.path.isfile(fname):
+            raise FileNotFoundError("File " + fname + " missing")
+        self.fname = fname
+        self.size = size
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.enable_cache = enable_cache
+        self.time_cache_size = time_cache_size
+        # LIFO: recently used (warm) connections are handed out first
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._timezone_name = None
+        # GTFS object owning the cache shared by all pooled objects
+        self._cache_owner = None
+
+    def _open(self):
+        conn = connect_read_only(self.fname, immutable=self.immutable)
+        conn.execute('PRAGMA mmap_size = %d;' % self.mmap_size)
+        conn.execute('PRAGMA cache_size = %d;' % self.cache_size)
+        G = GTFS(conn)
+        if self.enable_cache:
+            with self._lock:
+                if self._cache_owner is None:
+                    G.enable_cache(self.time_cache_size)
+                    self._cache_owner = G
+                else:
+                    G.enable_cache(shared_with=self._cache_owner)
+        if self._timezone_name is None:
+            self._timezone_name = G.get_timezone_name()
+        return G
+
+    def acquire(self, timeout=None):
+        """
+        Take a GTFS object from the pool, opening a new connection if none is idle and the pool is not full.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            seconds to wait for a GTFS object, by default wait forever
+
+        Returns
+        -------
+        G: gtfspy.gtfs.GTFS
+            should be given back with release()
+
+        Raises
+        ------
+        TimeoutError
+            if no GTFS object became available within timeout
+        """
+        if self._closed:
+            raise RuntimeError("GTFSPool is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = len(self._all) < self.size
+            if can_open:
+                # reserve the slot before opening outside the lock
+                self._all.append(None)
+        if can_open:
+            try:
+                G = self._open()
+            except Exception:
+                with self._lock:
+                    self._all.remove(None)
+                raise
+            with self._lock:
+                self._all[self._all.index(None)] = G
+            return G
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No GTFS connection available within %s seconds" % timeout)
+
+    def release(self, G):
+        """
+        Give a GTFS object obtained with acquire() back to the pool.
+        """
+        if self._closed:
+            G.conn.close()
+        else:
+            self._idle.put(G)
+
+    @contextmanager
+    def gtfs(self, timeout=None):
+        """
+        Context manager for acquiring and releasing a pooled GTFS object.
+        """
+        G = self.acquire(timeout=timeout)
+        try:
+            yield G
+        finally:
+            self.release(G)
+
+    def map(self, func, items, timeout=None):
+        """
+        Call func(G, item) for each item sequentially using one pooled GTFS object.
+
+        Returns
+        -------
+        results: list
+        """
+        with self.gtfs(timeout=timeout) as G:
+            return [func(G, item) for item in items]
+
+    def get_timezone_name(self):
+        """
+        The timezone name of the database, read only once per pool.
+        """
+        if self._timezone_name is None:
+            with self.gtfs():
+                pass
+        return self._timezone_name
+
+    @property
+    def n_open(self):
+        with self._lock:
+            return len([G for G in self._all if G is not None])
+
+    def close(self):
+        """
+        Close all idle connections; connections currently in use are closed when released.
+        """
+        self._closed = True
+        while True:
+            try:
+                G = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            G.conn.close()
+        with self._lock:
+            self._all = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -22,7 +22,7 @@ from six import string_types
 
 from gtfspy import stats
 from gtfspy import util
-from gtfspy.gtfs import GTFS
+from gtfspy.gtfs import GTFS, bump_data_version
 
 
 Loaders = [AgencyLoader,  # deps: -
@@ -47,7 +47,8 @@ postprocessors = [
 
 
 def import_gtfs(gtfs_sources, output, preserve_connection=False,
-                print_progress=True, location_name=None, **kwargs):
+                print_progress=True, location_name=None, compute_stats=True,
+                precompute_hourly_departures=False, **kwargs):
     """Import a GTFS database
 
     gtfs_sources: str, dict, list
@@ -64,6 +65,13 @@ def import_gtfs(gtfs_sources, output, preserve_connection=False,
         Whether to print progress output
     location_name: str, optional
         set the location of this database
+    compute_stats: bool, optional
+        Whether to compute the feed statistics (see stats.update_stats) at the end of the import.
+        For large feeds, this can be set to False, and the statistics computed later
+        by calling stats.update_stats(GTFS(output)).
+    precompute_hourly_departures: bool, optional
+        Whether to build the hourly_departures table (see stats.update_hourly_departures) already
+        at import. Otherwise it is built when first needed.
     """
     if isinstance(output, sqlite3.Connection):
         conn = output
@@ -114,6 +122,8 @@ def import_gtfs(gtfs_sources, output, preserve_connection=False,
     # Make any views
     for F in postprocessors:
         F(conn)
+    bump_data_version(conn)
+    conn.commit()
 
     # Set up same basic metadata.
     from gtfspy import gtfs as mod_gtfs
@@ -158,7 +168,10 @@ def import_gtfs(gtfs_sources, output, preserve_connection=False,
             G.meta['download_date'] = unique_download_dates[0]
 
     G.meta['timezone'] = cur.execute('SELECT timezone FROM agencies LIMIT 1').fetchone()[0]
-    stats.update_stats(G)
+    if compute_stats:
+        stats.update_stats(G)
+    if precompute_hourly_departures:
+        stats.update_hourly_departures(G)
     del G
 
     if print_progress:
@@ -1,6 +1,6 @@
 from datetime import timedelta, datetime
 
-from gtfspy.import_loaders.table_loader import TableLoader
+from gtfspy.import_loaders.table_loader import TableLoader, create_temp_id_table
 
 class DayLoader(TableLoader):
     # Note: calendar and calendar_dates should have been imported before
@@ -27,9 +27,22 @@ def drop_day_table_indices(cursor):
     cursor.execute("DROP INDEX IF EXISTS idx_days_dsut_tid")
 
 
-def insert_data_to_days(cur, conn):
-    # clear if something existed before
-    cur.execute("DELETE FROM days")
+def insert_data_to_days(cur, conn, trip_Is=None):
+    """
+    Compute the days table from calendar, calendar_dates and trips.
+
+    If trip_Is is given, only the rows of these trips are recomputed
+    (rows of trips that no longer exist are removed as well).
+    """
+    if trip_Is is None:
+        trip_filter = ''
+        # clear if something existed before
+        cur.execute("DELETE FROM days")
+    else:
+        create_temp_id_table(conn, 'days_trip_Is', 'trip_I', trip_Is)
+        trip_filter = ' AND trip_I IN (SELECT trip_I FROM temp.days_trip_Is)'
+        cur.execute("DELETE FROM days WHERE trip_I IN (SELECT trip_I FROM temp.days_trip_Is)")
+        cur.execute("DELETE FROM days WHERE trip_I NOT IN (SELECT trip_I FROM trips)")
     days = []
     # This index is important here, but no where else, and not for
     # future processing.  So, create it here, delete it at the end
@@ -37,7 +50,11 @@ def insert_data_to_days(cur, conn):
     # moved to CalendarDatesLoader.
     cur.execute('CREATE INDEX IF NOT EXISTS idx_calendar_dates_sid ON calendar_dates (service_I)')
 
-    cur.execute('SELECT * FROM calendar')
+    if trip_Is is None:
+        cur.execute('SELECT * FROM calendar')
+    else:
+        cur.execute('SELECT * FROM calendar WHERE service_I IN '
+                    '(SELECT service_I FROM trips WHERE trip_I IN (SELECT trip_I FROM temp.days_trip_Is))')
     colnames = cur.description
     cur2 = conn.cursor()
 
@@ -86,8 +103,8 @@ def insert_data_to_days(cur, conn):
     cur.executemany("""INSERT INTO days
                    (date, day_start_ut, trip_I)
                    SELECT ?, strftime('%s', ?, '12:00', 'utc')-43200, trip_I
-                   FROM trips WHERE service_I=?
-                   """, ((date, date, service_I)
+                   FROM trips WHERE service_I=?""" + trip_filter,
+                    ((date, date, service_I)
                          for date, service_I in days))
 
     # EXCEPTIONS: Add in dates with exceptions.  Find them and
@@ -97,14 +114,23 @@ def insert_data_to_days(cur, conn):
                  "SELECT date, strftime('%s',date,'12:00','utc')-43200, trip_I "
                  "FROM trips "
                  "JOIN calendar_dates USING(service_I) "
-                 "WHERE exception_type=?",
+                 "WHERE exception_type=?" + trip_filter,
                  (1,))
     conn.commit()
     cur.execute('DROP INDEX IF EXISTS main.idx_calendar_dates_sid')
+    if trip_Is is not None:
+        cur.execute('DROP TABLE temp.days_trip_Is')
 
 
-def recreate_days_table(conn):
+def recreate_days_table(conn, trip_Is=None):
+    """
+    Recreate the days table, or if trip_Is is given, only the rows of those trips.
+    """
     cursor = conn.cursor()
+    if trip_Is is not None:
+        # indices are kept, as only a part of the table is updated
+        insert_data_to_days(cursor, conn, trip_Is)
+        return
     drop_day_table_indices(cursor)
     insert_data_to_days(cursor, conn)
     create_day_table_indices(cursor)
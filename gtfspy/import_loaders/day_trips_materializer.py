@@ -1,4 +1,4 @@
-from gtfspy.import_loaders.table_loader import TableLoader
+from gtfspy.import_loaders.table_loader import TableLoader, create_temp_id_table
 
 
 class DayTripsMaterializer(TableLoader):
@@ -74,21 +74,43 @@ def drop_day_trip_indices(cur):
     cur.execute('DROP INDEX IF EXISTS idx_day_trips2_stut_etut')
     cur.execute('DROP INDEX IF EXISTS idx_day_trips2_dsut')
 
-def insert_data_to_day_trips2(conn):
+def insert_data_to_day_trips2(conn, trip_Is=None):
+    """
+    Compute the day_trips2 table from days and trips.
+
+    If trip_Is is given, only the rows of these trips are recomputed.
+    Rows of other trips are removed if the trip or its day no longer exists in days.
+    """
     cur = conn.cursor()
-    cur.execute('DELETE FROM day_trips2')
+    if trip_Is is None:
+        trip_filter = ''
+        cur.execute('DELETE FROM day_trips2')
+    else:
+        create_temp_id_table(conn, 'day_trips2_trip_Is', 'trip_I', trip_Is)
+        trip_filter = ' WHERE trip_I IN (SELECT trip_I FROM temp.day_trips2_trip_Is)'
+        cur.execute('DELETE FROM day_trips2 WHERE trip_I IN (SELECT trip_I FROM temp.day_trips2_trip_Is)')
+        cur.execute('DELETE FROM day_trips2 WHERE trip_I NOT IN (SELECT trip_I FROM trips)')
+        cur.execute('DELETE FROM day_trips2 WHERE (trip_I, day_start_ut) NOT IN (SELECT trip_I, day_start_ut FROM days)')
+    # (CROSS JOIN makes days the outer loop, as there is no index on days.trip_I alone.)
     cur.execute('INSERT INTO day_trips2 '
                 'SELECT date, trip_I, '
                 'days.day_start_ut+trips.start_time_ds AS start_time_ut, '
                 'days.day_start_ut+trips.end_time_ds AS end_time_ut, '
                 'day_start_ut '
-                'FROM days JOIN trips USING (trip_I)')
+                'FROM days ' + ('CROSS ' if trip_Is is not None else '') + 'JOIN trips USING (trip_I)' + trip_filter)
     # Delete rows, where start_time_ut or end_time_ut IS NULL.
     # This could happen e.g. if stop_times are missing for some trip.
-    cur.execute("DELETE FROM day_trips2 WHERE start_time_ut IS NULL or end_time_ut IS NULL")
+    cur.execute("DELETE FROM day_trips2 WHERE (start_time_ut IS NULL or end_time_ut IS NULL)" +
+                trip_filter.replace(' WHERE', ' AND'))
+    if trip_Is is not None:
+        cur.execute('DROP TABLE temp.day_trips2_trip_Is')
     conn.commit()
 
-def recreate_day_trips2_table(conn):
+def recreate_day_trips2_table(conn, trip_Is=None):
+    if trip_Is is not None:
+        # indices are kept, as only a part of the table is updated
+        insert_data_to_day_trips2(conn, trip_Is)
+        return
     drop_day_trip_indices(conn.cursor())
     insert_data_to_day_trips2(conn)
     create_day_trips_indices(conn.cursor())
\ No newline at end of file
@@ -1,4 +1,4 @@
-from gtfspy.import_loaders.table_loader import TableLoader, decode_six
+from gtfspy.import_loaders.table_loader import TableLoader, decode_six, create_temp_id_table
 
 
 class StopTimesLoader(TableLoader):
@@ -76,9 +76,25 @@ class StopTimesLoader(TableLoader):
     #    conn.commit()
 
 
-def resequence_stop_times_seq_values(conn):
+def resequence_stop_times_seq_values(conn, trip_Is=None):
+    """
+    Renumber stop_times.seq values of each trip to 1, 2, 3, ...
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+    trip_Is: iterable of ints, optional
+        if given, only the stop_times of these trips are resequenced
+    """
     cursor = conn.cursor()
-    rows = cursor.execute('SELECT ROWID, trip_I, seq FROM stop_times ORDER BY trip_I, seq').fetchall()
+    if trip_Is is None:
+        rows = cursor.execute('SELECT ROWID, trip_I, seq FROM stop_times ORDER BY trip_I, seq').fetchall()
+    else:
+        create_temp_id_table(conn, 'resequence_trip_Is', 'trip_I', trip_Is)
+        rows = cursor.execute('SELECT ROWID, trip_I, seq FROM stop_times '
+                              'WHERE trip_I IN (SELECT trip_I FROM temp.resequence_trip_Is) '
+                              'ORDER BY trip_I, seq').fetchall()
+        conn.execute('DROP TABLE temp.resequence_trip_Is')
     old_trip_I = ''
     correct_seq = 1
     for row in rows:
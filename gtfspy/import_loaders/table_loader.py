@@ -372,13 +372,15 @@ class TableLoader(object):
     copy_where = ''
 
     @classmethod
-    def copy(cls, conn, **where):
+    def copy(cls, conn, condition=None, **where):
         """Copy data from one table to another while filtering data at the same time
 
         Parameters
         ----------
         conn: sqlite3 DB connection.  It must have a second database
-            attached as "other".
+            attached as "source".
+        condition: str, optional
+            additional SQL condition that the copied rows should satisfy
         **where : keyword arguments
             specifying (start_ut and end_ut for filtering, see the copy_where clause in the subclasses)
         """
@@ -388,6 +390,11 @@ class TableLoader(object):
             # print(copy_where)
         else:
             copy_where = ''
+        if condition:
+            if copy_where:
+                copy_where += ' AND (%s)' % condition
+            else:
+                copy_where = 'WHERE %s' % condition
         cur.execute('INSERT INTO %s '
                     'SELECT * FROM source.%s %s' % (cls.table, cls.table, copy_where))
 
@@ -405,4 +412,12 @@ def decode_six(string):
         return string.decode('utf-8')
     else:
         assert(isinstance(string, str))
-        return string
\ No newline at end of file
+        return string
+
+def create_temp_id_table(conn, table_name, column, ids):
+    """Create (or replace) a temporary table `temp.<table_name>` with one INTEGER PRIMARY KEY
+    column, filled with the given ids.  Used for restricting updates to a subset of rows."""
+    conn.execute('DROP TABLE IF EXISTS temp.%s' % table_name)
+    conn.execute('CREATE TEMP TABLE %s (%s INTEGER PRIMARY KEY)' % (table_name, column))
+    conn.executemany('INSERT OR IGNORE INTO temp.%s VALUES (?)' % table_name,
+                     ((int(id_),) for id_ in ids))
@@ -1,4 +1,4 @@
-from gtfspy.import_loaders.table_loader import TableLoader, decode_six
+from gtfspy.import_loaders.table_loader import TableLoader, decode_six, create_temp_id_table
 
 
 class TripLoader(TableLoader):
@@ -56,12 +56,27 @@ class TripLoader(TableLoader):
     #    conn.commit()
 
 
-def update_trip_travel_times_ds(conn):
+def update_trip_travel_times_ds(conn, trip_Is=None):
+    """
+    Update trips.start_time_ds and trips.end_time_ds based on stop_times.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+    trip_Is: iterable of ints, optional
+        if given, only these trips are updated
+    """
     cur0 = conn.cursor()
     cur = conn.cursor()
+    if trip_Is is None:
+        trip_filter = ''
+    else:
+        create_temp_id_table(conn, 'travel_time_trip_Is', 'trip_I', trip_Is)
+        trip_filter = 'WHERE trip_I IN (SELECT trip_I FROM temp.travel_time_trip_Is)'
     cur0.execute('''SELECT trip_I, min(dep_time), max(arr_time)
                    FROM trips JOIN stop_times USING (trip_I)
-                   GROUP BY trip_I''')
+                   %s
+                   GROUP BY trip_I''' % trip_filter)
 
     print("updating trips travel times")
 
@@ -81,4 +96,6 @@ def update_trip_travel_times_ds(conn):
 
     cur.executemany('''UPDATE trips SET start_time_ds=?, end_time_ds=? WHERE trip_I=?''',
                     iter_rows(cur0))
+    if trip_Is is not None:
+        conn.execute('DROP TABLE temp.travel_time_trip_Is')
     conn.commit()
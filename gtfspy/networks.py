@@ -1,8 +1,8 @@
 import networkx
+import numpy
 import pandas as pd
-from math import isnan
 from gtfspy import route_types
-from gtfspy.util import wgs84_distance, graph_node_attrs
+from gtfspy.util import wgs84_distances
 from warnings import warn
 
 ALL_STOP_TO_STOP_LINK_ATTRIBUTES = [
@@ -17,7 +17,12 @@ DEFAULT_STOP_TO_STOP_LINK_ATTRIBUTES = [
     "d", "route_I_counts"
 ]
 
-def walk_transfer_stop_to_stop_network(gtfs, max_link_distance=None):
+TEMPORAL_NETWORK_COLUMNS = [
+    "from_stop_I", "to_stop_I", "dep_time_ut", "arr_time_ut",
+    "route_type", "trip_I", "seq", "route_I"
+]
+
+def walk_transfer_stop_to_stop_network(gtfs, max_link_distance=None, return_sparse=False, weight=None):
     """
     Construct the walk network.
     If OpenStreetMap-based walking distances have been computed, then those are used as the distance.
@@ -29,6 +34,12 @@ def walk_transfer_stop_to_stop_network(gtfs, max_link_distance=None):
     max_link_distance: int, optional
         If given, all walking transfers with great circle distance longer
         than this limit (expressed in meters) will be omitted.
+    return_sparse: bool, optional
+        If True, return a symmetric scipy.sparse adjacency matrix instead of a networkx graph
+        (see _links_to_sparse_adjacency). Requires scipy.
+    weight: str, optional
+        Link attribute ("d" or "d_walk") stored as the matrix values when return_sparse is True.
+        By default, each link has value 1.
 
     Returns
     -------
@@ -38,11 +49,13 @@ def walk_transfer_stop_to_stop_network(gtfs, max_link_distance=None):
                 straight-line distance between stops
             d_walk:
                 distance along the road/tracks/..
+    or, if return_sparse is True,
+    adjacency: scipy.sparse.csr_matrix
+    stop_I_to_index: dict[int, int]
     """
     if max_link_distance is None:
         max_link_distance = 1000
-    net = networkx.Graph()
-    _add_stops_to_net(net, gtfs.get_table("stops"))
+    stops = gtfs.get_table("stops")
     stop_distances = gtfs.get_table("stop_distances")
     if stop_distances["d_walk"][0] is None:
         osm_distances_available = False
@@ -51,19 +64,22 @@ def walk_transfer_stop_to_stop_network(gtfs, max_link_distance=None):
     else:
         osm_distances_available = True
 
-    for stop_distance_tuple in stop_distances.itertuples():
-        from_node = stop_distance_tuple.from_stop_I
-        to_node = stop_distance_tuple.to_stop_I
+    if osm_distances_available:
+        d_walk = stop_distances["d_walk"].values.astype(float)
+        links = stop_distances[d_walk <= max_link_distance]
+        data_columns = ['d', 'd_walk']
+    else:
+        links = stop_distances[~(stop_distances["d"].values > max_link_distance)]
+        data_columns = ['d']
 
-        if osm_distances_available:
-            if stop_distance_tuple.d_walk > max_link_distance or isnan(stop_distance_tuple.d_walk):
-                continue
-            data = {'d': stop_distance_tuple.d, 'd_walk': stop_distance_tuple.d_walk}
-        else:
-            if stop_distance_tuple.d > max_link_distance:
-                continue
-            data = {'d': stop_distance_tuple.d}
-        net.add_edge(from_node, to_node, **data)
+    if return_sparse:
+        values = None if weight is None else links[weight].values
+        return _links_to_sparse_adjacency(stops["stop_I"].values, links["from_stop_I"].values,
+                                          links["to_stop_I"].values, values, symmetric=True)
+    net = networkx.Graph()
+    _add_stops_to_net(net, stops)
+    net.add_edges_from(zip(links["from_stop_I"].tolist(), links["to_stop_I"].tolist(),
+                           _records(links, data_columns)))
     return net
 
 
@@ -71,7 +87,9 @@ def stop_to_stop_network_for_route_type(gtfs,
                                         route_type,
                                         link_attributes=None,
                                         start_time_ut=None,
-                                        end_time_ut=None):
+                                        end_time_ut=None,
+                                        return_sparse=False,
+                                        weight=None):
     """
     Get a stop-to-stop network describing a single mode of travel.
 
@@ -95,78 +113,120 @@ def stop_to_stop_network_for_route_type(gtfs,
         start time of the time span (in unix time)
     end_time_ut: int
         end time of the time span (in unix time)
+    return_sparse: bool, optional
+        If True, return a scipy.sparse adjacency matrix instead of a networkx graph
+        (see _links_to_sparse_adjacency). Requires scipy.
+    weight: str, optional
+        Numeric link attribute (e.g. "n_vehicles" or "duration_avg") stored as the matrix values
+        when return_sparse is True. By default, each link has value 1.
 
     Returns
     -------
     net: networkx.DiGraph
         A directed graph Directed graph
+    or, if return_sparse is True,
+    adjacency: scipy.sparse.csr_matrix
+    stop_I_to_index: dict[int, int]
     """
     if link_attributes is None:
         link_attributes = DEFAULT_STOP_TO_STOP_LINK_ATTRIBUTES
-    assert(route_type in route_types.TRANSIT_ROUTE_TYPES)
-
-    stops_dataframe = gtfs.get_stops_for_route_type(route_type)
+    if return_sparse:
+        link_attributes = [] if weight is None else [weight]
+    stops_dataframe, links = _stop_to_stop_links(gtfs, route_type, link_attributes,
+                                                 start_time_ut=start_time_ut, end_time_ut=end_time_ut,
+                                                 as_records=not return_sparse)
+    if return_sparse:
+        values = None if weight is None else links[weight].values
+        return _links_to_sparse_adjacency(stops_dataframe["stop_I"].values, links["from_stop_I"].values,
+                                          links["to_stop_I"].values, values)
     net = networkx.DiGraph()
     _add_stops_to_net(net, stops_dataframe)
+    net.add_edges_from(links)
+    return net
 
+
+def _stop_to_stop_links(gtfs, route_type, link_attributes, start_time_ut=None, end_time_ut=None, as_records=True):
+    """
+    Compute the links (and their attributes) of the stop-to-stop network of a single route_type.
+
+    Parameters
+    ----------
+    gtfs : gtfspy.GTFS
+    route_type : int
+    link_attributes: list[str]
+        see stop_to_stop_network_for_route_type
+    start_time_ut: int, optional
+    end_time_ut: int, optional
+    as_records: bool, optional
+        whether to return the links as a list of (from_stop_I, to_stop_I, data) tuples
+        (suitable for networkx.Graph.add_edges_from) or as a pandas.DataFrame
+
+    Returns
+    -------
+    stops_dataframe: pandas.DataFrame
+    links: list[tuple] | pandas.DataFrame
+        links are ordered by their first appearance in gtfs.get_transit_events
+    """
+    assert(route_type in route_types.TRANSIT_ROUTE_TYPES)
+
+    stops_dataframe = gtfs.get_stops_for_route_type(route_type)
     events_df = gtfs.get_transit_events(start_time_ut=start_time_ut,
                                         end_time_ut=end_time_ut,
                                         route_type=route_type)
-    if len(net.nodes()) < 2:
+    if len(stops_dataframe) < 2:
         assert events_df.shape[0] == 0
 
-    # group events by links, and loop over them (i.e. each link):
+    # aggregate the events of each link in one go
     link_event_groups = events_df.groupby(['from_stop_I', 'to_stop_I'], sort=False)
-    for key, link_events in link_event_groups:
-        from_stop_I, to_stop_I = key
-        assert isinstance(link_events, pd.DataFrame)
-        # 'dep_time_ut' 'arr_time_ut' 'shape_id' 'route_type' 'trip_I' 'duration' 'from_seq' 'to_seq'
-        if link_attributes is None:
-            net.add_edge(from_stop_I, to_stop_I)
-        else:
-            link_data = {}
-            if "duration_min" in link_attributes:
-                link_data['duration_min'] = float(link_events['duration'].min())
-            if "duration_max" in link_attributes:
-                link_data['duration_max'] = float(link_events['duration'].max())
-            if "duration_median" in link_attributes:
-                link_data['duration_median'] = float(link_events['duration'].median())
-            if "duration_avg" in link_attributes:
-                link_data['duration_avg'] = float(link_events['duration'].mean())
-            # statistics on numbers of vehicles:
-            if "n_vehicles" in link_attributes:
-                link_data['n_vehicles'] = int(link_events.shape[0])
-            if "capacity_estimate" in link_attributes:
-                link_data['capacity_estimate'] = route_types.ROUTE_TYPE_TO_APPROXIMATE_CAPACITY[route_type] \
-                                                 * int(link_events.shape[0])
-            if "d" in link_attributes:
-                from_lat = graph_node_attrs(net, from_stop_I)['lat']
-                from_lon = graph_node_attrs(net, from_stop_I)['lon']
-                to_lat = graph_node_attrs(net, to_stop_I)['lat']
-                to_lon = graph_node_attrs(net, to_stop_I)['lon']
-                distance = wgs84_distance(from_lat, from_lon, to_lat, to_lon)
-                link_data['d'] = int(distance)
-            if "distance_shape" in link_attributes:
-                assert "shape_id" in link_events.columns.values
-                found = None
-                for i, shape_id in enumerate(link_events["shape_id"].values):
-                    if shape_id is not None:
-                        found = i
-                        break
-                if found is None:
-                    link_data["distance_shape"] = None
-                else:
-                    link_event = link_events.iloc[found]
-                    distance = gtfs.get_shape_distance_between_stops(
-                        link_event["trip_I"],
-                        int(link_event["from_seq"]),
-                        int(link_event["to_seq"])
-                    )
-                    link_data['distance_shape'] = distance
-            if "route_I_counts" in link_attributes:
-                link_data["route_I_counts"] = link_events.groupby("route_I").size().to_dict()
-            net.add_edge(from_stop_I, to_stop_I, **link_data)
-    return net
+    durations = link_event_groups['duration']
+    links = durations.size().rename('n_vehicles').reset_index()
+    data_columns = []
+    for attribute, aggregate in [("duration_min", "min"), ("duration_max", "max"),
+                                 ("duration_median", "median"), ("duration_avg", "mean")]:
+        if attribute in link_attributes:
+            links[attribute] = getattr(durations, aggregate)().values.astype(float)
+            data_columns.append(attribute)
+    if "n_vehicles" in link_attributes:
+        data_columns.append("n_vehicles")
+    if "capacity_estimate" in link_attributes:
+        links['capacity_estimate'] = route_types.ROUTE_TYPE_TO_APPROXIMATE_CAPACITY[route_type] * links['n_vehicles']
+        data_columns.append("capacity_estimate")
+    if "d" in link_attributes:
+        stop_coordinates = stops_dataframe.set_index('stop_I')
+        from_coordinates = stop_coordinates.loc[links['from_stop_I'].values]
+        to_coordinates = stop_coordinates.loc[links['to_stop_I'].values]
+        distances = wgs84_distances(from_coordinates['lat'].values, from_coordinates['lon'].values,
+                                    to_coordinates['lat'].values, to_coordinates['lon'].values)
+        links['d'] = distances.astype(int)
+        data_columns.append("d")
+    if "distance_shape" in link_attributes:
+        assert "shape_id" in events_df.columns.values
+        # the shape distance is computed along the first event (of each link) that has a shape
+        link_index = dict(zip(zip(links['from_stop_I'].tolist(), links['to_stop_I'].tolist()), range(len(links))))
+        distance_shapes = [None] * len(links)
+        events_with_shape = events_df[events_df['shape_id'].notnull()]
+        first_events = events_with_shape.drop_duplicates(['from_stop_I', 'to_stop_I'])
+        for event in first_events.itertuples():
+            distance_shapes[link_index[(event.from_stop_I, event.to_stop_I)]] = \
+                gtfs.get_shape_distance_between_stops(event.trip_I, int(event.from_seq), int(event.to_seq))
+        links['distance_shape'] = pd.Series(distance_shapes, index=links.index, dtype=object)
+        data_columns.append("distance_shape")
+    if "route_I_counts" in link_attributes:
+        route_I_counts = [dict() for _ in range(len(links))]
+        if len(links) > 0:
+            counts = events_df.groupby(['from_stop_I', 'to_stop_I', 'route_I']).size()
+            link_indices = pd.MultiIndex.from_frame(links[['from_stop_I', 'to_stop_I']]).get_indexer(
+                counts.index.droplevel('route_I'))
+            for link_i, route_I, count in zip(link_indices.tolist(),
+                                              counts.index.get_level_values('route_I').tolist(),
+                                              counts.values.tolist()):
+                route_I_counts[link_i][route_I] = count
+        links['route_I_counts'] = route_I_counts
+        data_columns.append("route_I_counts")
+    if not as_records:
+        return stops_dataframe, links
+    return stops_dataframe, list(zip(links['from_stop_I'].tolist(), links['to_stop_I'].tolist(),
+                                     _records(links, data_columns)))
 
 
 def stop_to_stop_networks_by_type(gtfs):
@@ -192,7 +252,8 @@ def stop_to_stop_networks_by_type(gtfs):
     assert len(route_type_to_network) == len(route_types.ALL_ROUTE_TYPES)
     return route_type_to_network
 
-def combined_stop_to_stop_transit_network(gtfs, start_time_ut=None, end_time_ut=None):
+def combined_stop_to_stop_transit_network(gtfs, start_time_ut=None, end_time_ut=None, return_sparse=False,
+                                          weight=None):
     """
     Compute stop-to-stop networks for all travel modes and combine them into a single network.
     The modes of transport are encoded to a single network.
@@ -202,20 +263,48 @@ def combined_stop_to_stop_transit_network(gtfs, start_time_ut=None, end_time_ut=
     Parameters
     ----------
     gtfs: gtfspy.GTFS
+    return_sparse: bool, optional
+        If True, return a scipy.sparse adjacency matrix instead of a networkx graph.
+        The values of parallel links (of different travel modes) are summed.
+        Requires scipy.
+    weight: str, optional
+        Numeric link attribute stored as the matrix values when return_sparse is True.
+        By default, each link has value 1.
 
     Returns
     -------
     net: networkx.MultiDiGraph
         keys should be one of route_types.TRANSIT_ROUTE_TYPES (i.e. GTFS route_types)
+    or, if return_sparse is True,
+    adjacency: scipy.sparse.csr_matrix
+    stop_I_to_index: dict[int, int]
     """
+    link_attributes = DEFAULT_STOP_TO_STOP_LINK_ATTRIBUTES
+    if return_sparse:
+        link_attributes = [] if weight is None else [weight]
     multi_di_graph = networkx.MultiDiGraph()
+    stop_Is = []
+    link_frames = []
     for route_type in route_types.TRANSIT_ROUTE_TYPES:
-        graph = stop_to_stop_network_for_route_type(gtfs, route_type,
-                                                    start_time_ut=start_time_ut, end_time_ut=end_time_ut)
-        for from_node, to_node, data in graph.edges(data=True):
+        stops_dataframe, links = _stop_to_stop_links(gtfs, route_type, link_attributes,
+                                                     start_time_ut=start_time_ut, end_time_ut=end_time_ut,
+                                                     as_records=not return_sparse)
+        if return_sparse:
+            stop_Is.append(stops_dataframe['stop_I'].values)
+            link_frames.append(links)
+            continue
+        # add the links in the order of their from-stops (as networkx.DiGraph.edges would list them)
+        stop_I_to_position = dict(zip(stops_dataframe['stop_I'].tolist(), range(len(stops_dataframe))))
+        links.sort(key=lambda link: stop_I_to_position[link[0]])
+        for from_node, to_node, data in links:
             data['route_type'] = route_type
-        multi_di_graph.add_edges_from(graph.edges(data=True))
-        multi_di_graph.add_nodes_from(graph.nodes(data=True))
+        multi_di_graph.add_edges_from(links)
+        _add_stops_to_net(multi_di_graph, stops_dataframe)
+    if return_sparse:
+        links = pd.concat(link_frames)
+        values = None if weight is None else links[weight].values
+        return _links_to_sparse_adjacency(pd.unique(numpy.concatenate(stop_Is)), links["from_stop_I"].values,
+                                          links["to_stop_I"].values, values)
     return multi_di_graph
 
 def _add_stops_to_net(net, stops):
@@ -227,13 +316,59 @@ def _add_stops_to_net(net, stops):
     net: networkx.Graph
     stops: pandas.DataFrame
     """
-    for stop in stops.itertuples():
-        data = {
-            "lat": stop.lat,
-            "lon": stop.lon,
-            "name": stop.name
-        }
-        net.add_node(stop.stop_I, **data)
+    net.add_nodes_from(zip(stops['stop_I'].tolist(), _records(stops, ['lat', 'lon', 'name'])))
+
+
+def _records(df, columns):
+    """
+    Rows of the given columns of a pandas.DataFrame as a list of dicts with Python scalar values.
+    """
+    values = [df[column].tolist() for column in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)] if columns else [{} for _ in range(len(df))]
+
+
+def _links_to_sparse_adjacency(stop_Is, from_stop_Is, to_stop_Is, values=None, symmetric=False):
+    """
+    Build a sparse adjacency matrix from a list of links.
+
+    Parameters
+    ----------
+    stop_Is: numpy.ndarray
+        the nodes of the network, in the order of the matrix rows/columns
+    from_stop_Is: numpy.ndarray
+    to_stop_Is: numpy.ndarray
+    values: numpy.ndarray, optional
+        the values of the links, defaults to 1 for each link
+    symmetric: bool, optional
+        if True, the links are considered undirected (as in networkx.Graph): both directions are stored,
+        and of repeated links only the last one is kept
+
+    Returns
+    -------
+    adjacency: scipy.sparse.csr_matrix
+        adjacency[stop_I_to_index[from_stop_I], stop_I_to_index[to_stop_I]] is the value of the link
+    stop_I_to_index: dict[int, int]
+    """
+    from scipy import sparse
+    stop_Is = numpy.asarray(stop_Is)
+    stop_I_to_index = dict(zip(stop_Is.tolist(), range(len(stop_Is))))
+    index_of = pd.Series(numpy.arange(len(stop_Is)), index=stop_Is)
+    rows = index_of.loc[numpy.asarray(from_stop_Is)].values
+    cols = index_of.loc[numpy.asarray(to_stop_Is)].values
+    if values is None:
+        values = numpy.ones(len(rows), dtype=int)
+    values = numpy.asarray(values)
+    if symmetric:
+        lower = numpy.minimum(rows, cols)
+        upper = numpy.maximum(rows, cols)
+        keep = ~pd.DataFrame({'lower': lower, 'upper': upper}).duplicated(keep='last').values
+        lower, upper, values = lower[keep], upper[keep], values[keep]
+        off_diagonal = lower != upper
+        rows = numpy.concatenate([lower, upper[off_diagonal]])
+        cols = numpy.concatenate([upper, lower[off_diagonal]])
+        values = numpy.concatenate([values, values[off_diagonal]])
+    adjacency = sparse.coo_matrix((values, (rows, cols)), shape=(len(stop_Is), len(stop_Is))).tocsr()
+    return adjacency, stop_I_to_index
 
 
 def temporal_network(gtfs,
@@ -264,19 +399,80 @@ def temporal_network(gtfs,
     events_df = gtfs.get_transit_events(start_time_ut=start_time_ut,
                                         end_time_ut=end_time_ut,
                                         route_type=route_type)
-    events_df.drop('to_seq', 1, inplace=True)
-    events_df.drop('shape_id', 1, inplace=True)
-    events_df.drop('duration', 1, inplace=True)
-    events_df.drop('route_id', 1, inplace=True)
-    events_df.rename(
-        columns={
-            'from_seq': "seq"
-        },
-        inplace=True
-    )
+    events_df = _transit_events_to_temporal_network(events_df)
     return events_df
 
 
+def temporal_network_batches(gtfs,
+                             start_time_ut=None,
+                             end_time_ut=None,
+                             route_type=None,
+                             batch_duration=None):
+    """
+    Compute the temporal network of the data in batches of trips, without materializing all events at once.
+
+    The trips (on each day) are split into batches by their start time, so that, taken together, the batches
+    contain the same events as temporal_network(gtfs, start_time_ut, end_time_ut, route_type).
+
+    Parameters
+    ----------
+    gtfs : gtfspy.GTFS
+    start_time_ut: int | None
+        start time of the time span (in unix time)
+    end_time_ut: int | None
+        end time of the time span (in unix time)
+    route_type: int | None
+        see temporal_network
+    batch_duration: int, optional
+        the span of trip start times covered by each batch in seconds, defaults to one day (86400 seconds)
+
+    Yields
+    ------
+    events_df: pandas.DataFrame
+        A non-empty batch of events with the same columns as in temporal_network,
+        ordered by trip_I and departure time within the batch.
+    """
+    if batch_duration is None:
+        batch_duration = 24 * 3600
+    assert batch_duration > 0
+    # the span of start times of the trips that can have events within [start_time_ut, end_time_ut]
+    day_trips_table = gtfs._get_day_trips_table_name()
+    trip_query = "FROM " + day_trips_table + " JOIN trips USING(trip_I) JOIN routes USING(route_I)"
+    where_clauses = []
+    if end_time_ut:
+        where_clauses.append("start_time_ut < {end_time_ut}".format(end_time_ut=end_time_ut))
+    if start_time_ut:
+        where_clauses.append("end_time_ut > {start_time_ut}".format(start_time_ut=start_time_ut))
+    if route_type is not None:
+        where_clauses.append("routes.type = {route_type}".format(route_type=route_type))
+    if where_clauses:
+        trip_query += " WHERE " + " AND ".join(where_clauses)
+    first_trip_start_ut = gtfs.conn.execute("SELECT min(start_time_ut) " + trip_query).fetchone()[0]
+    if first_trip_start_ut is None:
+        return
+    # skip the batches without any trips
+    batch_indices = gtfs.conn.execute(
+        "SELECT DISTINCT (start_time_ut - {first}) / {duration} AS batch_index ".format(
+            first=first_trip_start_ut, duration=int(batch_duration)) + trip_query + " ORDER BY batch_index").fetchall()
+
+    for batch_index, in batch_indices:
+        batch_start = first_trip_start_ut + batch_index * batch_duration
+        events_df = gtfs.get_transit_events(start_time_ut=start_time_ut,
+                                            end_time_ut=end_time_ut,
+                                            route_type=route_type,
+                                            trip_start_time_span=(batch_start, batch_start + batch_duration))
+        if len(events_df) > 0:
+            yield _transit_events_to_temporal_network(events_df)
+
+
+def _transit_events_to_temporal_network(events_df):
+    """
+    Select and rename the columns of gtfs.get_transit_events to those of temporal_network.
+    """
+    events_df = events_df.rename(columns={'from_seq': "seq"})
+    return events_df[TEMPORAL_NETWORK_COLUMNS]
+
+
 def route_to_route_network(gtfs, walking_threshold, start_time, end_time):
     """
     Creates networkx graph where the nodes are bus routes and a edge indicates that there is a possibility to transfer
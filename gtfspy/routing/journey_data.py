@@ -1,11 +1,14 @@
 import os
 import sqlite3
+from multiprocessing import Pool
+
+import numpy
 import pandas as pd
 
 from gtfspy.routing.connection import Connection
 from gtfspy.gtfs import GTFS
 from gtfspy.routing.label import LabelTimeAndRoute, LabelTimeWithBoardingsCount, LabelTimeBoardingsAndRoute, \
-    compute_pareto_front, LabelGeneric
+    LabelGeneric
 from gtfspy.routing.travel_impedance_data_store import TravelImpedanceDataStore
 from gtfspy.routing.fastest_path_analyzer import FastestPathAnalyzer
 from gtfspy.routing.node_profile_analyzer_time_and_veh_legs import NodeProfileAnalyzerTimeAndVehLegs
@@ -21,6 +24,374 @@ def attach_database(conn, other_db_path, name="other"):
 
 _T_WALK_STR = "t_walk"
 
+
+def _fastest_path_mask(from_stop_Is, departure_times, arrival_times, journey_ids):
+    """
+    Vectorized equivalent of computing, for each origin separately, the Pareto front of journeys
+    with respect to departure time and arrival time (compute_pareto_front with ignore_n_boardings=True).
+
+    Parameters
+    ----------
+    from_stop_Is: numpy.ndarray
+    departure_times: numpy.ndarray
+    arrival_times: numpy.ndarray
+    journey_ids: numpy.ndarray
+        used for breaking ties between otherwise identical journeys (smallest journey_id wins)
+
+    Returns
+    -------
+    is_fastest_path: numpy.ndarray
+        boolean mask aligned with the input arrays
+    """
+    n = len(journey_ids)
+    is_fastest_path = numpy.zeros(n, dtype=bool)
+    if n == 0:
+        return is_fastest_path
+    # within each origin: latest departure first, then earliest arrival, then smallest journey_id
+    order = numpy.lexsort((journey_ids, arrival_times, -departure_times, from_stop_Is))
+    sorted_from_stop_Is = from_stop_Is[order]
+    # dense integer ranks of the arrival times keep the comparisons exact also for non-integer times
+    sorted_arrival_times = numpy.unique(arrival_times[order], return_inverse=True)[1].reshape(n).astype(numpy.int64)
+    group_starts = numpy.ones(n, dtype=bool)
+    group_starts[1:] = sorted_from_stop_Is[1:] != sorted_from_stop_Is[:-1]
+    group_index = numpy.cumsum(group_starts) - 1
+    # shift each group below all previous groups so that a single running minimum restarts at group borders
+    span = int(sorted_arrival_times.max() - sorted_arrival_times.min()) + 1
+    shifted = sorted_arrival_times - group_index * span
+    running_min = numpy.minimum.accumulate(shifted)
+    sorted_is_fp = group_starts.copy()
+    sorted_is_fp[1:] |= shifted[1:] < running_min[:-1]
+    is_fastest_path[order] = sorted_is_fp
+    return is_fastest_path
+
+
+JOURNEY_COLUMNS_NO_ROUTE = ("journey_id",
+                            "from_stop_I",
+                            "to_stop_I",
+                            "departure_time",
+                            "arrival_time_target",
+                            "n_boardings")
+
+JOURNEY_COLUMNS_WITH_ROUTE = ("journey_id",
+                              "from_stop_I",
+                              "to_stop_I",
+                              "departure_time",
+                              "arrival_time_target",
+                              "n_boardings",
+                              "movement_duration",
+                              "route")
+
+JOURNEY_COLUMNS_WITH_ROUTE_NO_BOARDINGS = ("journey_id",
+                                           "from_stop_I",
+                                           "to_stop_I",
+                                           "departure_time",
+                                           "arrival_time_target",
+                                           "movement_duration",
+                                           "route")
+
+LEG_COLUMNS = ("journey_id",
+               "from_stop_I",
+               "to_stop_I",
+               "departure_time",
+               "arrival_time_target",
+               "trip_I",
+               "seq",
+               "leg_stops")
+
+
+def _insert_stmt(table, columns):
+    return "INSERT INTO " + table + "(" + ", ".join(columns) + ") VALUES (" + ", ".join("?" for _ in columns) + ")"
+
+
+def _offset_journey_ids(rows, offset):
+    return [(row[0] + offset,) + tuple(row[1:]) for row in rows]
+
+
+JOURNEYS_VERSION_KEY = "journeys_version"
+
+
+def bump_journeys_version(conn):
+    """
+    Increment the counter of in-place updates of the journeys table, stored in the parameters table
+    (does not commit). Used by JourneyDataAnalyzer for invalidating its cached query results.
+    """
+    conn.execute("INSERT OR REPLACE INTO parameters('key', 'value') "
+                 "VALUES (?, COALESCE((SELECT CAST(value AS INT) FROM parameters WHERE key=?), 0) + 1)",
+                 (JOURNEYS_VERSION_KEY, JOURNEYS_VERSION_KEY))
+
+
+def collect_journey_rows(target_stop_I, origin_stop_I_to_journey_labels, track_route=False, multitarget_routing=False):
+    """
+    Convert journey labels into rows of the journeys (and legs) tables.
+
+    Parameters
+    ----------
+    target_stop_I: int
+    origin_stop_I_to_journey_labels: dict
+        key: origin_stop_Is
+        value: list of labels
+    track_route: bool
+    multitarget_routing: bool
+
+    Returns
+    -------
+    journey_columns: tuple[str]
+    journey_rows: list[list]
+        journey ids run from 1 upwards, and need to be offset when written to the database
+    leg_rows: list[tuple] or None
+        None when routes are not tracked
+    """
+    if track_route:
+        return _collect_journey_rows_with_route(origin_stop_I_to_journey_labels)
+    journey_id = 1
+    journey_list = []
+    for origin_stop, labels in origin_stop_I_to_journey_labels.items():
+        for label in labels:
+            assert (isinstance(label, LabelTimeWithBoardingsCount))
+            if multitarget_routing:
+                target_stop = None
+            else:
+                target_stop = int(target_stop_I)
+
+            values = [int(journey_id),
+                      int(origin_stop),
+                      target_stop,
+                      int(label.departure_time),
+                      int(label.arrival_time_target),
+                      int(label.n_boardings)]
+
+            journey_list.append(values)
+            journey_id += 1
+    return JOURNEY_COLUMNS_NO_ROUTE, journey_list, None
+
+
+def _collect_journey_rows_with_route(stop_I_to_journey_labels):
+    journey_id = 1
+    journey_list = []
+    connection_list = []
+    journey_columns = JOURNEY_COLUMNS_WITH_ROUTE_NO_BOARDINGS
+    for origin_stop, labels in stop_I_to_journey_labels.items():
+        assert (isinstance(stop_I_to_journey_labels[origin_stop], list))
+
+        for label in labels:
+            assert (isinstance(label, LabelTimeAndRoute) or isinstance(label, LabelTimeBoardingsAndRoute))
+            # We need to "unpack" the journey to actually figure out where the trip went
+            # (there can be several targets).
+            if label.departure_time == label.arrival_time_target:
+                continue
+
+            target_stop, new_connection_values, route_stops = _collect_connection_data(journey_id, label)
+            if origin_stop == target_stop:
+                continue
+
+            if isinstance(label, LabelTimeBoardingsAndRoute):
+                journey_columns = JOURNEY_COLUMNS_WITH_ROUTE
+                values = [int(journey_id),
+                          int(origin_stop),
+                          int(target_stop),
+                          int(label.departure_time),
+                          int(label.arrival_time_target),
+                          label.n_boardings,
+                          label.movement_duration,
+                          route_stops]
+            else:
+                values = [int(journey_id),
+                          int(origin_stop),
+                          int(target_stop),
+                          int(label.departure_time),
+                          int(label.arrival_time_target),
+                          label.movement_duration,
+                          route_stops]
+
+            journey_list.append(values)
+            connection_list += new_connection_values
+            journey_id += 1
+    return journey_columns, journey_list, connection_list
+
+
+def _collect_connection_data(journey_id, label):
+    target_stop = None
+    cur_label = label
+    seq = 1
+    value_list = []
+    route_stops = []
+    leg_stops = []
+    prev_trip_id = None
+    connection = None
+    leg_departure_time = None
+    leg_departure_stop = None
+    leg_arrival_time = None
+    leg_arrival_stop = None
+    while True:
+        if isinstance(cur_label.connection, Connection):
+            connection = cur_label.connection
+            if connection.trip_id:
+                trip_id = connection.trip_id
+            else:
+                trip_id = -1
+
+            # In case of new leg
+            if prev_trip_id != trip_id:
+                route_stops.append(connection.departure_stop)
+                if prev_trip_id:
+                    leg_stops.append(connection.departure_stop)
+
+                    values = (
+                        int(journey_id),
+                        int(leg_departure_stop),
+                        int(leg_arrival_stop),
+                        int(leg_departure_time),
+                        int(leg_arrival_time),
+                        int(prev_trip_id),
+                        int(seq),
+                        ','.join([str(x) for x in leg_stops])
+                            )
+                    value_list.append(values)
+                    seq += 1
+                    leg_stops = []
+
+                leg_departure_stop = connection.departure_stop
+                leg_departure_time = connection.departure_time
+            leg_arrival_time = connection.arrival_time
+            leg_arrival_stop = connection.arrival_stop
+            leg_stops.append(connection.departure_stop)
+            target_stop = connection.arrival_stop
+            prev_trip_id = trip_id
+
+        if not cur_label.previous_label:
+            leg_stops.append(connection.arrival_stop)
+            values = (
+                int(journey_id),
+                int(leg_departure_stop),
+                int(leg_arrival_stop),
+                int(leg_departure_time),
+                int(leg_arrival_time),
+                int(prev_trip_id),
+                int(seq),
+                ','.join([str(x) for x in leg_stops])
+            )
+            value_list.append(values)
+            break
+
+        cur_label = cur_label.previous_label
+    route_stops.append(target_stop)
+    route_stops = ','.join([str(x) for x in route_stops])
+    return target_stop, value_list, route_stops
+
+
+def _iter_travel_impedance_rows(conn, table, to_stop_I_range=None, chunk_size=100000):
+    """
+    Yield (sort_key, (from_stop_I, to_stop_I), (min, max, median, mean)) of a travel impedance table,
+    ordered by sort_key and reading chunk_size rows at a time.
+    The sort_key is (from_stop_I, to_stop_I), or (to_stop_I, from_stop_I) when a (first, last) to_stop_I_range
+    is given.
+    """
+    cur = conn.cursor()
+    if to_stop_I_range is None:
+        cur.execute("SELECT from_stop_I, to_stop_I, min, max, median, mean FROM " + table +
+                    " ORDER BY from_stop_I, to_stop_I")
+    else:
+        cur.execute("SELECT to_stop_I, from_stop_I, min, max, median, mean FROM " + table +
+                    " WHERE to_stop_I BETWEEN ? AND ? ORDER BY to_stop_I, from_stop_I",
+                    [int(x) for x in to_stop_I_range])
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            sort_key = row[:2]
+            od_pair = sort_key if to_stop_I_range is None else (row[1], row[0])
+            yield sort_key, od_pair, row[2:]
+
+
+def _merge_join_sorted_rows(after_rows, before_rows):
+    """
+    Merge-join two iterators produced by _iter_travel_impedance_rows with the same sort order.
+    Sort keys are assumed to be unique within each iterator.
+
+    Yields
+    ------
+    (od_pair, after_values, before_values): tuple
+    """
+    sentinel = object()
+    before = next(before_rows, sentinel)
+    for after in after_rows:
+        while before is not sentinel and before[0] < after[0]:
+            before = next(before_rows, sentinel)
+        if before is sentinel:
+            return
+        if before[0] == after[0]:
+            yield after[1], after[2], before[2]
+
+
+def _compute_diff_rows(matched):
+    """
+    Compute absolute and relative differences (after - before) for merge-joined travel impedance rows.
+
+    Returns
+    -------
+    diff_rows: list[tuple]
+        (from_stop_I, to_stop_I, diff_min, diff_max, diff_median, diff_mean,
+         rel_diff_min, rel_diff_max, rel_diff_median, rel_diff_mean)
+    """
+    if not matched:
+        return []
+    keys = [x[0] for x in matched]
+    after = numpy.array([x[1] for x in matched], dtype=float)
+    before = numpy.array([x[2] for x in matched], dtype=float)
+    diff = after - before
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        rel_diff = diff / before
+    values = numpy.hstack([diff, rel_diff]).astype(object)
+    values[~numpy.isfinite(numpy.hstack([diff, rel_diff]))] = None
+    return [key + tuple(row) for key, row in zip(keys, values.tolist())]
+
+
+def _insert_diff_rows(conn, table, diff_rows):
+    if not diff_rows:
+        return
+    conn.executemany("INSERT OR REPLACE INTO diff_" + table +
+                     " (from_stop_I, to_stop_I, diff_min, diff_max, diff_median, diff_mean, "
+                     "rel_diff_min, rel_diff_max, rel_diff_median, rel_diff_mean) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", diff_rows)
+
+
+def _write_diff_rows_for_partition(args):
+    """
+    Compare the od-pairs of one to_stop_I range, and write the differences to the diff database
+    in transactions of chunk_size rows.
+
+    Returns
+    -------
+    n_rows: int
+        number of diff rows written
+    """
+    table, before_db_path, after_db_path, diff_db_path, to_stop_I_range, chunk_size, timeout = args
+    before_conn = sqlite3.connect(before_db_path)
+    after_conn = sqlite3.connect(after_db_path)
+    diff_conn = sqlite3.connect(diff_db_path, timeout)
+    n_rows = 0
+    try:
+        matched = _merge_join_sorted_rows(
+            _iter_travel_impedance_rows(after_conn, table, to_stop_I_range, chunk_size),
+            _iter_travel_impedance_rows(before_conn, table, to_stop_I_range, chunk_size))
+        batch = []
+        for pair in matched:
+            batch.append(pair)
+            if len(batch) >= chunk_size:
+                _insert_diff_rows(diff_conn, table, _compute_diff_rows(batch))
+                diff_conn.commit()
+                n_rows += len(batch)
+                batch = []
+        _insert_diff_rows(diff_conn, table, _compute_diff_rows(batch))
+        diff_conn.commit()
+        return n_rows + len(batch)
+    finally:
+        before_conn.close()
+        after_conn.close()
+        diff_conn.close()
+
+
 class JourneyDataManager:
 
     def __init__(self, gtfs_path, journey_db_path, routing_params=None, multitarget_routing=False,
@@ -51,6 +422,7 @@ class JourneyDataManager:
 
         # insert a pretty robust timeout:
         timeout = 1000
+        self.journey_db_path = journey_db_path
         self.conn = sqlite3.connect(journey_db_path, timeout)
         if not journey_db_pre_exists:
             self.initialize_database()
@@ -93,12 +465,46 @@ class JourneyDataManager:
         # if not enforce_synchronous_writes:
         cur.execute('PRAGMA synchronous = 0;')
 
+        journey_columns, journey_rows, leg_rows = self.collect_journey_rows(target_stop_I,
+                                                                            origin_stop_I_to_journey_labels)
+        if journey_rows:
+            if self.track_route:
+                print("Inserting journeys and legs into database")
+            else:
+                print("Inserting journeys without route into database")
+            self._insert_journey_rows_exclusive(journey_columns, journey_rows, leg_rows)
+            if self.track_route:
+                self.routing_parameters["target_list"] += (str(int(target_stop_I)) + ",")
+        print("Finished import process")
+        self.conn.commit()
+
+    def collect_journey_rows(self, target_stop_I, origin_stop_I_to_journey_labels):
+        """
+        Convert journey labels into rows of the journeys (and legs) tables.
+        Journey ids of the returned rows run from 1 upwards, and are offset when the rows are written.
+
+        Returns
+        -------
+        journey_columns: tuple[str]
+        journey_rows: list[list]
+        leg_rows: list[tuple] or None
+            None when routes are not tracked
+        """
         if self.track_route:
-            self._insert_journeys_with_route_into_db(origin_stop_I_to_journey_labels, target_stop=int(target_stop_I))
+            print("Collecting journey and connection data")
         else:
-            self._insert_journeys_into_db_no_route(origin_stop_I_to_journey_labels, target_stop=int(target_stop_I))
-        print("Finished import process")
+            print("Collecting journey data")
+        return collect_journey_rows(target_stop_I, origin_stop_I_to_journey_labels,
+                                    track_route=self.track_route,
+                                    multitarget_routing=self.multitarget_routing)
+
+    def get_journey_data_writer(self, **kwargs):
+        """
+        Get a JourneyDataWriter for this journey database, see gtfspy.routing.journey_data_writer.
+        """
+        from gtfspy.routing.journey_data_writer import JourneyDataWriter
         self.conn.commit()
+        return JourneyDataWriter(self.journey_db_path, **kwargs)
 
     def _assert_journey_computation_paramaters_match(self):
         for key, value in self.routing_parameters.items():
@@ -110,213 +516,22 @@ class JourneyDataManager:
         val = cur.execute("select max(journey_id) FROM journeys").fetchone()
         return val[0] if val[0] else 0
 
-    def _insert_journeys_into_db_no_route(self, stop_profiles, target_stop=None):
-        # TODO: Change the insertion so that the check last journey id and insertions are in the same transaction block
-        """
-        con.isolation_level = 'EXCLUSIVE'
-        con.execute('BEGIN EXCLUSIVE')
-        #exclusive access starts here. Nothing else can r/w the db, do your magic here.
-        con.commit()
-        """
-        print("Collecting journey data")
-        journey_id = 1
-        journey_list = []
-        tot = len(stop_profiles)
-        for i, (origin_stop, labels) in enumerate(stop_profiles.items(), start=1):
-            #print("\r Stop " + str(i) + " of " + str(tot), end='', flush=True)
-            for label in labels:
-                assert (isinstance(label, LabelTimeWithBoardingsCount))
-                if self.multitarget_routing:
-                    target_stop = None
-                else:
-                    target_stop = int(target_stop)
-
-                values = [int(journey_id),
-                          int(origin_stop),
-                          target_stop,
-                          int(label.departure_time),
-                          int(label.arrival_time_target),
-                          int(label.n_boardings)]
-
-                journey_list.append(values)
-                journey_id += 1
-        print("Inserting journeys without route into database")
-        insert_journeys_stmt = '''INSERT INTO journeys(
-              journey_id,
-              from_stop_I,
-              to_stop_I,
-              departure_time,
-              arrival_time_target,
-              n_boardings) VALUES (%s) ''' % (", ".join(["?" for x in range(6)]))
-        #self.conn.executemany(insert_journeys_stmt, journey_list)
-        self._executemany_exclusive(insert_journeys_stmt, journey_list)
-        self.conn.commit()
-
     @timeit
-    def _executemany_exclusive(self, statement, rows):
+    def _insert_journey_rows_exclusive(self, journey_columns, journey_rows, leg_rows=None):
+        # checking the last journey id and inserting happen in the same exclusive transaction
         self.conn.execute('BEGIN EXCLUSIVE')
-        last_id = self._get_largest_journey_id()
-        rows = [[x[0] + last_id] + x[1:] for x in rows]
-        self.conn.executemany(statement, rows)
-
-    def _insert_journeys_with_route_into_db(self, stop_I_to_journey_labels, target_stop):
-        print("Collecting journey and connection data")
-        journey_id = (self._get_largest_journey_id() if self._get_largest_journey_id() else 0) + 1
-        journey_list = []
-        connection_list = []
-        label = None
-        for i, (origin_stop, labels) in enumerate(stop_I_to_journey_labels.items(), start=1):
-            # tot = len(stop_profiles)
-            #print("\r Stop " + str(i) + " of " + str(tot), end='', flush=True)
-
-            assert (isinstance(stop_I_to_journey_labels[origin_stop], list))
-
-            for label in labels:
-                assert (isinstance(label, LabelTimeAndRoute) or isinstance(label, LabelTimeBoardingsAndRoute))
-                # We need to "unpack" the journey to actually figure out where the trip went
-                # (there can be several targets).
-                if label.departure_time == label.arrival_time_target:
-                    print("Weird label:", label)
-                    continue
-
-                target_stop, new_connection_values, route_stops = self._collect_connection_data(journey_id, label)
-                if origin_stop == target_stop:
-                    continue
-
-                if isinstance(label, LabelTimeBoardingsAndRoute):
-                    values = [int(journey_id),
-                              int(origin_stop),
-                              int(target_stop),
-                              int(label.departure_time),
-                              int(label.arrival_time_target),
-                              label.n_boardings,
-                              label.movement_duration,
-                              route_stops]
-                else:
-                    values = [int(journey_id),
-                              int(origin_stop),
-                              int(target_stop),
-                              int(label.departure_time),
-                              int(label.arrival_time_target),
-                              label.movement_duration,
-                              route_stops]
-
-                journey_list.append(values)
-                connection_list += new_connection_values
-                journey_id += 1
-
-        print("Inserting journeys into database")
-        if label:
-            if isinstance(label, LabelTimeBoardingsAndRoute):
-                insert_journeys_stmt = '''INSERT INTO journeys(
-                      journey_id,
-                      from_stop_I,
-                      to_stop_I,
-                      departure_time,
-                      arrival_time_target,
-                      n_boardings,
-                      movement_duration,
-                      route) VALUES (%s) ''' % (", ".join(["?" for x in range(8)]))
-            else:
-                insert_journeys_stmt = '''INSERT INTO journeys(
-                      journey_id,
-                      from_stop_I,
-                      to_stop_I,
-                      departure_time,
-                      arrival_time_target,
-                      movement_duration,
-                      route) VALUES (%s) ''' % (", ".join(["?" for x in range(7)]))
-            self.conn.executemany(insert_journeys_stmt, journey_list)
-
-            print("Inserting legs into database")
-            insert_legs_stmt = '''INSERT INTO legs(
-                                  journey_id,
-                                  from_stop_I,
-                                  to_stop_I,
-                                  departure_time,
-                                  arrival_time_target,
-                                  trip_I,
-                                  seq,
-                                  leg_stops) VALUES (%s) ''' % (", ".join(["?" for x in range(8)]))
-            self.conn.executemany(insert_legs_stmt, connection_list)
-            self.routing_parameters["target_list"] += (str(target_stop) + ",")
-            self.conn.commit()
-
+        offset = self._get_largest_journey_id()
+        self.conn.executemany(_insert_stmt("journeys", journey_columns),
+                              _offset_journey_ids(journey_rows, offset))
+        if leg_rows:
+            self.conn.executemany(_insert_stmt("legs", LEG_COLUMNS), _offset_journey_ids(leg_rows, offset))
+        self.conn.commit()
 
     def create_index_for_journeys_table(self):
         self.conn.execute("PRAGMA temp_store=2")
         self.conn.commit()
         self.conn.execute("CREATE INDEX IF NOT EXISTS journeys_to_stop_I_idx ON journeys (to_stop_I)")
 
-    def _collect_connection_data(self, journey_id, label):
-        target_stop = None
-        cur_label = label
-        seq = 1
-        value_list = []
-        route_stops = []
-        leg_stops = []
-        prev_trip_id = None
-        connection = None
-        leg_departure_time = None
-        leg_departure_stop = None
-        leg_arrival_time = None
-        leg_arrival_stop = None
-        while True:
-            if isinstance(cur_label.connection, Connection):
-                connection = cur_label.connection
-                if connection.trip_id:
-                    trip_id = connection.trip_id
-                else:
-                    trip_id = -1
-
-                # In case of new leg
-                if prev_trip_id != trip_id:
-                    route_stops.append(connection.departure_stop)
-                    if prev_trip_id:
-                        leg_stops.append(connection.departure_stop)
-
-                        values = (
-                            int(journey_id),
-                            int(leg_departure_stop),
-                            int(leg_arrival_stop),
-                            int(leg_departure_time),
-                            int(leg_arrival_time),
-                            int(prev_trip_id),
-                            int(seq),
-                            ','.join([str(x) for x in leg_stops])
-                                )
-                        value_list.append(values)
-                        seq += 1
-                        leg_stops = []
-
-                    leg_departure_stop = connection.departure_stop
-                    leg_departure_time = connection.departure_time
-                leg_arrival_time = connection.arrival_time
-                leg_arrival_stop = connection.arrival_stop
-                leg_stops.append(connection.departure_stop)
-                target_stop = connection.arrival_stop
-                prev_trip_id = trip_id
-
-            if not cur_label.previous_label:
-                leg_stops.append(connection.arrival_stop)
-                values = (
-                    int(journey_id),
-                    int(leg_departure_stop),
-                    int(leg_arrival_stop),
-                    int(leg_departure_time),
-                    int(leg_arrival_time),
-                    int(prev_trip_id),
-                    int(seq),
-                    ','.join([str(x) for x in leg_stops])
-                )
-                value_list.append(values)
-                break
-
-            cur_label = cur_label.previous_label
-        route_stops.append(target_stop)
-        route_stops = ','.join([str(x) for x in route_stops])
-        return target_stop, value_list, route_stops
-
     def populate_additional_journey_columns(self):
         self.add_fastest_path_column()
         self.add_time_to_prev_journey_fp_column()
@@ -357,52 +572,82 @@ class JourneyDataManager:
     @timeit
     def add_fastest_path_column(self):
         print("adding fastest path column")
-        cur = self.conn.cursor()
         for target in self.get_targets_having_journeys():
-            fastest_path_journey_ids = []
-            for origin in self.get_origins_having_journeys():
-                cur.execute('SELECT departure_time, arrival_time_target, journey_id FROM journeys '
-                            'WHERE from_stop_I = ? AND to_stop_I = ? '
-                            'ORDER BY departure_time ASC', (origin, target))
-                all_trips = cur.fetchall()
-                all_labels = [LabelTimeAndRoute(x[0], x[1], x[2], False) for x in all_trips] #putting journey_id as movement_duration
-                all_fp_labels = compute_pareto_front(all_labels, finalization=False, ignore_n_boardings=True)
-                fastest_path_journey_ids.append(all_fp_labels)
-
-            fastest_path_journey_ids = [(1, x.movement_duration) for sublist in fastest_path_journey_ids for x in sublist]
-            cur.executemany("UPDATE journeys SET fastest_path = ? WHERE journey_id = ?", fastest_path_journey_ids)
+            journey_ids, from_stop_Is, departure_times, arrival_times = \
+                self._get_journey_arrays_for_target(target, "from_stop_I, departure_time, arrival_time_target")
+            fp_mask = _fastest_path_mask(from_stop_Is, departure_times, arrival_times, journey_ids)
+            fp_journey_ids = journey_ids[fp_mask]
+            self._update_journeys_through_temp_table("fastest_path",
+                                                     fp_journey_ids,
+                                                     numpy.ones(len(fp_journey_ids), dtype=numpy.int64))
+        bump_journeys_version(self.conn)
         self.conn.commit()
 
     @timeit
     def add_time_to_prev_journey_fp_column(self):
         print("adding pre journey waiting time")
-        cur = self.conn.cursor()
         for target in self.get_targets_having_journeys():
-
-            cur.execute('SELECT journey_id, from_stop_I, to_stop_I, departure_time FROM journeys '
-                        'WHERE fastest_path = 1 AND to_stop_I = ? '
-                        'ORDER BY from_stop_I, to_stop_I, departure_time ', (target,))
-
-            all_trips = cur.fetchall()
-            time_to_prev_journey = []
-            prev_departure_time = None
-            prev_origin = None
-            prev_destination = None
-            for trip in all_trips:
-                journey_id = trip[0]
-                from_stop_I = trip[1]
-                to_stop_I = trip[2]
-                departure_time = trip[3]
-                if prev_origin != from_stop_I or prev_destination != to_stop_I:
-                    prev_departure_time = None
-                if prev_departure_time:
-                    time_to_prev_journey.append((departure_time - prev_departure_time, journey_id))
-                prev_origin = from_stop_I
-                prev_destination = to_stop_I
-                prev_departure_time = departure_time
-            cur.executemany("UPDATE journeys SET pre_journey_wait_fp = ? WHERE journey_id = ?", time_to_prev_journey)
+            journey_ids, from_stop_Is, departure_times = \
+                self._get_journey_arrays_for_target(target, "from_stop_I, departure_time", "fastest_path = 1")
+            order = numpy.lexsort((departure_times, from_stop_Is))
+            journey_ids = journey_ids[order]
+            from_stop_Is = from_stop_Is[order]
+            departure_times = departure_times[order]
+            # a journey has a previous journey only if the preceding row belongs to the same origin:
+            has_prev = numpy.zeros(len(journey_ids), dtype=bool)
+            has_prev[1:] = from_stop_Is[1:] == from_stop_Is[:-1]
+            time_to_prev_journey = numpy.zeros(len(journey_ids), dtype=departure_times.dtype)
+            time_to_prev_journey[1:] = departure_times[1:] - departure_times[:-1]
+            self._update_journeys_through_temp_table("pre_journey_wait_fp",
+                                                     journey_ids[has_prev],
+                                                     time_to_prev_journey[has_prev])
+        bump_journeys_version(self.conn)
         self.conn.commit()
 
+    def _get_journey_arrays_for_target(self, target, columns, condition=None):
+        """
+        Fetch journey_id and the given numeric columns of the journeys to one target as numpy arrays.
+        Journeys having NULL in any of the columns are left out.
+
+        Parameters
+        ----------
+        target: int
+        columns: str
+            comma-separated list of journeys columns
+        condition: str, optional
+            additional SQL condition for selecting the journeys
+
+        Returns
+        -------
+        arrays: list[numpy.ndarray]
+            journey_id (int) array followed by one (float) array for each of the columns
+        """
+        column_names = [column.strip() for column in columns.split(",")]
+        sql = "SELECT journey_id, " + columns + " FROM journeys WHERE to_stop_I = ?"
+        for column in column_names:
+            sql += " AND " + column + " IS NOT NULL"
+        if condition:
+            sql += " AND " + condition
+        rows = self.conn.execute(sql, (int(target),)).fetchall()
+        n_columns = len(column_names) + 1
+        data = numpy.array(rows, dtype=float).reshape(len(rows), n_columns)
+        return [data[:, 0].astype(numpy.int64)] + [data[:, i] for i in range(1, n_columns)]
+
+    def _update_journeys_through_temp_table(self, column, journey_ids, values):
+        """
+        Set journeys.column to values for the given journey_ids using a single joined UPDATE.
+        """
+        cur = self.conn.cursor()
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS journey_updates (journey_id INTEGER PRIMARY KEY, value INT)")
+        cur.execute("DELETE FROM journey_updates")
+        # integral floats are stored as integers (INT affinity of value)
+        cur.executemany("INSERT INTO journey_updates (journey_id, value) VALUES (?, ?)",
+                        zip(journey_ids.tolist(), values.tolist()))
+        cur.execute("UPDATE journeys SET " + column + " = "
+                    "(SELECT value FROM journey_updates WHERE journey_updates.journey_id = journeys.journey_id) "
+                    "WHERE journey_id IN (SELECT journey_id FROM journey_updates)")
+        cur.execute("DELETE FROM journey_updates")
+
     @timeit
     def compute_journey_time_components(self):
         print("adding journey components")
@@ -422,6 +667,7 @@ class JourneyDataManager:
                         "WHERE journeys.journey_id = legs.journey_id AND trip_I < 0 GROUP BY journey_id)")
             cur.execute("UPDATE journeys "
                         "SET transfer_wait_duration = journey_duration - in_vehicle_duration - walking_duration")
+        bump_journeys_version(self.conn)
         self.conn.commit()
 
     def _journey_label_generator(self, destination_stop_Is=None, origin_stop_Is=None):
@@ -635,6 +881,7 @@ class JourneyDataManager:
 
         sql = "UPDATE journeys SET %s = ? WHERE journey_id = ?" % (attribute,)
         cur.executemany(sql, insert_tuples)
+        bump_journeys_version(self.conn)
         self.conn.commit()
 
     def _insert_travel_impedance_data_to_db(self, travel_impedance_measure_name, data):
@@ -819,6 +1066,7 @@ class JourneyDataManager:
 
 class DiffDataManager:
     def __init__(self, diff_db_path):
+        self.diff_db_path = diff_db_path
         self.conn = sqlite3.connect(diff_db_path)
 
     def initialize_journey_comparison_tables(self, tables, before_db_tuple, after_db_tuple):
@@ -831,10 +1079,7 @@ class DiffDataManager:
         self.conn = self.attach_database(after_db_path, name=after_db_name)
 
         for table in tables:
-            self.conn.execute("CREATE TABLE IF NOT EXISTS diff_" + table +
-                              "(from_stop_I INT, to_stop_I INT, "
-                              "diff_min INT, diff_max INT, diff_median INT, diff_mean INT, "
-                              "rel_diff_min REAL, rel_diff_max REAL, rel_diff_median REAL, rel_diff_mean REAL)")
+            self._create_diff_table(table)
             insert_stmt = "INSERT OR REPLACE INTO diff_" + table + \
                           " (from_stop_I, to_stop_I, diff_min, diff_max, diff_median, diff_mean, " \
                           "rel_diff_min, rel_diff_max, rel_diff_median, rel_diff_mean) " \
@@ -855,6 +1100,93 @@ class DiffDataManager:
             self.conn.execute(insert_stmt)
             self.conn.commit()
 
+    @timeit
+    def initialize_journey_comparison_tables_streaming(self, tables, before_db_path, after_db_path,
+                                                       chunk_size=100000):
+        """
+        Same as initialize_journey_comparison_tables, but the tables of the two databases are read in
+        (from_stop_I, to_stop_I) order through separate cursors and merge-joined in chunks, so that memory use
+        and temporary storage stay constant.
+
+        Parameters
+        ----------
+        tables: list[str]
+        before_db_path: str
+        after_db_path: str
+        chunk_size: int
+            number of rows read and written at a time
+        """
+        before_conn = sqlite3.connect(before_db_path)
+        after_conn = sqlite3.connect(after_db_path)
+        try:
+            for table in tables:
+                self._create_diff_table(table)
+                matched = _merge_join_sorted_rows(
+                    _iter_travel_impedance_rows(after_conn, table, chunk_size=chunk_size),
+                    _iter_travel_impedance_rows(before_conn, table, chunk_size=chunk_size))
+                batch = []
+                for pair in matched:
+                    batch.append(pair)
+                    if len(batch) >= chunk_size:
+                        self._insert_diff_rows(table, _compute_diff_rows(batch))
+                        batch = []
+                self._insert_diff_rows(table, _compute_diff_rows(batch))
+                self.conn.commit()
+        finally:
+            before_conn.close()
+            after_conn.close()
+
+    @timeit
+    def initialize_journey_comparison_tables_parallel(self, tables, before_db_path, after_db_path,
+                                                      n_processes=None, n_partitions=None, chunk_size=100000,
+                                                      timeout=1000):
+        """
+        Parallel variant of initialize_journey_comparison_tables_streaming.
+        The od-pairs are partitioned into to_stop_I ranges, and each range is compared in a worker process,
+        which writes its results to the diff database in transactions of chunk_size rows.
+
+        Parameters
+        ----------
+        tables: list[str]
+        before_db_path: str
+        after_db_path: str
+        n_processes: int, optional
+            number of worker processes, by default the number of CPUs
+        n_partitions: int, optional
+            number of to_stop_I partitions per table, by default 4 * n_processes
+        chunk_size: int
+        timeout: float
+            sqlite3 connection timeout of the workers, which take turns in writing to the diff database
+        """
+        n_processes = n_processes or os.cpu_count()
+        if n_partitions is None:
+            n_partitions = 4 * n_processes
+        for table in tables:
+            self._create_diff_table(table)
+        self.conn.commit()
+        with Pool(n_processes) as pool:
+            after_conn = sqlite3.connect(after_db_path)
+            try:
+                for table in tables:
+                    to_stop_Is = [x[0] for x in after_conn.execute(
+                        "SELECT DISTINCT to_stop_I FROM " + table + " ORDER BY to_stop_I")]
+                    partitions = [p for p in numpy.array_split(to_stop_Is, n_partitions) if len(p) > 0]
+                    args = [(table, before_db_path, after_db_path, self.diff_db_path,
+                             (partition[0], partition[-1]), chunk_size, timeout) for partition in partitions]
+                    for _ in pool.imap_unordered(_write_diff_rows_for_partition, args):
+                        pass
+            finally:
+                after_conn.close()
+
+    def _create_diff_table(self, table):
+        self.conn.execute("CREATE TABLE IF NOT EXISTS diff_" + table +
+                          "(from_stop_I INT, to_stop_I INT, "
+                          "diff_min INT, diff_max INT, diff_median INT, diff_mean INT, "
+                          "rel_diff_min REAL, rel_diff_max REAL, rel_diff_median REAL, rel_diff_mean REAL)")
+
+    def _insert_diff_rows(self, table, diff_rows):
+        _insert_diff_rows(self.conn, table, diff_rows)
+
     def attach_database(self, other_db_path, name="other"):
         cur = self.conn.cursor()
         cur.execute("ATTACH '%s' AS '%s'" % (str(other_db_path), name))
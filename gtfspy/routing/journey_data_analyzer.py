@@ -1,11 +1,38 @@
+import functools
 import os
 import sqlite3
-import numpy as np
 
-from pandas import read_sql_query, DataFrame, Series
+from pandas import read_sql_query, DataFrame
 from gtfspy.gtfs import GTFS
 from gtfspy.util import timeit
-from gtfspy.routing.journey_data import attach_database
+from gtfspy.routing.journey_data import attach_database, Parameters, JOURNEYS_VERSION_KEY
+
+LEG_SECTIONS_TABLE = "leg_sections"
+LEG_SECTIONS_SIGNATURE_KEY = "leg_sections_legs_signature"
+
+
+def memoized_query(method):
+    """
+    Cache the results of a JourneyDataAnalyzer query method, keyed by the query parameters.
+    DataFrames are copied on the way out so that callers can not modify the cached results.
+    Calls with unhashable parameters (e.g. lists) are not cached.
+    The cache is cleared when the journey data has changed (see JourneyDataAnalyzer._get_data_signature).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._clear_cache_if_data_changed()
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return method(self, *args, **kwargs)
+        if key not in self._query_cache:
+            self._query_cache[key] = method(self, *args, **kwargs)
+        result = self._query_cache[key]
+        if isinstance(result, DataFrame):
+            return result.copy()
+        return result
+    return wrapper
 
 
 class JourneyDataAnalyzer:
@@ -19,10 +46,110 @@ class JourneyDataAnalyzer:
         self.g = GTFS(gtfs_path)
         self.gtfs_path = gtfs_path
         self.conn = attach_database(self.conn, self.gtfs_path)
+        self._query_cache = {}
+        self._cache_changes = None
+        self._cache_data_signature = None
+        self._attached_diff_path = None
 
     def __del__(self):
         self.conn.close()
 
+    def clear_cache(self):
+        """
+        Forget all memoized query results (call after modifying the journey database).
+        """
+        self._query_cache = {}
+
+    def _clear_cache_if_data_changed(self):
+        # Nothing has been written to the database if neither this connection nor any other connection
+        # has modified it since the last check, and the (more expensive) signature needs not to be computed.
+        changes = (self.conn.execute("PRAGMA data_version").fetchone()[0], self.conn.total_changes)
+        if changes == self._cache_changes:
+            return
+        data_signature = self._get_data_signature()
+        if data_signature != self._cache_data_signature:
+            self.clear_cache()
+            self._cache_data_signature = data_signature
+        self._cache_changes = changes
+
+    def _get_data_signature(self):
+        """
+        Signature of the legs and journeys tables: the signature of the legs (see _get_legs_signature),
+        the number of rows and largest rowid of the journeys and the number of in-place updates of the journeys
+        (see journey_data.bump_journeys_version).
+        """
+        n_journeys, max_rowid = self.conn.execute("SELECT count(*), max(rowid) FROM journeys").fetchone()
+        return "%s;%d,%d;%s" % (self._get_legs_signature(), n_journeys, max_rowid if max_rowid is not None else 0,
+                                Parameters(self.conn).get(JOURNEYS_VERSION_KEY))
+
+    def has_leg_sections_table(self):
+        return self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                 (LEG_SECTIONS_TABLE,)).fetchone() is not None
+
+    def _get_legs_signature(self):
+        """
+        Number of rows and largest rowid of the legs table, used to detect changes of the legs.
+        """
+        n_legs, max_rowid = self.conn.execute("SELECT count(*), max(rowid) FROM legs").fetchone()
+        return "%d,%d" % (n_legs, max_rowid if max_rowid is not None else 0)
+
+    @timeit
+    def materialize_leg_sections(self, force=False, chunk_size=100000):
+        """
+        Store the stop-to-stop sections of all legs in the table leg_sections of the journey database.
+        The table has one row for each consecutive stop pair of each leg:
+            journey_id, target_stop_I (destination of the journey), trip_I, from_stop_I, to_stop_I, type
+        where type is the route type of the trip (-1 for walking).
+        An existing table is rebuilt when the legs table has changed since the table was created.
+
+        Parameters
+        ----------
+        force: bool
+            rebuild the table even if it is up to date
+        chunk_size: int
+            number of legs processed at a time
+        """
+        legs_signature = self._get_legs_signature()
+        if self.has_leg_sections_table():
+            if not force and Parameters(self.conn).get(LEG_SECTIONS_SIGNATURE_KEY) == legs_signature:
+                return
+            self.conn.execute("DROP TABLE " + LEG_SECTIONS_TABLE)
+        self.conn.execute("CREATE TABLE " + LEG_SECTIONS_TABLE + " (journey_id INT, target_stop_I INT, trip_I INT, "
+                          "from_stop_I INT, to_stop_I INT, type INT)")
+        read_cur = self.conn.cursor()
+        read_cur.execute("""SELECT legs.journey_id, journeys.to_stop_I, legs.trip_I, legs.leg_stops,
+                            coalesce(q2.type, -1) AS type
+                            FROM legs
+                            JOIN journeys ON journeys.journey_id = legs.journey_id
+                            LEFT JOIN (SELECT trips.trip_I, routes.type FROM other.trips, other.routes
+                                       WHERE trips.route_I = routes.route_I) q2
+                            ON legs.trip_I = q2.trip_I""")
+        insert_stmt = "INSERT INTO " + LEG_SECTIONS_TABLE + " VALUES (?, ?, ?, ?, ?, ?)"
+        while True:
+            legs = read_cur.fetchmany(chunk_size)
+            if not legs:
+                break
+            rows = []
+            for journey_id, target_stop_I, trip_I, leg_stops, route_type in legs:
+                stops = [int(stop) for stop in leg_stops.split(",")]
+                rows.extend((journey_id, target_stop_I, trip_I, from_stop_I, to_stop_I, route_type)
+                            for from_stop_I, to_stop_I in zip(stops[:-1], stops[1:]))
+            self.conn.executemany(insert_stmt, rows)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_leg_sections_target ON " + LEG_SECTIONS_TABLE +
+                          " (target_stop_I, from_stop_I, to_stop_I, type)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_leg_sections_jid ON " + LEG_SECTIONS_TABLE + " (journey_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_leg_sections_from ON " + LEG_SECTIONS_TABLE + " (from_stop_I)")
+        Parameters(self.conn)[LEG_SECTIONS_SIGNATURE_KEY] = legs_signature
+        self.clear_cache()
+
+    def _attach_diff_database(self, diff_path):
+        if self._attached_diff_path != diff_path:
+            if self._attached_diff_path is not None:
+                self.conn.execute("DETACH DATABASE diff")
+            self.conn = attach_database(self.conn, diff_path, name="diff")
+            self._attached_diff_path = diff_path
+
+    @memoized_query
     def get_journey_legs_to_target(self, target, fastest_path=True, min_boardings=False, all_leg_sections=True,
                                                    ignore_walk=False, diff_threshold=None, diff_path=None):
         """
@@ -48,18 +175,20 @@ class JourneyDataAnalyzer:
         add_diff = ""
         if fastest_path:
             added_constraints += " AND journeys.pre_journey_wait_fp>=0"
-        if ignore_walk:
-            added_constraints += " AND legs.trip_I >= 0"
         if diff_path and diff_threshold:
-            self.conn = attach_database(self.conn, diff_path, name="diff")
+            self._attach_diff_database(diff_path)
             add_diff = ", diff.diff_temporal_distance"
             added_constraints += " AND abs(diff_temporal_distance.diff_mean) >= %s " \
                                  "AND diff_temporal_distance.from_stop_I = journeys.from_stop_I " \
                                  "AND diff_temporal_distance.to_stop_I = journeys.to_stop_I" % (diff_threshold,)
 
         if all_leg_sections:
+            if ignore_walk:
+                added_constraints += " AND leg_sections.trip_I >= 0"
             df = self._get_journey_legs_to_target_with_all_sections(target, added_constraints)
         else:
+            if ignore_walk:
+                added_constraints += " AND legs.trip_I >= 0"
             query = """SELECT from_stop_I, to_stop_I, coalesce(type, -1) AS type,
                          count(*) AS n_trips
                          FROM
@@ -73,38 +202,16 @@ class JourneyDataAnalyzer:
         return df
 
     def _get_journey_legs_to_target_with_all_sections(self, target, added_constraint):
-        def gen_pairs(stop_lists):
-            for stop_list in stop_lists:
-                prev_stop = None
-                stop_pair_list = []
-                for stop in stop_list:
-                    if prev_stop:
-                        stop_pair_list.append((int(prev_stop), int(stop)))
-                    prev_stop = stop
-                yield stop_pair_list
-
-        query = """SELECT leg_stops, coalesce(type, -1) AS type, count(*) AS n_trips FROM
-                   (SELECT legs.* FROM legs, journeys
-                   WHERE journeys.journey_id = legs.journey_id AND journeys.to_stop_I = %s %s) q1
-                     LEFT JOIN (SELECT * FROM other.trips, other.routes WHERE trips.route_I = routes.route_I) q2
-                     ON q1.trip_I = q2.trip_I
-                     GROUP BY leg_stops, type""" % (str(target), added_constraint)
-        orig_df = read_sql_query(query, self.conn)
-
-        df = DataFrame([x for x in gen_pairs(orig_df.leg_stops.str.split(',').tolist())],
-                          index=[orig_df.type, orig_df.n_trips]).stack()
-
-        df = df.reset_index()
-        df = df.rename(columns={0: "stop_tuple"})
-        df[['from_stop_I', 'to_stop_I']] = df['stop_tuple'].apply(Series)
-
-        df = df.groupby(['from_stop_I', 'to_stop_I', 'type']).agg({'n_trips': [np.sum]})
-        df = df.reset_index()
-        df.columns = df.columns.droplevel(1)
-        df_to_return = df[['from_stop_I', 'to_stop_I', 'type', 'n_trips']]
-
-        return df_to_return
-
+        self.materialize_leg_sections()
+        query = """SELECT leg_sections.from_stop_I, leg_sections.to_stop_I, leg_sections.type, count(*) AS n_trips
+                   FROM leg_sections, journeys
+                   WHERE journeys.journey_id = leg_sections.journey_id AND leg_sections.target_stop_I = %s %s
+                   GROUP BY leg_sections.from_stop_I, leg_sections.to_stop_I, leg_sections.type
+                   ORDER BY leg_sections.from_stop_I, leg_sections.to_stop_I, leg_sections.type""" \
+                % (str(target), added_constraint)
+        return read_sql_query(query, self.conn)
+
+    @memoized_query
     def get_origin_target_journey_legs(self, origin, target, start_time=None, end_time=None, fastest_path=True, min_boardings=False,
                                        ignore_walk=False, add_coordinates=True):
 
@@ -176,6 +283,7 @@ class JourneyDataAnalyzer:
         df = DataFrame({"n_trips": df.groupby(["from_stop_I", "to_stop_I", "type"]).size()}).reset_index()
         return df
 
+    @memoized_query
     def journey_alternatives_per_stop_pair(self, target, start_time, end_time):
         query = """SELECT from_stop_I, to_stop_I, ifnull(1.0*sum(n_sq)/(sum(n_trips)*(sum(n_trips)-1)), 1) AS simpson,
                     sum(n_trips) AS n_trips, count(*) AS n_routes FROM 
@@ -189,6 +297,7 @@ class JourneyDataAnalyzer:
 
         return df
 
+    @memoized_query
     def journey_alternative_data_time_weighted(self, target, start_time, end_time):
         query = """SELECT sum(p*p) AS simpson, sum(n_trips) AS n_trips, count(*) AS n_routes, from_stop_I, to_stop_I FROM
                     (SELECT 1.0*sum(pre_journey_wait_fp)/total_time AS p, count(*) AS n_trips, route, 
@@ -210,6 +319,7 @@ class JourneyDataAnalyzer:
         df = self.g.add_coordinates_to_df(df, join_column="to_stop_I", lat_name="to_lat", lon_name="to_lon")
         return df
 
+    @memoized_query
     def get_upstream_stops(self, target, stop):
         query = """SELECT stops.* FROM other.stops, 
                     (SELECT journeys.from_stop_I AS stop_I FROM journeys, legs 
@@ -242,19 +352,41 @@ class JourneyDataAnalyzer:
         df = read_sql_query(query, self.conn)
         return df
 
-    def passing_journeys_per_stop(self):
+    @memoized_query
+    def passing_journeys_per_stop(self, fastest_path=False):
         """
+        Number of journeys (to any target) departing from each stop along their legs.
 
-        :return:
+        :param fastest_path: consider only fastest path journeys
+        :return: DataFrame with columns stop_I, n_journeys
         """
-        pass
+        self.materialize_leg_sections()
+        added_constraints = " AND journeys.pre_journey_wait_fp>=0" if fastest_path else ""
+        query = """SELECT leg_sections.from_stop_I AS stop_I, count(DISTINCT leg_sections.journey_id) AS n_journeys
+                   FROM leg_sections, journeys
+                   WHERE journeys.journey_id = leg_sections.journey_id %s
+                   GROUP BY leg_sections.from_stop_I""" % (added_constraints,)
+        return read_sql_query(query, self.conn)
+
     @timeit
+    @memoized_query
     def journeys_per_section(self, fastest_path=False, time_weighted=False):
         """
+        Number of journeys (to any target) traversing each stop-to-stop section, per route type.
 
-        :return:
+        :param fastest_path: consider only fastest path journeys
+        :param time_weighted: weight each journey by its pre_journey_wait_fp
+        :return: DataFrame with columns from_stop_I, to_stop_I, type, n_trips
         """
-        pass
+        self.materialize_leg_sections()
+        added_constraints = " AND journeys.pre_journey_wait_fp>=0" if fastest_path else ""
+        aggregate = "sum(journeys.pre_journey_wait_fp)" if time_weighted else "count(*)"
+        query = """SELECT leg_sections.from_stop_I, leg_sections.to_stop_I, leg_sections.type, %s AS n_trips
+                   FROM leg_sections, journeys
+                   WHERE journeys.journey_id = leg_sections.journey_id %s
+                   GROUP BY leg_sections.from_stop_I, leg_sections.to_stop_I, leg_sections.type""" \
+                % (aggregate, added_constraints)
+        return read_sql_query(query, self.conn)
 
     def n_departure_stop_alternatives(self):
         """
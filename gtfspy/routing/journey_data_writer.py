@@ -0,0 +1,190 @@
+import multiprocessing
+import sqlite3
+import threading
+import time
+
+from gtfspy.routing.journey_data import LEG_COLUMNS, collect_journey_rows, _insert_stmt, _offset_journey_ids
+
+
+class JourneyDataWriter(object):
+    """
+    Single writer of a journey database, fed through a queue.
+
+    Routing workers (possibly running in other processes) push the journeys computed for a target to
+    the writer's queue. The writer is the only connection writing to the database: it uses WAL journaling,
+    groups the pushed results into large transactions, and assigns each batch a contiguous range of
+    journey ids, so that the workers never need to lock the database.
+
+    Usage
+    -----
+    jdm = JourneyDataManager(gtfs_path, journey_db_path, routing_params=params)  # creates the tables
+    with jdm.get_journey_data_writer() as writer:
+        # pass writer.queue to the worker processes, which call
+        # JourneyDataWriter.push(queue, target_stop_I, journey_labels, track_route=...)
+        ...
+    print(writer.metrics)
+    """
+
+    def __init__(self, journey_db_path, batch_size=100000, queue=None, max_queue_size=0, timeout=1000):
+        """
+        Parameters
+        ----------
+        journey_db_path: str
+            path to an initialized journey database (see JourneyDataManager)
+        batch_size: int
+            number of journeys written in one transaction
+        queue: multiprocessing.Queue, optional
+            queue to consume, by default a new multiprocessing.Queue is created
+        max_queue_size: int
+            maximum size of the created queue, 0 for unbounded
+        timeout: float
+            sqlite3 connection timeout
+        """
+        self.journey_db_path = journey_db_path
+        self.batch_size = batch_size
+        self.timeout = timeout
+        if queue is None:
+            queue = multiprocessing.Queue(max_queue_size)
+        self.queue = queue
+        self._thread = None
+        self._error = None
+        self.metrics = {"n_targets": 0,
+                        "n_journeys": 0,
+                        "n_legs": 0,
+                        "n_transactions": 0,
+                        "write_duration": 0.0,
+                        "elapsed": 0.0,
+                        "journeys_per_second": 0.0}
+
+    @staticmethod
+    def push(queue, target_stop_I, origin_stop_I_to_journey_labels, track_route=False, multitarget_routing=False):
+        """
+        Convert journey labels into table rows in the calling (worker) process and push them to the writer queue.
+        """
+        journey_columns, journey_rows, leg_rows = collect_journey_rows(target_stop_I,
+                                                                       origin_stop_I_to_journey_labels,
+                                                                       track_route=track_route,
+                                                                       multitarget_routing=multitarget_routing)
+        queue.put((int(target_stop_I), journey_columns, journey_rows, leg_rows))
+
+    def put(self, target_stop_I, origin_stop_I_to_journey_labels, track_route=False, multitarget_routing=False):
+        if self._error is not None:
+            raise self._error
+        self.push(self.queue, target_stop_I, origin_stop_I_to_journey_labels,
+                  track_route=track_route, multitarget_routing=multitarget_routing)
+
+    def start(self):
+        assert self._thread is None, "writer already started"
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """
+        Write everything remaining in the queue and stop the writer.
+        Raises the error of the writer thread, if writing failed.
+
+        Returns
+        -------
+        metrics: dict
+        """
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            raise self._error
+        return self.metrics
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not mask the exception raised within the with-block by an error of the writer
+            try:
+                self.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        start_time = time.time()
+        conn = sqlite3.connect(self.journey_db_path, self.timeout, isolation_level=None)
+        closed = False
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            max_journey_id = conn.execute("SELECT max(journey_id) FROM journeys").fetchone()[0]
+            next_journey_id = (max_journey_id if max_journey_id else 0) + 1
+            batch = []
+            n_batch_journeys = 0
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    closed = True
+                    break
+                if batch and item[1] != batch[0][1]:
+                    next_journey_id = self._write_batch(conn, batch, next_journey_id)
+                    batch = []
+                    n_batch_journeys = 0
+                batch.append(item)
+                n_batch_journeys += len(item[2])
+                if n_batch_journeys >= self.batch_size:
+                    next_journey_id = self._write_batch(conn, batch, next_journey_id)
+                    batch = []
+                    n_batch_journeys = 0
+            if batch:
+                self._write_batch(conn, batch, next_journey_id)
+        except Exception as e:
+            self._error = e
+            # keep consuming (and discarding) the queue until close(), so that the producers
+            # do not block on a full queue
+            while not closed:
+                closed = self.queue.get() is None
+        finally:
+            conn.close()
+            self.metrics["elapsed"] = time.time() - start_time
+            if self.metrics["elapsed"] > 0:
+                self.metrics["journeys_per_second"] = self.metrics["n_journeys"] / self.metrics["elapsed"]
+
+    def _write_batch(self, conn, batch, next_journey_id):
+        """
+        Write a batch of (target_stop_I, journey_columns, journey_rows, leg_rows) items in one transaction.
+
+        Returns
+        -------
+        next_journey_id: int
+            first journey id of the range left free for the next batch
+        """
+        write_start = time.time()
+        journey_columns = batch[0][1]
+        journey_rows = []
+        leg_rows = []
+        route_targets = []
+        for target_stop_I, _, target_journey_rows, target_leg_rows in batch:
+            if not target_journey_rows:
+                continue
+            offset = next_journey_id - 1
+            journey_rows += _offset_journey_ids(target_journey_rows, offset)
+            next_journey_id += max(row[0] for row in target_journey_rows)
+            if target_leg_rows is not None:
+                leg_rows += _offset_journey_ids(target_leg_rows, offset)
+                route_targets.append(target_stop_I)
+
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(_insert_stmt("journeys", journey_columns), journey_rows)
+        if leg_rows:
+            conn.executemany(_insert_stmt("legs", LEG_COLUMNS), leg_rows)
+        if route_targets:
+            target_list = conn.execute("SELECT value FROM parameters WHERE key='target_list'").fetchone()
+            target_list = (target_list[0] if target_list else ",") + "".join(str(t) + "," for t in route_targets)
+            conn.execute("INSERT OR REPLACE INTO parameters('key', 'value') VALUES (?, ?)", ("target_list", target_list))
+        conn.execute("COMMIT")
+
+        self.metrics["n_targets"] += len(batch)
+        self.metrics["n_journeys"] += len(journey_rows)
+        self.metrics["n_legs"] += len(leg_rows)
+        self.metrics["n_transactions"] += 1
+        self.metrics["write_duration"] += time.time() - write_start
+        return next_journey_id
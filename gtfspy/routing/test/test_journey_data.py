@@ -2,12 +2,15 @@ from unittest import TestCase
 
 import pyximport
 
-from gtfspy.routing.journey_data import JourneyDataManager
-from gtfspy.routing.label import LabelTimeWithBoardingsCount
+import numpy
+
+from gtfspy.routing.journey_data import JourneyDataManager, DiffDataManager, _fastest_path_mask
+from gtfspy.routing.label import LabelTimeWithBoardingsCount, LabelTimeAndRoute, compute_pareto_front
 
 pyximport.install()
 import shutil
 import os
+import sqlite3
 from gtfspy.import_gtfs import import_gtfs
 from gtfspy.routing.travel_impedance_data_store import TravelImpedanceDataStore
 
@@ -59,4 +62,87 @@ class TestJourneyData(TestCase):
         self.assertAlmostEqual(df.iloc[0]["min"], 1)
         self.assertAlmostEqual(df.iloc[0]["mean"], 1.5)
         self.assertAlmostEqual(df.iloc[0]["max"], 2.0)
-        self.assertIn(df.iloc[0]["median"],[1, 2, 1.0, 1.5, 2.0])
\ No newline at end of file
+        self.assertIn(df.iloc[0]["median"],[1, 2, 1.0, 1.5, 2.0])
+
+    def test_add_fastest_path_column(self):
+        destination_stop = 1
+        origin_stop = 2
+        self.jdm.import_journey_data_for_target_stop(destination_stop,
+                                                     {origin_stop:
+                                                        [LabelTimeWithBoardingsCount(1, 10, 1, True),
+                                                         LabelTimeWithBoardingsCount(2, 8, 2, True),
+                                                         LabelTimeWithBoardingsCount(3, 8, 1, True),
+                                                         LabelTimeWithBoardingsCount(4, 12, 1, True)]}
+                                                     )
+        self.jdm.add_fastest_path_column()
+        rows = self.jdm.conn.execute("SELECT departure_time FROM journeys "
+                                     "WHERE fastest_path = 1 ORDER BY departure_time").fetchall()
+        self.assertEqual([x[0] for x in rows], [3, 4])
+
+        # journeys with missing times are skipped, and non-integer times are compared exactly
+        self.jdm.conn.execute("UPDATE journeys SET arrival_time_target = NULL WHERE departure_time = 1")
+        self.jdm.conn.execute("UPDATE journeys SET departure_time = 3.4, arrival_time_target = 8.6 "
+                              "WHERE departure_time = 3")
+        self.jdm.conn.execute("UPDATE journeys SET departure_time = 3.2, arrival_time_target = 8.4, fastest_path = 0 "
+                              "WHERE departure_time = 2")
+        self.jdm.conn.execute("UPDATE journeys SET fastest_path = NULL")
+        self.jdm.add_fastest_path_column()
+        rows = self.jdm.conn.execute("SELECT departure_time FROM journeys "
+                                     "WHERE fastest_path = 1 ORDER BY departure_time").fetchall()
+        self.assertEqual([x[0] for x in rows], [3.2, 3.4, 4])
+
+    def test_fastest_path_mask_matches_pareto_front(self):
+        rng = numpy.random.RandomState(0)
+        n = 500
+        from_stop_Is = rng.randint(0, 5, n)
+        departure_times = rng.randint(0, 100, n)
+        arrival_times = departure_times + rng.randint(1, 50, n)
+        journey_ids = numpy.arange(1, n + 1)
+        mask = _fastest_path_mask(from_stop_Is, departure_times, arrival_times, journey_ids)
+        expected = set()
+        for origin in range(5):
+            sel = from_stop_Is == origin
+            labels = [LabelTimeAndRoute(dep, arr, jid, False) for dep, arr, jid in
+                      zip(departure_times[sel], arrival_times[sel], journey_ids[sel])]
+            expected |= set(label.movement_duration for label in
+                            compute_pareto_front(labels, finalization=False, ignore_n_boardings=True))
+        self.assertSetEqual(set(journey_ids[mask].tolist()), expected)
+
+
+class TestDiffDataManager(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = "./tmp_diff_test_data/"
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self.before_path = os.path.join(self.tmp_dir, "before.sqlite")
+        self.after_path = os.path.join(self.tmp_dir, "after.sqlite")
+        before_data = [(1, 2, 10, 20, 15, 15), (1, 3, 10, 20, 15, 15), (2, 3, 0, 0, 0, 0), (4, 3, 5, 5, 5, 5)]
+        after_data = [(1, 2, 12, 18, 15, 16), (2, 3, 1, 2, 1, 1), (4, 3, 5, 6, 5, 5), (5, 3, 1, 1, 1, 1)]
+        for path, data in [(self.before_path, before_data), (self.after_path, after_data)]:
+            store = TravelImpedanceDataStore(path)
+            store.create_table("temporal_distance")
+            store.insert_data("temporal_distance", [dict(zip(["from_stop_I", "to_stop_I", "min", "max", "median", "mean"], x))
+                                                    for x in data])
+            store.conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _diff_rows(self, diff_db_name):
+        conn = sqlite3.connect(os.path.join(self.tmp_dir, diff_db_name))
+        rows = conn.execute("SELECT * FROM diff_temporal_distance ORDER BY from_stop_I, to_stop_I").fetchall()
+        conn.close()
+        return rows
+
+    def test_streaming_comparison_matches_sql_comparison(self):
+        DiffDataManager(os.path.join(self.tmp_dir, "diff_sql.sqlite")).initialize_journey_comparison_tables(
+            ["temporal_distance"], (self.before_path, "before"), (self.after_path, "after"))
+        DiffDataManager(os.path.join(self.tmp_dir, "diff_stream.sqlite")).initialize_journey_comparison_tables_streaming(
+            ["temporal_distance"], self.before_path, self.after_path, chunk_size=1)
+        DiffDataManager(os.path.join(self.tmp_dir, "diff_parallel.sqlite")).initialize_journey_comparison_tables_parallel(
+            ["temporal_distance"], self.before_path, self.after_path, n_processes=2, chunk_size=1)
+        expected = self._diff_rows("diff_sql.sqlite")
+        self.assertEqual(len(expected), 3)
+        self.assertListEqual(self._diff_rows("diff_stream.sqlite"), expected)
+        self.assertListEqual(self._diff_rows("diff_parallel.sqlite"), expected)
@@ -0,0 +1,100 @@
+import os
+import shutil
+import sqlite3
+from collections import namedtuple
+from unittest import TestCase
+
+import pyximport
+
+from gtfspy.import_gtfs import import_gtfs
+from gtfspy.routing.journey_data import JourneyDataManager
+from gtfspy.routing.journey_data_analyzer import JourneyDataAnalyzer
+
+pyximport.install()
+
+
+class TestJourneyDataAnalyzer(TestCase):
+
+    def setUp(self):
+        self.routing_tmp_test_data_dir = "./tmp_journey_analyzer_test_data/"
+        self.gtfs_path = os.path.join(self.routing_tmp_test_data_dir, "test_gtfs.sqlite")
+        self.journey_db_path = os.path.join(self.routing_tmp_test_data_dir, "test_journeys.sqlite")
+        shutil.rmtree(self.routing_tmp_test_data_dir, ignore_errors=True)
+        os.makedirs(self.routing_tmp_test_data_dir)
+        import_gtfs([os.path.join(os.path.dirname(__file__), "../../test/test_data/test_gtfs.zip")], self.gtfs_path)
+        jdm = JourneyDataManager(self.gtfs_path, self.journey_db_path, track_route=True)
+        trip_I = jdm.gtfs.execute_custom_query("SELECT trip_I FROM trips LIMIT 1").fetchone()[0]
+        self.route_type = jdm.gtfs.get_route_name_and_type_of_tripI(trip_I)[1]
+        jdm.conn.executemany("INSERT INTO journeys (journey_id, from_stop_I, to_stop_I, pre_journey_wait_fp) "
+                             "VALUES (?, ?, ?, ?)",
+                             [(1, 1, 5, 10), (2, 2, 5, None), (3, 1, 6, 0)])
+        jdm.conn.executemany("INSERT INTO legs (journey_id, from_stop_I, to_stop_I, trip_I, seq, leg_stops) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             [(1, 1, 3, trip_I, 1, "1,2,3"),
+                              (1, 3, 5, -1, 2, "3,5"),
+                              (2, 2, 3, trip_I, 1, "2,3"),
+                              (3, 1, 6, trip_I, 1, "1,2,6")])
+        jdm.conn.commit()
+        del jdm
+        self.jda = JourneyDataAnalyzer(self.journey_db_path, self.gtfs_path)
+
+    def tearDown(self):
+        del self.jda
+        shutil.rmtree(self.routing_tmp_test_data_dir, ignore_errors=True)
+
+    def test_get_journey_legs_to_target_with_all_sections(self):
+        df = self.jda.get_journey_legs_to_target(5, fastest_path=False)
+        sections = {(row.from_stop_I, row.to_stop_I, row.type): row.n_trips for row in df.itertuples()}
+        self.assertDictEqual(sections, {(1, 2, self.route_type): 1,
+                                        (2, 3, self.route_type): 2,
+                                        (3, 5, -1): 1})
+        df = self.jda.get_journey_legs_to_target(5, fastest_path=True, ignore_walk=True)
+        sections = {(row.from_stop_I, row.to_stop_I, row.type): row.n_trips for row in df.itertuples()}
+        self.assertDictEqual(sections, {(1, 2, self.route_type): 1,
+                                        (2, 3, self.route_type): 1})
+
+    def test_memoized_results_are_not_shared(self):
+        df = self.jda.get_journey_legs_to_target(5, fastest_path=False)
+        df["n_trips"] = 0
+        df_again = self.jda.get_journey_legs_to_target(5, fastest_path=False)
+        self.assertGreater(df_again["n_trips"].sum(), 0)
+
+    def test_unhashable_query_parameters_are_not_cached(self):
+        df = self.jda.get_journey_legs_to_target(5, fastest_path=False, diff_path=["not", "hashable"])
+        self.assertGreater(len(df), 0)
+        self.assertEqual(len(self.jda._query_cache), 0)
+
+    def test_leg_sections_are_rebuilt_when_legs_change(self):
+        df = self.jda.journeys_per_section()
+        self.assertNotIn((6, 7), set(zip(df.from_stop_I, df.to_stop_I)))
+        # new legs written by another connection are seen by the memoized queries
+        conn = sqlite3.connect(self.journey_db_path)
+        conn.execute("INSERT INTO journeys (journey_id, from_stop_I, to_stop_I) VALUES (4, 6, 7)")
+        conn.execute("INSERT INTO legs (journey_id, from_stop_I, to_stop_I, trip_I, seq, leg_stops) "
+                     "VALUES (4, 6, 7, -1, 1, '6,7')")
+        conn.commit()
+        conn.close()
+        df = self.jda.journeys_per_section()
+        self.assertIn((6, 7), set(zip(df.from_stop_I, df.to_stop_I)))
+        df = self.jda.get_journey_legs_to_target(7, fastest_path=False)
+        self.assertIn((6, 7), set(zip(df.from_stop_I, df.to_stop_I)))
+
+    def test_cache_is_cleared_on_in_place_journey_updates(self):
+        df = self.jda.get_journey_legs_to_target(5, fastest_path=True, ignore_walk=True)
+        self.assertEqual(df["n_trips"].sum(), 2)
+        jdm = JourneyDataManager(self.gtfs_path, self.journey_db_path, track_route=True)
+        label = namedtuple("Label", ["journey_id", "pre_journey_wait_fp"])
+        jdm.update_journey_from_labels([label(2, 0)], "pre_journey_wait_fp")
+        del jdm
+        df = self.jda.get_journey_legs_to_target(5, fastest_path=True, ignore_walk=True)
+        self.assertEqual(df["n_trips"].sum(), 3)
+
+    def test_journeys_per_section_and_passing_journeys(self):
+        df = self.jda.journeys_per_section()
+        sections = {(row.from_stop_I, row.to_stop_I): row.n_trips for row in df.itertuples()}
+        self.assertEqual(sections[(1, 2)], 2)
+        self.assertEqual(sections[(2, 6)], 1)
+        df = self.jda.passing_journeys_per_stop()
+        n_journeys = {row.stop_I: row.n_journeys for row in df.itertuples()}
+        self.assertEqual(n_journeys[2], 3)
+        self.assertEqual(n_journeys[3], 1)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import sqlite3
+import threading
+from unittest import TestCase
+
+import pyximport
+
+from gtfspy.import_gtfs import import_gtfs
+from gtfspy.routing.connection import Connection
+from gtfspy.routing.journey_data import JourneyDataManager
+from gtfspy.routing.journey_data_writer import JourneyDataWriter
+from gtfspy.routing.label import LabelTimeWithBoardingsCount, LabelTimeAndRoute
+
+pyximport.install()
+
+
+class TestJourneyDataWriter(TestCase):
+
+    def setUp(self):
+        self.routing_tmp_test_data_dir = "./tmp_journey_writer_test_data/"
+        self.gtfs_path = os.path.join(self.routing_tmp_test_data_dir, "test_gtfs.sqlite")
+        shutil.rmtree(self.routing_tmp_test_data_dir, ignore_errors=True)
+        os.makedirs(self.routing_tmp_test_data_dir)
+        import_gtfs([os.path.join(os.path.dirname(__file__), "../../test/test_data/test_gtfs.zip")], self.gtfs_path)
+        self.jdm = JourneyDataManager(self.gtfs_path,
+                                      os.path.join(self.routing_tmp_test_data_dir, "test_journeys.sqlite"),
+                                      routing_params={"track_vehicle_legs": True})
+
+    def tearDown(self):
+        shutil.rmtree(self.routing_tmp_test_data_dir, ignore_errors=True)
+
+    def test_writer_assigns_contiguous_journey_ids(self):
+        self.jdm.import_journey_data_for_target_stop(1, {2: [LabelTimeWithBoardingsCount(1, 2, 1, True)]})
+        with self.jdm.get_journey_data_writer(batch_size=2) as writer:
+            writer.put(1, {3: [LabelTimeWithBoardingsCount(1, 5, 1, True),
+                               LabelTimeWithBoardingsCount(2, 6, 2, True)]})
+            writer.put(4, {2: [LabelTimeWithBoardingsCount(3, 7, 1, True)],
+                           3: [LabelTimeWithBoardingsCount(4, 9, 0, True)]})
+            writer.put(5, {})
+        self.assertEqual(writer.metrics["n_journeys"], 4)
+        self.assertEqual(writer.metrics["n_targets"], 3)
+        self.assertGreaterEqual(writer.metrics["n_transactions"], 2)
+
+        rows = self.jdm.conn.execute("SELECT journey_id, from_stop_I, to_stop_I, departure_time FROM journeys "
+                                     "ORDER BY journey_id").fetchall()
+        self.assertEqual([row[0] for row in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(rows[3][1:], (2, 4, 3))
+        self.assertEqual(rows[4][1:], (3, 4, 4))
+        journal_mode = self.jdm.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(journal_mode, "wal")
+
+    def test_writer_with_tracked_routes(self):
+        jdm = JourneyDataManager(self.gtfs_path,
+                                 os.path.join(self.routing_tmp_test_data_dir, "test_route_journeys.sqlite"),
+                                 routing_params={"track_vehicle_legs": False},
+                                 track_route=True)
+        last_label = LabelTimeAndRoute(25, 30, 5, False, connection=Connection(3, 1, 25, 30, 8, 1))
+        label = LabelTimeAndRoute(10, 30, 15, False, connection=Connection(2, 3, 10, 20, 7, 1),
+                                  previous_label=last_label)
+        walk_label = LabelTimeAndRoute(12, 20, 8, True, connection=Connection(5, 4, 12, 20, None, -1, is_walk=True))
+        with jdm.get_journey_data_writer(batch_size=1) as writer:
+            writer.put(1, {2: [label]}, track_route=True)
+            writer.put(4, {5: [walk_label]}, track_route=True)
+        self.assertEqual(writer.metrics["n_journeys"], 2)
+        self.assertEqual(writer.metrics["n_legs"], 3)
+
+        journeys = jdm.conn.execute("SELECT journey_id, from_stop_I, to_stop_I, departure_time, arrival_time_target, "
+                                    "movement_duration, route FROM journeys ORDER BY journey_id").fetchall()
+        self.assertEqual(journeys, [(1, 2, 1, 10, 30, 15, "2,3,1"), (2, 5, 4, 12, 20, 8, "5,4")])
+        legs = jdm.conn.execute("SELECT journey_id, from_stop_I, to_stop_I, departure_time, arrival_time_target, "
+                                "trip_I, seq, leg_stops FROM legs ORDER BY journey_id, seq").fetchall()
+        self.assertEqual(legs, [(1, 2, 3, 10, 20, 7, 1, "2,3"),
+                                (1, 3, 1, 25, 30, 8, 2, "3,1"),
+                                (2, 5, 4, 12, 20, -1, 1, "5,4")])
+        target_list = jdm.conn.execute("SELECT value FROM parameters WHERE key='target_list'").fetchone()[0]
+        self.assertEqual([int(x) for x in target_list.split(",") if x], [1, 4])
+
+    def test_writer_error_does_not_block_producers(self):
+        empty_db_path = os.path.join(self.routing_tmp_test_data_dir, "no_tables.sqlite")
+        sqlite3.connect(empty_db_path).close()
+        writer = JourneyDataWriter(empty_db_path, max_queue_size=1).start()
+        with self.assertRaises(sqlite3.OperationalError):
+            for _ in range(1000):
+                writer.put(1, {2: [LabelTimeWithBoardingsCount(1, 2, 1, True)]})
+        with self.assertRaises(sqlite3.OperationalError):
+            writer.close()
+
+    def test_writer_error_in_last_batch(self):
+        db_path = os.path.join(self.routing_tmp_test_data_dir, "no_journey_columns.sqlite")
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE journeys (journey_id INT)")
+        conn.close()
+        writer = JourneyDataWriter(db_path).start()
+        writer.put(1, {2: [LabelTimeWithBoardingsCount(1, 2, 1, True)]})
+        errors = []
+
+        def close():
+            try:
+                writer.close()
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+        closing_thread = threading.Thread(target=close, daemon=True)
+        closing_thread.start()
+        closing_thread.join(10)
+        self.assertFalse(closing_thread.is_alive(), "close() did not return")
+        self.assertEqual(len(errors), 1)
+
+    def test_writer_error_does_not_mask_exception(self):
+        db_path = os.path.join(self.routing_tmp_test_data_dir, "no_journey_columns.sqlite")
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE journeys (journey_id INT)")
+        conn.close()
+        with self.assertRaises(KeyError):
+            with JourneyDataWriter(db_path) as writer:
+                writer.put(1, {2: [LabelTimeWithBoardingsCount(1, 2, 1, True)]})
+                raise KeyError("raised within the with-block")
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+
+from gtfspy.routing.travel_impedance_data_store import TravelImpedanceDataStore, load_matrix
+
+
+class TestTravelImpedanceDataStore(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = TravelImpedanceDataStore(os.path.join(self.tmp_dir, "store.sqlite"))
+        self.store.create_table("temporal_distance")
+        data = [{"from_stop_I": 1, "to_stop_I": 2, "min": 10, "max": 20, "median": 15, "mean": 16},
+                {"from_stop_I": 1, "to_stop_I": 3, "min": 30, "max": 40, "median": 35, "mean": 36},
+                {"from_stop_I": 5, "to_stop_I": 2, "min": 1, "max": 2, "median": 1.5, "mean": 1.5}]
+        self.store.insert_data("temporal_distance", data)
+        self.store.create_indices("temporal_distance")
+
+    def tearDown(self):
+        self.store.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_data_as_dataframe(self):
+        df = self.store.read_data_as_dataframe("temporal_distance", from_stop_I=1, statistic="max")
+        self.assertEqual(len(df), 2)
+        self.assertListEqual(sorted(df["max"].tolist()), [20, 40])
+        with self.assertRaises(ValueError):
+            self.store.read_data_as_dataframe("temporal_distance", statistic="max; DROP TABLE x")
+        with self.assertRaises(ValueError):
+            self.store.read_data_as_dataframe("no_such_measure")
+
+    def test_read_data_as_matrix(self):
+        matrix, from_stop_Is, to_stop_Is = self.store.read_data_as_matrix("temporal_distance", "mean", chunk_size=1)
+        self.assertListEqual(from_stop_Is.tolist(), [1, 5])
+        self.assertListEqual(to_stop_Is.tolist(), [2, 3])
+        self.assertEqual(matrix[0, 0], 16)
+        self.assertEqual(matrix[0, 1], 36)
+        self.assertEqual(matrix[1, 0], 1.5)
+        self.assertTrue(numpy.isnan(matrix[1, 1]))
+
+        matrix, from_stop_Is, to_stop_Is = self.store.read_data_as_matrix("temporal_distance", "min",
+                                                                          from_stop_Is=[5], to_stop_Is=[2, 4])
+        self.assertEqual(matrix.shape, (1, 2))
+        self.assertEqual(matrix[0, 0], 1)
+
+    def test_export_matrix(self):
+        prefix = os.path.join(self.tmp_dir, "temporal_distance_mean")
+        self.store.export_matrix(prefix, "temporal_distance", "mean")
+        matrix, from_stop_Is, to_stop_Is = load_matrix(prefix)
+        expected, _, _ = self.store.read_data_as_matrix("temporal_distance", "mean")
+        numpy.testing.assert_array_equal(matrix, expected)
+        self.assertListEqual(from_stop_Is.tolist(), [1, 5])
@@ -1,6 +1,10 @@
 import sqlite3
+
+import numpy
 import pandas as pd
 
+STATISTICS = ("min", "max", "median", "mean")
+
 
 class TravelImpedanceDataStore:
 
@@ -21,28 +25,146 @@ class TravelImpedanceDataStore:
         -------
         values: number | Pandas DataFrame
         """
-        to_select = []
-        where_clauses = []
-        to_select.append("from_stop_I")
-        to_select.append("to_stop_I")
-        if from_stop_I is not None:
-            where_clauses.append("from_stop_I=" + str(int(from_stop_I)))
-        if to_stop_I is not None:
-            where_clauses.append("to_stop_I=" + str(int(to_stop_I)))
-        where_clause = ""
-        if len(where_clauses) > 0:
-            where_clause = " WHERE " + " AND ".join(where_clauses)
+        self._assert_valid_measure(travel_impedance_measure)
+        to_select = ["from_stop_I", "to_stop_I"]
         if not statistic:
             to_select.extend(["min", "mean", "median", "max"])
         else:
+            self._assert_valid_statistic(statistic)
             to_select.append(statistic)
-        to_select_clause = ",".join(to_select)
-        if not to_select_clause:
-            to_select_clause = "*"
-        sql = "SELECT " + to_select_clause + " FROM " + travel_impedance_measure + where_clause + ";"
-        df = pd.read_sql(sql, self.conn)
+        where_clause, params = self._where_clause(from_stop_I, to_stop_I)
+        sql = "SELECT " + ",".join(to_select) + " FROM " + travel_impedance_measure + where_clause + ";"
+        df = pd.read_sql(sql, self.conn, params=params)
         return df
 
+    def read_data_as_matrix(self,
+                            travel_impedance_measure,
+                            statistic="mean",
+                            from_stop_Is=None,
+                            to_stop_Is=None,
+                            fill_value=numpy.nan,
+                            dtype=numpy.float32,
+                            chunk_size=100000):
+        """
+        Recover pre-computed travel impedances between od-pairs as a dense origin x destination matrix.
+
+        Parameters
+        ----------
+        travel_impedance_measure: str
+        statistic: str
+            one of "min", "max", "median", "mean"
+        from_stop_Is: list-like, optional
+            origins (rows) of the matrix, by default all origins present in the data
+        to_stop_Is: list-like, optional
+            destinations (columns) of the matrix, by default all destinations present in the data
+        fill_value: float
+            value for od-pairs without data
+        dtype: numpy.dtype
+        chunk_size: int
+            number of rows fetched from the database at a time
+
+        Returns
+        -------
+        matrix: numpy.ndarray
+            matrix[i, j] is the statistic from from_stop_Is[i] to to_stop_Is[j]
+        from_stop_Is: numpy.ndarray
+            sorted stop_Is corresponding to the rows
+        to_stop_Is: numpy.ndarray
+            sorted stop_Is corresponding to the columns
+        """
+        from_stop_Is, to_stop_Is = self._get_matrix_stop_Is(travel_impedance_measure, from_stop_Is, to_stop_Is)
+        matrix = numpy.full((len(from_stop_Is), len(to_stop_Is)), fill_value, dtype=dtype)
+        self._fill_matrix(matrix, travel_impedance_measure, statistic, from_stop_Is, to_stop_Is, chunk_size)
+        return matrix, from_stop_Is, to_stop_Is
+
+    def export_matrix(self,
+                      fname_prefix,
+                      travel_impedance_measure,
+                      statistic="mean",
+                      from_stop_Is=None,
+                      to_stop_Is=None,
+                      fill_value=numpy.nan,
+                      dtype=numpy.float32,
+                      chunk_size=100000):
+        """
+        Write a travel impedance matrix to binary .npy files, without holding the whole matrix in memory.
+
+        Three files are written:
+            fname_prefix + ".npy": the matrix
+            fname_prefix + "_from_stop_I.npy": stop_Is of the rows
+            fname_prefix + "_to_stop_I.npy": stop_Is of the columns
+        The matrix can be loaded (memory-mapped) with load_matrix.
+
+        Parameters
+        ----------
+        fname_prefix: str
+        (others as in read_data_as_matrix)
+        """
+        from_stop_Is, to_stop_Is = self._get_matrix_stop_Is(travel_impedance_measure, from_stop_Is, to_stop_Is)
+        matrix = numpy.lib.format.open_memmap(fname_prefix + ".npy", mode="w+", dtype=dtype,
+                                              shape=(len(from_stop_Is), len(to_stop_Is)))
+        matrix[:] = fill_value
+        self._fill_matrix(matrix, travel_impedance_measure, statistic, from_stop_Is, to_stop_Is, chunk_size)
+        matrix.flush()
+        del matrix
+        numpy.save(fname_prefix + "_from_stop_I.npy", from_stop_Is)
+        numpy.save(fname_prefix + "_to_stop_I.npy", to_stop_Is)
+
+    def _get_matrix_stop_Is(self, travel_impedance_measure, from_stop_Is, to_stop_Is):
+        self._assert_valid_measure(travel_impedance_measure)
+        if from_stop_Is is None:
+            from_stop_Is = [x[0] for x in self.conn.execute(
+                "SELECT DISTINCT from_stop_I FROM " + travel_impedance_measure)]
+        if to_stop_Is is None:
+            to_stop_Is = [x[0] for x in self.conn.execute(
+                "SELECT DISTINCT to_stop_I FROM " + travel_impedance_measure)]
+        return numpy.unique(numpy.asarray(from_stop_Is, dtype=numpy.int64)), \
+            numpy.unique(numpy.asarray(to_stop_Is, dtype=numpy.int64))
+
+    def _fill_matrix(self, matrix, travel_impedance_measure, statistic, from_stop_Is, to_stop_Is, chunk_size):
+        self._assert_valid_statistic(statistic)
+        if len(from_stop_Is) == 0 or len(to_stop_Is) == 0:
+            return
+        cur = self.conn.cursor()
+        cur.execute("SELECT from_stop_I, to_stop_I, " + statistic + " FROM " + travel_impedance_measure +
+                    " WHERE " + statistic + " IS NOT NULL")
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = numpy.array(rows, dtype=numpy.float64)
+            from_Is = chunk[:, 0].astype(numpy.int64)
+            to_Is = chunk[:, 1].astype(numpy.int64)
+            row_indices = numpy.minimum(numpy.searchsorted(from_stop_Is, from_Is), len(from_stop_Is) - 1)
+            col_indices = numpy.minimum(numpy.searchsorted(to_stop_Is, to_Is), len(to_stop_Is) - 1)
+            valid = (from_stop_Is[row_indices] == from_Is) & (to_stop_Is[col_indices] == to_Is)
+            matrix[row_indices[valid], col_indices[valid]] = chunk[valid, 2]
+
+    def _assert_valid_measure(self, travel_impedance_measure):
+        exists = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                   (travel_impedance_measure,)).fetchone()
+        if not exists:
+            raise ValueError("No travel impedance table for measure: %s" % travel_impedance_measure)
+
+    @staticmethod
+    def _assert_valid_statistic(statistic):
+        if statistic not in STATISTICS:
+            raise ValueError("statistic should be one of %s, got %s" % (str(STATISTICS), statistic))
+
+    @staticmethod
+    def _where_clause(from_stop_I, to_stop_I):
+        where_clauses = []
+        params = []
+        if from_stop_I is not None:
+            where_clauses.append("from_stop_I=?")
+            params.append(int(from_stop_I))
+        if to_stop_I is not None:
+            where_clauses.append("to_stop_I=?")
+            params.append(int(to_stop_I))
+        if not where_clauses:
+            return "", params
+        return " WHERE " + " AND ".join(where_clauses), params
+
     def create_table(self, travel_impedance_measure, ensure_uniqueness=True):
         print("Creating table: ", travel_impedance_measure)
         sql = "CREATE TABLE IF NOT EXISTS " + travel_impedance_measure + " (from_stop_I INT, " \
@@ -72,12 +194,17 @@ class TravelImpedanceDataStore:
         sql_from_to = "CREATE UNIQUE INDEX IF NOT EXISTS " + table + "_from_stop_I_to_stop_I ON " + table + " (from_stop_I, to_stop_I)" 
         sql_from = "CREATE INDEX IF NOT EXISTS " + table + "_from_stop_I ON " + table + " (from_stop_I)"
         sql_to = "CREATE INDEX IF NOT EXISTS " + table + "_to_stop_I ON " + table + " (to_stop_I)"
+        # covering index: matrix and dataframe reads are answered from the index alone
+        sql_covering = "CREATE INDEX IF NOT EXISTS " + table + "_covering ON " + table + \
+                       " (from_stop_I, to_stop_I, " + ", ".join(STATISTICS) + ")"
         print("Executing: " + sql_from_to)
         self.conn.execute(sql_from_to)
         print("Executing: " + sql_from)
         self.conn.execute(sql_from)
         print("Executing: " + sql_to)
         self.conn.execute(sql_to)
+        print("Executing: " + sql_covering)
+        self.conn.execute(sql_covering)
         self.conn.commit()
 
     def insert_data(self, travel_impedance_measure_name, data):
@@ -106,4 +233,23 @@ class TravelImpedanceDataStore:
         self.conn.execute("PRAGMA SYNCHRONOUS = OFF")
 
 
+def load_matrix(fname_prefix, mmap_mode="r"):
+    """
+    Load a travel impedance matrix written by TravelImpedanceDataStore.export_matrix.
+
+    Parameters
+    ----------
+    fname_prefix: str
+    mmap_mode: str, optional
+        passed to numpy.load, use None to read the whole matrix into memory
 
+    Returns
+    -------
+    matrix: numpy.ndarray | numpy.memmap
+    from_stop_Is: numpy.ndarray
+    to_stop_Is: numpy.ndarray
+    """
+    matrix = numpy.load(fname_prefix + ".npy", mmap_mode=mmap_mode)
+    from_stop_Is = numpy.load(fname_prefix + "_from_stop_I.npy")
+    to_stop_Is = numpy.load(fname_prefix + "_to_stop_I.npy")
+    return matrix, from_stop_Is, to_stop_Is
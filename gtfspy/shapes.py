@@ -461,3 +461,63 @@ def interpolate_shape_times(shape_distances, shape_breaks, stop_times):
     # deal final ones separately:
     shape_times[shape_breaks[-1]:] = stop_times[-1]
     return list(shape_times)
+
+
+def interpolate_shape_times_vectorized(shape_distances, shape_breaks, stop_times):
+    """
+    Interpolate passage times for the shape points between the first and the last shape break.
+    Gives the same result as interpolate_shape_times restricted to shape_breaks[0]...shape_breaks[-1],
+    but without a Python loop over the stops.
+
+    Parameters
+    ----------
+    shape_distances: list
+        list of cumulative distances along the shape
+    shape_breaks: list
+        list of shape_breaks
+    stop_times: list
+        list of stop_times
+
+    Returns
+    -------
+    result: tuple or None
+        (shape_times, first_break, last_break), where shape_times is a numpy array of the
+        interpolated times of shape points first_break...last_break.
+        None, if the interpolation is not possible (missing or inconsistent shape breaks or distances,
+        or two stops with different shape breaks at the same distance along the shape).
+    """
+    if len(shape_breaks) == 0 or len(shape_breaks) != len(stop_times):
+        return None
+    try:
+        breaks = np.array(shape_breaks, dtype=float)
+        distances = np.array(shape_distances, dtype=float)
+    except (TypeError, ValueError):
+        return None
+    if np.isnan(breaks).any():
+        return None
+    breaks = breaks.astype(int)
+    if breaks[0] < 0 or breaks[-1] >= len(distances) or (np.diff(breaks) < 0).any():
+        return None
+    stop_times = np.asarray(stop_times, dtype=float)
+    first_break = breaks[0]
+    last_break = breaks[-1]
+    point_indices = np.arange(first_break, last_break + 1)
+    point_distances = distances[first_break:last_break + 1]
+    if np.isnan(point_distances).any():
+        return None
+    # the last stop (in stop order) whose shape break is at or before each shape point:
+    segment = np.searchsorted(breaks, point_indices, side="right") - 1
+    shape_times = np.empty(len(point_indices))
+    at_end = segment >= len(breaks) - 1
+    shape_times[at_end] = stop_times[-1]
+    seg = segment[~at_end]
+    from_d = distances[breaks[seg]]
+    to_d = distances[breaks[seg + 1]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norm_distances = (point_distances[~at_end] - from_d) / (to_d - from_d)
+    shape_times[~at_end] = (1. - norm_distances) * stop_times[seg] + norm_distances * stop_times[seg + 1]
+    if not np.isfinite(shape_times).all():
+        # zero-length shape segments between stops (e.g. duplicated shape points)
+        return None
+    return shape_times, first_break, last_break
+
@@ -0,0 +1,357 @@
+from __future__ import absolute_import
+
+from collections import namedtuple
+from heapq import heappush, heappop
+from multiprocessing import Pool
+
+import numpy
+
+from gtfspy.gtfs import GTFS
+from gtfspy.route_types import WALK
+from gtfspy.spreading.spreader import get_infection_events_dataframe, infection_events_to_trips
+from gtfspy.util import EARTH_RADIUS
+
+# number of transit events converted from arrays to python lists at a time during spreading
+EVENT_BLOCK_SIZE = 4096
+
+# The infection event of each reached stop, as numpy arrays (seed stop first, then in the order of stop_I).
+# trip_I is -1 (WALK) for walking and for the seed stop.
+SpreadingResult = namedtuple('SpreadingResult',
+                             ['seed_stop_I', 'stop_I', 'arr_time_ut', 'dep_time_ut', 'from_stop_I', 'trip_I'])
+
+
+class FastSpreader(object):
+    """
+    Array-backed version of gtfspy.spreading.spreader.Spreader.
+
+    The transit events of the time window and the walking distances are loaded once, and can be used
+    for spreading from many seeds. Transit events are processed from arrays sorted by arrival time;
+    only the walking events created during the spreading go through a heap. The rules for infecting
+    stops (minimum transfer time, staying in the same vehicle) are the same as in Spreader.
+    """
+
+    def __init__(self, gtfs, start_time_ut, max_duration_ut, min_transfer_time=30, walk_speed=0.5):
+        """
+        Parameters
+        ----------
+        gtfs: GTFS
+        start_time_ut: number
+            Start time of the spreading.
+        max_duration_ut: int
+            maximum duration of the spreading process (in seconds)
+        min_transfer_time : int
+            minimum transfer time in seconds
+        walk_speed: float
+            walking speed in meters per second
+        """
+        self.gtfs = gtfs
+        self.start_time_ut = start_time_ut
+        self.max_duration_ut = max_duration_ut
+        self.min_transfer_time = min_transfer_time
+        self.walk_speed = walk_speed
+        self._load_stops()
+        self._load_events()
+        self._load_walk_network()
+
+    def _load_stops(self):
+        rows = numpy.array(self.gtfs.conn.execute("SELECT stop_I, lat, lon FROM stops").fetchall(),
+                           dtype=float).reshape(-1, 3)
+        self.stop_Is = rows[:, 0].astype(int)
+        self.stop_lats = rows[:, 1]
+        self.stop_lons = rows[:, 2]
+        self.n_stop_slots = int(self.stop_Is.max()) + 1 if len(self.stop_Is) else 0
+
+    def _load_events(self):
+        end_time_ut = self.start_time_ut + self.max_duration_ut
+        events = self.gtfs.get_transit_events(self.start_time_ut, end_time_ut)
+        arr = events['arr_time_ut'].values
+        dep = events['dep_time_ut'].values
+        from_stop = events['from_stop_I'].values
+        to_stop = events['to_stop_I'].values
+        trip = events['trip_I'].values
+        # same order as the tuples in the EventHeap of Spreader
+        order = numpy.lexsort((trip, to_stop, from_stop, dep, arr))
+        self.event_arr_time_ut = arr[order].astype(numpy.int64)
+        self.event_dep_time_ut = dep[order].astype(numpy.int64)
+        self.event_from_stop_I = from_stop[order].astype(numpy.int64)
+        self.event_to_stop_I = to_stop[order].astype(numpy.int64)
+        self.event_trip_I = trip[order].astype(numpy.int64)
+
+    def _load_walk_network(self):
+        """
+        Walking distances as compressed sparse row arrays: the neighbors of stop_I are
+        walk_to_stop_I[walk_indptr[stop_I]:walk_indptr[stop_I + 1]].
+        """
+        distances = self.gtfs.get_straight_line_transfer_distances()
+        from_stop_Is = distances['from_stop_I'].values.astype(int)
+        to_stop_Is = distances['to_stop_I'].values.astype(int)
+        n_slots = self.n_stop_slots
+        if len(from_stop_Is):
+            n_slots = max(n_slots, int(from_stop_Is.max()) + 1, int(to_stop_Is.max()) + 1)
+        order = numpy.argsort(from_stop_Is, kind="mergesort")
+        self.walk_indptr = numpy.r_[0, numpy.cumsum(numpy.bincount(from_stop_Is, minlength=n_slots))]
+        self.walk_to_stop_I = to_stop_Is[order]
+        self.walk_duration = (distances['d'].values[order] / float(self.walk_speed)).astype(int)
+
+    def _get_stop_distances(self, lat, lon):
+        d_lat = numpy.radians(self.stop_lats - lat)
+        d_lon = numpy.radians(self.stop_lons - lon)
+        a = (numpy.sin(d_lat / 2) ** 2 +
+             numpy.cos(numpy.radians(lat)) * numpy.cos(numpy.radians(self.stop_lats)) * numpy.sin(d_lon / 2) ** 2)
+        return EARTH_RADIUS * 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+    def get_closest_stop(self, lat, lon):
+        """
+        Same as GTFS.get_closest_stop, computed from the preloaded stop coordinates.
+        """
+        return int(self.stop_Is[numpy.argmin(self._get_stop_distances(lat, lon))])
+
+    def get_access_stops(self, lat, lon, max_access_distance):
+        """
+        Stops that can be walked to from (lat, lon).
+
+        Parameters
+        ----------
+        lat: float
+        lon: float
+        max_access_distance: float
+            in meters
+
+        Returns
+        -------
+        stop_Is: numpy.ndarray
+            the closest stop first, and then all other stops within max_access_distance
+        access_times: numpy.ndarray
+            walking times (seconds) to the stops
+        """
+        distances = self._get_stop_distances(lat, lon)
+        closest = numpy.argmin(distances)
+        others = numpy.flatnonzero(distances <= max_access_distance)
+        indices = numpy.r_[closest, others[others != closest]].astype(int)
+        return self.stop_Is[indices], (distances[indices] / float(self.walk_speed)).astype(int)
+
+    def spread(self, lat, lon, max_access_distance=None):
+        """
+        Spread from (lat, lon).
+
+        Parameters
+        ----------
+        lat: float
+        lon: float
+        max_access_distance: float, optional
+            By default (as in Spreader) the spreading starts from the closest stop at start_time_ut.
+            If given, the seed location is first walked from to the closest stop and to all stops within
+            max_access_distance meters.
+
+        Returns
+        -------
+        result: SpreadingResult
+        """
+        if max_access_distance is None:
+            return self.spread_from_stop(self.get_closest_stop(lat, lon))
+        stop_Is, access_times = self.get_access_stops(lat, lon, max_access_distance)
+        return self.spread_from_stop(stop_Is[0], access_time=access_times[0],
+                                     access_stop_Is=stop_Is[1:], access_times=access_times[1:])
+
+    def spread_from_stop(self, seed_stop_I, access_time=0, access_stop_Is=(), access_times=()):
+        """
+        Parameters
+        ----------
+        seed_stop_I: int
+        access_time: int, optional
+            time needed to reach the seed stop after the start of the spreading
+            (which is at start_time_ut - 1, as in Spreader)
+        access_stop_Is: list, optional
+            other stops reached by walking from the seed location
+        access_times: list, optional
+            walking times to access_stop_Is after the start of the spreading (each at least access_time)
+
+        Returns
+        -------
+        result: SpreadingResult
+        """
+        n_slots = len(self.walk_indptr) - 1
+        min_transfer_time = self.min_transfer_time
+        end_time_ut = self.start_time_ut + self.max_duration_ut
+        walk_indptr = self.walk_indptr
+        walk_to_stop_I = self.walk_to_stop_I
+        walk_duration = self.walk_duration
+
+        # per-stop state: the earliest visit (infection event) of each stop
+        min_arr = numpy.full(n_slots, numpy.inf)
+        min_dep = numpy.zeros(n_slots, dtype=int)
+        min_from = numpy.full(n_slots, -1, dtype=int)
+        min_trip = numpy.full(n_slots, WALK, dtype=int)
+        # stop where each trip has last visited a stop (for staying in the same vehicle)
+        trip_at_stop = {}
+        infected = numpy.zeros(n_slots, dtype=bool)
+        is_stop = numpy.zeros(n_slots, dtype=bool)
+        is_stop[self.stop_Is] = True
+        n_uninfected = int(is_stop.sum())
+
+        walk_heap = []
+
+        def visit(arr, dep, from_stop, to_stop, trip):
+            if arr <= min_arr[to_stop] + min_transfer_time:
+                if arr < min_arr[to_stop]:
+                    min_arr[to_stop] = arr
+                    min_dep[to_stop] = dep
+                    min_from[to_stop] = from_stop
+                    min_trip[to_stop] = trip
+                if trip != WALK:
+                    trip_at_stop[trip] = to_stop
+
+        def infect(stop_I, arr):
+            infected[stop_I] = True
+            for i in range(walk_indptr[stop_I], walk_indptr[stop_I + 1]):
+                neighbor = walk_to_stop_I[i]
+                if infected[neighbor] or not is_stop[neighbor]:
+                    continue
+                walk_arr = arr + walk_duration[i]
+                if walk_arr > end_time_ut:
+                    continue
+                heappush(walk_heap, (int(walk_arr), int(arr), int(stop_I), int(neighbor), WALK))
+
+        seed_time = self.start_time_ut - 1 + access_time
+        start_event = (seed_time, seed_time, seed_stop_I, seed_stop_I, WALK)
+        visit(*start_event)
+        infect(seed_stop_I, start_event[0])
+        n_uninfected -= 1
+        heappush(walk_heap, start_event)
+        for stop_I, stop_access_time in zip(access_stop_Is, access_times):
+            heappush(walk_heap, (int(self.start_time_ut - 1 + stop_access_time), seed_time, int(seed_stop_I),
+                                 int(stop_I), WALK))
+
+        # The sorted event arrays are read in blocks converted to python lists (for fast element access):
+        # most spreadings infect all stops long before the last event.
+        n_events = len(self.event_arr_time_ut)
+        block_end = 0
+        n_block = 0
+        j = 0
+        while n_uninfected > 0:
+            if j == n_block and block_end < n_events:
+                block_start, block_end = block_end, min(block_end + EVENT_BLOCK_SIZE, n_events)
+                event_arr = self.event_arr_time_ut[block_start:block_end].tolist()
+                event_dep = self.event_dep_time_ut[block_start:block_end].tolist()
+                event_from = self.event_from_stop_I[block_start:block_end].tolist()
+                event_to = self.event_to_stop_I[block_start:block_end].tolist()
+                event_trip = self.event_trip_I[block_start:block_end].tolist()
+                n_block = block_end - block_start
+                j = 0
+            # take the next event from the walk heap or from the transit events, whichever is smaller
+            if j < n_block:
+                arr = event_arr[j]
+                if walk_heap and (walk_heap[0][0] < arr or (
+                        walk_heap[0][0] == arr and
+                        walk_heap[0] <= (arr, event_dep[j], event_from[j], event_to[j], event_trip[j]))):
+                    arr, dep, from_stop, to_stop, trip = heappop(walk_heap)
+                else:
+                    dep = event_dep[j]
+                    from_stop = event_from[j]
+                    to_stop = event_to[j]
+                    trip = event_trip[j]
+                    j += 1
+            elif walk_heap:
+                arr, dep, from_stop, to_stop, trip = heappop(walk_heap)
+            else:
+                break
+            if arr > end_time_ut:
+                break
+            if not infected[from_stop]:
+                continue
+            # can the event be used for spreading from from_stop:
+            time_sep = dep - min_arr[from_stop]
+            if not ((time_sep >= min_transfer_time) or
+                    (time_sep >= 0 and (trip == WALK or trip_at_stop.get(trip) == from_stop))):
+                continue
+            already_visited = infected[to_stop]
+            visit(arr, dep, from_stop, to_stop, trip)
+            if not already_visited:
+                infect(to_stop, arr)
+                n_uninfected -= 1
+
+        stop_Is = numpy.flatnonzero(infected)
+        # seed stop first
+        stop_Is = numpy.r_[seed_stop_I, stop_Is[stop_Is != seed_stop_I]].astype(int)
+        return SpreadingResult(seed_stop_I=seed_stop_I,
+                               stop_I=stop_Is,
+                               arr_time_ut=min_arr[stop_Is].astype(int),
+                               dep_time_ut=min_dep[stop_Is],
+                               from_stop_I=min_from[stop_Is],
+                               trip_I=min_trip[stop_Is])
+
+    def get_infection_events(self, result):
+        """
+        Parameters
+        ----------
+        result: SpreadingResult
+
+        Returns
+        -------
+        infection_events: pandas.DataFrame
+            see gtfspy.spreading.spreader.get_infection_events_dataframe
+        """
+        return get_infection_events_dataframe(self.gtfs, result.stop_I, result.arr_time_ut, result.dep_time_ut,
+                                              result.from_stop_I, result.trip_I)
+
+    def get_shortest_path_trips(self, result):
+        """
+        Convert a spreading result to the format of Spreader.spread() / Spreader._get_shortest_path_trips.
+
+        Parameters
+        ----------
+        result: SpreadingResult
+
+        Returns
+        -------
+        trips: dict
+        """
+        return infection_events_to_trips(self.get_infection_events(result))
+
+
+_worker_spreader = None
+
+
+def _init_worker(gtfs_fname, start_time_ut, max_duration_ut, min_transfer_time, walk_speed):
+    global _worker_spreader
+    _worker_spreader = FastSpreader(GTFS(gtfs_fname), start_time_ut, max_duration_ut,
+                                    min_transfer_time=min_transfer_time, walk_speed=walk_speed)
+
+
+def _spread_in_worker(seed):
+    lat, lon = seed
+    return _worker_spreader.spread(lat, lon)
+
+
+def spread_many(gtfs_fname, start_time_ut, seeds, max_duration_ut, min_transfer_time=30, walk_speed=0.5,
+                n_processes=None, chunksize=1):
+    """
+    Spread from many seed locations in parallel; each worker process loads the events only once.
+
+    Parameters
+    ----------
+    gtfs_fname: str
+        path to the gtfs database
+    start_time_ut: number
+    seeds: list
+        of (lat, lon) tuples
+    max_duration_ut: int
+    min_transfer_time: int
+    walk_speed: float
+    n_processes: int, optional
+        number of worker processes, defaults to the number of cpus
+    chunksize: int
+        number of seeds sent to a worker at a time
+
+    Returns
+    -------
+    results: list
+        of SpreadingResult, in the order of seeds
+    """
+    init_args = (gtfs_fname, start_time_ut, max_duration_ut, min_transfer_time, walk_speed)
+    pool = Pool(n_processes, initializer=_init_worker, initargs=init_args)
+    try:
+        return pool.map(_spread_in_worker, list(seeds), chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,173 @@
+from __future__ import absolute_import
+
+from multiprocessing import Pool
+
+import numpy
+
+from gtfspy.geometry import compute_buffered_area_of_stops
+from gtfspy.gtfs import GTFS
+from gtfspy.spreading import fast_spreader
+
+_worker_stop_Is = None
+_worker_max_access_distance = None
+
+
+def _init_worker(gtfs_fname, start_time_ut, max_duration_ut, min_transfer_time, walk_speed, max_access_distance):
+    global _worker_stop_Is, _worker_max_access_distance
+    fast_spreader._init_worker(gtfs_fname, start_time_ut, max_duration_ut, min_transfer_time, walk_speed)
+    _worker_stop_Is = numpy.sort(fast_spreader._worker_spreader.stop_Is)
+    _worker_max_access_distance = max_access_distance
+
+
+def _travel_times_in_worker(args):
+    seed_index, (lat, lon) = args
+    spreader = fast_spreader._worker_spreader
+    result = spreader.spread(lat, lon, max_access_distance=_worker_max_access_distance)
+    return seed_index, travel_times_of_result(result, _worker_stop_Is, spreader.start_time_ut)
+
+
+def travel_times_of_result(result, stop_Is, start_time_ut):
+    """
+    Parameters
+    ----------
+    result: gtfspy.spreading.fast_spreader.SpreadingResult
+    stop_Is: numpy.ndarray
+        sorted stop_Is
+    start_time_ut: int
+
+    Returns
+    -------
+    travel_times: numpy.ndarray
+        travel time to each of stop_Is, inf for stops not reached.
+        As in Spreader, the spreading starts from the seed stop at start_time_ut - 1, and travel times are
+        measured from that moment: the seed stop has travel time 0 (or its access time), and a stop
+        walked to has its exact walking time.
+    """
+    travel_times = numpy.full(len(stop_Is), numpy.inf)
+    columns = numpy.searchsorted(stop_Is, result.stop_I)
+    travel_times[columns] = result.arr_time_ut - (start_time_ut - 1)
+    return travel_times
+
+
+def compute_travel_time_matrix(gtfs_fname,
+                               start_time_ut,
+                               seeds,
+                               max_duration_ut,
+                               fname_prefix=None,
+                               min_transfer_time=30,
+                               walk_speed=0.5,
+                               max_access_distance=None,
+                               n_processes=None,
+                               chunksize=16,
+                               dtype=numpy.float32):
+    """
+    Compute earliest-arrival travel times from many seed locations to all stops.
+
+    The transit events are loaded once per worker process (see FastSpreader), and each seed is spread from
+    in one of the worker processes.
+
+    Parameters
+    ----------
+    gtfs_fname: str
+        path to the gtfs database
+    start_time_ut: int
+    seeds: list
+        of (lat, lon) tuples
+    max_duration_ut: int
+        stops not reached within max_duration_ut have travel time inf
+    fname_prefix: str, optional
+        If given, the matrix is written to a memory-mapped file fname_prefix + ".npy"
+        (and the stop_Is of the columns to fname_prefix + "_stop_I.npy"), see load_travel_time_matrix.
+    min_transfer_time: int
+    walk_speed: float
+    max_access_distance: float, optional
+        see FastSpreader.spread
+    n_processes: int, optional
+        number of worker processes, defaults to the number of cpus; 1 computes in the calling process
+    chunksize: int
+        number of seeds sent to a worker at a time
+    dtype: numpy.dtype
+
+    Returns
+    -------
+    matrix: numpy.ndarray | numpy.memmap
+        (seed x stop) travel times in seconds
+    stop_Is: numpy.ndarray
+        stop_I of each column
+    """
+    seeds = list(seeds)
+    G = GTFS(gtfs_fname)
+    stop_Is = numpy.sort(numpy.array([row[0] for row in G.conn.execute("SELECT stop_I FROM stops")], dtype=int))
+    del G
+    shape = (len(seeds), len(stop_Is))
+    if fname_prefix is None:
+        matrix = numpy.empty(shape, dtype=dtype)
+    else:
+        matrix = numpy.lib.format.open_memmap(fname_prefix + ".npy", mode="w+", dtype=dtype, shape=shape)
+        numpy.save(fname_prefix + "_stop_I.npy", stop_Is)
+
+    init_args = (gtfs_fname, start_time_ut, max_duration_ut, min_transfer_time, walk_speed, max_access_distance)
+    if n_processes == 1:
+        _init_worker(*init_args)
+        for seed_index, seed in enumerate(seeds):
+            matrix[seed_index] = _travel_times_in_worker((seed_index, seed))[1]
+    else:
+        pool = Pool(n_processes, initializer=_init_worker, initargs=init_args)
+        try:
+            for seed_index, travel_times in pool.imap_unordered(_travel_times_in_worker, enumerate(seeds),
+                                                                chunksize=chunksize):
+                matrix[seed_index] = travel_times
+        finally:
+            pool.close()
+            pool.join()
+    if fname_prefix is not None:
+        matrix.flush()
+    return matrix, stop_Is
+
+
+def load_travel_time_matrix(fname_prefix, mmap_mode="r"):
+    """
+    Load a travel time matrix written by compute_travel_time_matrix.
+
+    Returns
+    -------
+    matrix: numpy.ndarray | numpy.memmap
+    stop_Is: numpy.ndarray
+    """
+    matrix = numpy.load(fname_prefix + ".npy", mmap_mode=mmap_mode)
+    stop_Is = numpy.load(fname_prefix + "_stop_I.npy")
+    return matrix, stop_Is
+
+
+def compute_isochrone_areas(gtfs, matrix, stop_Is, cutoffs, buffer_meters, resolution=16):
+    """
+    Area covered by the stops reached within each cutoff time, each stop buffered with buffer_meters
+    (see geometry.compute_buffered_area_of_stops).
+
+    Parameters
+    ----------
+    gtfs: GTFS
+    matrix: numpy.ndarray
+        (seed x stop) travel times, see compute_travel_time_matrix
+    stop_Is: numpy.ndarray
+        stop_I of each column
+    cutoffs: list
+        of travel times in seconds
+    buffer_meters: float
+    resolution: int
+
+    Returns
+    -------
+    areas: numpy.ndarray
+        (seed x cutoff) areas in square meters
+    """
+    lats, lons = gtfs.get_stop_coordinates_of_stop_Is(stop_Is)
+    areas = numpy.zeros((len(matrix), len(cutoffs)))
+    for seed_index in range(len(matrix)):
+        travel_times = numpy.asarray(matrix[seed_index])
+        for cutoff_index, cutoff in enumerate(cutoffs):
+            reached = travel_times <= cutoff
+            if reached.any():
+                areas[seed_index, cutoff_index] = compute_buffered_area_of_stops(lats[reached], lons[reached],
+                                                                                 buffer_meters, resolution)
+    return areas
@@ -4,6 +4,7 @@ import numpy
 import pandas as pd
 
 from gtfspy.gtfs import GTFS
+from gtfspy.route_types import WALK
 from .event import Event
 from .heap import EventHeap
 from .spreading_stop import SpreadingStop
@@ -148,41 +149,118 @@ class Spreader(object):
                 el['route_type'] : type of vehicle as specified by GTFS (and -1 for walking)
                 el['name'] : name of the route
         """
-        if not self._has_run:
-            raise RuntimeError("This spreader object has not run yet. Can not return any trips.")
-        # create new transfer events and add them to the heap (=queue)
-        inf_times = [[stop_I, el.get_min_visit_time() - self.start_time_ut]
-                     for stop_I, el in self._stop_I_to_spreading_stop.items()]
-        inf_times = numpy.array(inf_times)
-        inf_time_data = pd.DataFrame(inf_times, columns=["stop_I", "inf_time_ut"])
-        stop_data = self.gtfs.stops()
+        return infection_events_to_trips(self.get_infection_events())
 
-        combined = inf_time_data.merge(stop_data, how='inner', on='stop_I', suffixes=('_infs', '_stops'), copy=True)
+    def get_infection_events(self):
+        """
+        Get the event that first infected (reached) each stop, in columnar form.
 
-        trips = []
+        Returns
+        -------
+        infection_events: pandas.DataFrame
+            see get_infection_events_dataframe
+        """
+        if not self._has_run:
+            raise RuntimeError("This spreader object has not run yet. Can not return any trips.")
+        min_events = []
         for stop_I, dest_stop_obj in self._stop_I_to_spreading_stop.items():
             inf_event = dest_stop_obj.get_min_event()
-            if inf_event is None:
-                continue
-            dep_stop_I = inf_event.from_stop_I
-            dep_lat = float(combined[combined['stop_I'] == dep_stop_I]['lat'].values)
-            dep_lon = float(combined[combined['stop_I'] == dep_stop_I]['lon'].values)
-
-            dest_lat = float(combined[combined['stop_I'] == stop_I]['lat'].values)
-            dest_lon = float(combined[combined['stop_I'] == stop_I]['lon'].values)
-
-            if inf_event.trip_I == -1:
-                name = "walk"
-                rtype = -1
-            else:
-                name, rtype = self.gtfs.get_route_name_and_type_of_tripI(inf_event.trip_I)
-
-            trip = {
-                "lats"      : [dep_lat, dest_lat],
-                "lons"      : [dep_lon, dest_lon],
-                "times"     : [inf_event.dep_time_ut, inf_event.arr_time_ut],
-                "name"      : name,
-                "route_type": rtype
-            }
-            trips.append(trip)
-        return {"trips": trips}
+            if inf_event is not None:
+                min_events.append(inf_event)
+        columns = ['arr_time_ut', 'dep_time_ut', 'from_stop_I', 'to_stop_I', 'trip_I']
+        events = pd.DataFrame.from_records(min_events, columns=columns)
+        return get_infection_events_dataframe(self.gtfs,
+                                              events['to_stop_I'].values,
+                                              events['arr_time_ut'].values,
+                                              events['dep_time_ut'].values,
+                                              events['from_stop_I'].values,
+                                              events['trip_I'].values)
+
+    def get_shortest_path_geojson(self):
+        """
+        Returns
+        -------
+        geojson: dict
+            a FeatureCollection with one LineString per infected stop
+        """
+        return infection_events_to_geojson(self.get_infection_events())
+
+
+def get_infection_events_dataframe(gtfs, stop_Is, arr_times_ut, dep_times_ut, from_stop_Is, trip_Is):
+    """
+    Join infection events with the coordinates of their stops and with route data.
+
+    Parameters
+    ----------
+    gtfs: GTFS
+    stop_Is, arr_times_ut, dep_times_ut, from_stop_Is, trip_Is: array-like
+        the infection event of each infected stop (trip_I is -1 for walking)
+
+    Returns
+    -------
+    infection_events: pandas.DataFrame
+        with columns stop_I, from_stop_I, dep_time_ut, arr_time_ut, trip_I,
+        dep_lat, dep_lon, lat, lon, name ("walk" for walking), and route_type (-1 for walking),
+        in the order of the input
+    """
+    events = pd.DataFrame({"stop_I": numpy.asarray(stop_Is, dtype=int),
+                           "from_stop_I": numpy.asarray(from_stop_Is, dtype=int),
+                           "dep_time_ut": numpy.asarray(dep_times_ut),
+                           "arr_time_ut": numpy.asarray(arr_times_ut),
+                           "trip_I": numpy.asarray(trip_Is, dtype=int)})
+    stops = gtfs.execute_custom_query_pandas("SELECT stop_I, lat, lon FROM stops")
+    routes = gtfs.execute_custom_query_pandas("SELECT trip_I, routes.name AS name, routes.type AS route_type "
+                                              "FROM trips JOIN routes USING(route_I)")
+    events = events.merge(stops.rename(columns={"stop_I": "from_stop_I", "lat": "dep_lat", "lon": "dep_lon"}),
+                          on="from_stop_I", how="left")
+    events = events.merge(stops, on="stop_I", how="left")
+    events = events.merge(routes, on="trip_I", how="left")
+    is_walk = (events["trip_I"] == WALK).values
+    events["name"] = numpy.where(is_walk, "walk", events["name"].fillna("").astype(str))
+    events["route_type"] = numpy.where(is_walk, WALK, events["route_type"].fillna(WALK)).astype(int)
+    return events
+
+
+def infection_events_to_trips(infection_events):
+    """
+    Convert infection events (see get_infection_events_dataframe) to the format of Spreader.spread().
+
+    Returns
+    -------
+    trips: dict
+    """
+    columns = ["dep_lat", "lat", "dep_lon", "lon", "dep_time_ut", "arr_time_ut", "name", "route_type"]
+    trips = []
+    for dep_lat, lat, dep_lon, lon, dep_time, arr_time, name, route_type in \
+            zip(*[infection_events[column].tolist() for column in columns]):
+        trips.append({
+            "lats"      : [dep_lat, lat],
+            "lons"      : [dep_lon, lon],
+            "times"     : [dep_time, arr_time],
+            "name"      : name,
+            "route_type": route_type
+        })
+    return {"trips": trips}
+
+
+def infection_events_to_geojson(infection_events):
+    """
+    Convert infection events (see get_infection_events_dataframe) to a GeoJSON FeatureCollection.
+
+    Returns
+    -------
+    geojson: dict
+    """
+    features = []
+    for trip in infection_events_to_trips(infection_events)["trips"]:
+        features.append({"type": "Feature",
+                         "geometry": {
+                             "type": "LineString",
+                             "coordinates": list(zip(trip["lons"], trip["lats"]))
+                         },
+                         "properties": {
+                             "name": trip["name"],
+                             "route_type": trip["route_type"],
+                             "times": trip["times"]
+                         }})
+    return {"type": "FeatureCollection", "features": features}
@@ -6,9 +6,12 @@ import pandas as pd
 import numpy
 import sys
 import os
+import sqlite3
+import time
+from contextlib import contextmanager
 
-from gtfspy.gtfs import GTFS
-from gtfspy.util import wgs84_distance
+from gtfspy.gtfs import GTFS, DATA_VERSION_KEY
+from gtfspy.util import wgs84_distance, wgs84_distances
 
 
 def get_spatial_bounds(gtfs, as_dict=False):
@@ -130,13 +133,20 @@ def write_stats_as_csv(gtfs, path_to_csv, re_write=False):
         statswriter.writerow(row_to_write)
 
 
-def get_stats(gtfs):
+def get_stats(gtfs, timings=None):
     """
     Get basic statistics of the GTFS data.
 
+    Each of the (small) base tables is read once, and all counters and distributions
+    of its columns are computed from that single read. Date-level statistics
+    are computed from one aggregate over the days table.
+
     Parameters
     ----------
     gtfs: GTFS
+    timings: dict, optional
+        If given, the wall-clock time (in seconds) spent on each group of statistics
+        is stored into this dict, keyed by the name of the group. Useful for profiling.
 
     Returns
     -------
@@ -146,105 +156,163 @@ def get_stats(gtfs):
         (but not a list)
     """
     stats = {}
-    # Basic table counts
-    for table in ['agencies', 'routes', 'stops', 'stop_times', 'trips', 'calendar', 'shapes', 'calendar_dates',
-                  'days', 'stop_distances', 'frequencies', 'feed_info', 'transfers']:
-        stats["n_" + table] = gtfs.get_row_count(table)
+    if timings is None:
+        timings = {}
+    cur = gtfs.conn.cursor()
+
+    # Basic table counts for the tables that are not otherwise read
+    with _timed(timings, 'row_counts'):
+        for table in ['stop_times', 'trips', 'calendar', 'shapes', 'stop_distances', 'feed_info']:
+            stats["n_" + table] = gtfs.get_row_count(table)
 
     # Agency names
-    agencies = gtfs.get_table("agencies")
-    stats["agencies"] = "_".join(agencies['name'].values)
+    with _timed(timings, 'agencies'):
+        names, langs = _fetch_columns(cur, 'agencies', ['name', 'lang'])
+        stats["n_agencies"] = len(names)
+        stats["agencies"] = "_".join(names)
+        stats['agencies__lang__dist'] = _value_distribution(langs)
 
     # Stop lat/lon range
-    stops = gtfs.get_table("stops")
-    lats = stops['lat'].values
-    lons = stops['lon'].values
-    percentiles = [0, 10, 50, 90, 100]
-
-    try:
-        lat_percentiles = numpy.percentile(lats, percentiles)
-    except IndexError:
-        lat_percentiles = [None] * 5
-    lat_min, lat_10, lat_median, lat_90, lat_max = lat_percentiles
-    stats["lat_min"] = lat_min
-    stats["lat_10"] = lat_10
-    stats["lat_median"] = lat_median
-    stats["lat_90"] = lat_90
-    stats["lat_max"] = lat_max
-
-    try:
-        lon_percentiles = numpy.percentile(lons, percentiles)
-    except IndexError:
-        lon_percentiles = [None] * 5
-    lon_min, lon_10, lon_median, lon_90, lon_max = lon_percentiles
-    stats["lon_min"] = lon_min
-    stats["lon_10"] = lon_10
-    stats["lon_median"] = lon_median
-    stats["lon_90"] = lon_90
-    stats["lon_max"] = lon_max
-
-    if len(lats) > 0:
-        stats["height_km"] = wgs84_distance(lat_min, lon_median, lat_max, lon_median) / 1000.
-        stats["width_km"] = wgs84_distance(lon_min, lat_median, lon_max, lat_median) / 1000.
-    else:
-        stats["height_km"] = None
-        stats["width_km"] = None
+    with _timed(timings, 'stops'):
+        lats, lons, location_types = _fetch_columns(cur, 'stops', ['lat', 'lon', 'location_type'])
+        stats["n_stops"] = len(lats)
+        stats['stops__location_type__dist'] = _value_distribution(location_types)
+        percentiles = [0, 10, 50, 90, 100]
+
+        try:
+            lat_percentiles = numpy.percentile(numpy.array(lats, dtype=float), percentiles)
+        except IndexError:
+            lat_percentiles = [None] * 5
+        lat_min, lat_10, lat_median, lat_90, lat_max = lat_percentiles
+        stats["lat_min"] = lat_min
+        stats["lat_10"] = lat_10
+        stats["lat_median"] = lat_median
+        stats["lat_90"] = lat_90
+        stats["lat_max"] = lat_max
+
+        try:
+            lon_percentiles = numpy.percentile(numpy.array(lons, dtype=float), percentiles)
+        except IndexError:
+            lon_percentiles = [None] * 5
+        lon_min, lon_10, lon_median, lon_90, lon_max = lon_percentiles
+        stats["lon_min"] = lon_min
+        stats["lon_10"] = lon_10
+        stats["lon_median"] = lon_median
+        stats["lon_90"] = lon_90
+        stats["lon_max"] = lon_max
+
+        if len(lats) > 0:
+            stats["height_km"] = wgs84_distance(lat_min, lon_median, lat_max, lon_median) / 1000.
+            stats["width_km"] = wgs84_distance(lon_min, lat_median, lon_max, lat_median) / 1000.
+        else:
+            stats["height_km"] = None
+            stats["width_km"] = None
 
-    first_day_start_ut, last_day_start_ut = gtfs.get_day_start_ut_span()
-    stats["start_time_ut"] = first_day_start_ut
-    if last_day_start_ut is None:
-        stats["end_time_ut"] = None
-    else:
-        # 28 (instead of 24) comes from the GTFS stANDard
-        stats["end_time_ut"] = last_day_start_ut + 28 * 3600
-
-    stats["start_date"] = gtfs.get_min_date()
-    stats["end_date"] = gtfs.get_max_date()
-
-    # Maximum activity day
-    max_activity_date = gtfs.execute_custom_query(
-        'SELECT count(*), date '
-        'FROM days '
-        'GROUP BY date '
-        'ORDER BY count(*) DESC, date '
-        'LIMIT 1;').fetchone()
-    if max_activity_date:
-        stats["max_activity_date"] = max_activity_date[1]
-        max_activity_hour = gtfs.get_cursor().execute(
-            'SELECT count(*), arr_time_hour FROM day_stop_times '
-            'WHERE date=? GROUP BY arr_time_hour '
-            'ORDER BY count(*) DESC;', (stats["max_activity_date"],)).fetchone()
-        if max_activity_hour:
-            stats["max_activity_hour"] = max_activity_hour[1]
+    # Compute simple distributions of various columns that have a finite range of values.
+    # (agencies.lang and stops.location_type are computed above along with the other stats of those tables)
+    with _timed(timings, 'distributions'):
+        for table, column in [('routes', 'type'),
+                              ('calendar_dates', 'exception_type'),
+                              ('frequencies', 'exact_times'),
+                              ('transfers', 'transfer_type')]:
+            values, = _fetch_columns(cur, table, [column])
+            stats["n_" + table] = len(values)
+            stats[table + '__' + column + '__dist'] = _value_distribution(values)
+
+    # Date level statistics, all based on the number of trips per date
+    with _timed(timings, 'days'):
+        rows = cur.execute('SELECT date, count(*) FROM days GROUP BY date ORDER BY date').fetchall()
+        dates = [row[0] for row in rows]
+        trips_per_date = numpy.array([row[1] for row in rows], dtype=int)
+        stats["n_days"] = int(trips_per_date.sum())
+        # min and max as separate queries so that both can use the index on day_start_ut
+        first_day_start_ut = cur.execute('SELECT min(day_start_ut) FROM days').fetchone()[0]
+        last_day_start_ut = cur.execute('SELECT max(day_start_ut) FROM days').fetchone()[0]
+        stats["start_time_ut"] = first_day_start_ut
+        if last_day_start_ut is None:
+            stats["end_time_ut"] = None
         else:
-            stats["max_activity_hour"] = None
+            # 28 (instead of 24) comes from the GTFS stANDard
+            stats["end_time_ut"] = last_day_start_ut + 28 * 3600
+        stats["start_date"] = dates[0] if dates else None
+        stats["end_date"] = dates[-1] if dates else None
+        # Maximum activity day (ties are resolved by taking the earliest date)
+        max_activity_date = dates[int(numpy.argmax(trips_per_date))] if dates else None
+
+    # Maximum activity hour
+    max_activity_hour = None
+    if max_activity_date:
+        stats["max_activity_date"] = max_activity_date
+        with _timed(timings, 'max_activity_hour'):
+            max_activity_hour = _max_activity_hour(cur, max_activity_date)
+            stats["max_activity_hour"] = max_activity_hour
 
     # Fleet size estimate: considering each line separately
-    if max_activity_date and max_activity_hour:
-        fleet_size_estimates = _fleet_size_estimate(gtfs, stats['max_activity_hour'], stats['max_activity_date'])
-        stats.update(fleet_size_estimates)
+    if max_activity_date and max_activity_hour is not None:
+        with _timed(timings, 'fleet_size'):
+            fleet_size_estimates = _fleet_size_estimate(gtfs, stats['max_activity_hour'], stats['max_activity_date'])
+            stats.update(fleet_size_estimates)
 
-    # Compute simple distributions of various columns that have a finite range of values.
-    # Commented lines refer to values that are not imported yet, ?
-
-    stats['routes__type__dist'] = _distribution(gtfs, 'routes', 'type')
-    # stats['stop_times__pickup_type__dist'] = _distribution(gtfs, 'stop_times', 'pickup_type')
-    # stats['stop_times__drop_off_type__dist'] = _distribution(gtfs, 'stop_times', 'drop_off_type')
-    # stats['stop_times__timepoint__dist'] = _distribution(gtfs, 'stop_times', 'timepoint')
-    stats['calendar_dates__exception_type__dist'] = _distribution(gtfs, 'calendar_dates', 'exception_type')
-    stats['frequencies__exact_times__dist'] = _distribution(gtfs, 'frequencies', 'exact_times')
-    stats['transfers__transfer_type__dist'] = _distribution(gtfs, 'transfers', 'transfer_type')
-    stats['agencies__lang__dist'] = _distribution(gtfs, 'agencies', 'lang')
-    stats['stops__location_type__dist'] = _distribution(gtfs, 'stops', 'location_type')
-    # stats['stops__wheelchair_boarding__dist'] = _distribution(gtfs, 'stops', 'wheelchair_boarding')
-    # stats['trips__wheelchair_accessible__dist'] = _distribution(gtfs, 'trips', 'wheelchair_accessible')
-    # stats['trips__bikes_allowed__dist'] = _distribution(gtfs, 'trips', 'bikes_allowed')
-    # stats[''] = _distribution(gtfs, '', '')
-    stats = _feed_calendar_span(gtfs, stats)
+    with _timed(timings, 'feed_calendar_span'):
+        stats = _feed_calendar_span(gtfs, stats)
 
     return stats
 
 
+@contextmanager
+def _timed(timings, name):
+    """Store the wall-clock time spent in the with-block into timings[name]."""
+    start = time.time()
+    yield
+    timings[name] = time.time() - start
+
+
+def _fetch_columns(cur, table, columns):
+    """Read columns of a table with one query and return them as a list of tuples (one per column)."""
+    rows = cur.execute('SELECT {columns} FROM {table}'.format(columns=", ".join(columns), table=table)).fetchall()
+    if not rows:
+        return [()] * len(columns)
+    return list(zip(*rows))
+
+
+def _value_distribution(values):
+    """Count occurrences of values AND return it as a string.
+
+    The output is the same as that of _distribution: NULL values (if any) first,
+    then the values in increasing order.
+
+    Example return value:   '1:5 2:15'"""
+    n_null = sum(1 for value in values if value is None)
+    parts = ['None:%s' % n_null] if n_null else []
+    non_null = [value for value in values if value is not None]
+    if non_null:
+        unique_values, counts = numpy.unique(numpy.array(non_null), return_counts=True)
+        parts.extend('%s:%s' % (v, c) for v, c in zip(unique_values.tolist(), counts.tolist()))
+    return ' '.join(parts)
+
+
+def _max_activity_hour(cur, date):
+    """
+    The hour with the most stop time events on the given date.
+    Stop times without an arrival time are not counted.
+    Ties are resolved by taking the latest hour, as SQLite does when sorting the hours by count.
+
+    Instead of the day_stop_times view (days x trips x stop_times), only the
+    trips running on that date are looked up from day_trips2, and the stop times
+    of those trips are then fetched using the trip_I index of stop_times.
+    """
+    rows = cur.execute('SELECT arr_time_hour, count(*) '
+                       'FROM day_trips2 CROSS JOIN stop_times USING (trip_I) '
+                       'WHERE day_trips2.date=? AND arr_time_hour IS NOT NULL '
+                       'GROUP BY arr_time_hour', (date,)).fetchall()
+    if not rows:
+        return None
+    hours = numpy.array([int(row[0]) for row in rows])
+    counts = numpy.array([row[1] for row in rows])
+    order = numpy.argsort(-hours, kind="stable")
+    return hours[order][int(numpy.argmax(counts[order]))].item()
+
+
 def _distribution(gtfs, table, column):
     """Count occurrences of values AND return it as a string.
 
@@ -324,21 +392,26 @@ def _fleet_size_estimate(gtfs, hour, date):
     fleet_size_list = []
     fleet_size_dict = {}
     if hour:
-        for minute in range(hour * 3600, (hour + 1) * 3600, 60):
-            rows = gtfs.conn.cursor().execute(
-                'SELECT type, count(*) '
-                'FROM trips, routes, days '
-                'WHERE trips.route_I = routes.route_I '
-                'AND trips.trip_I=days.trip_I '
-                'AND start_time_ds <= ? '
-                'AND end_time_ds > ? + 60 '
-                'AND date = ? '
-                'GROUP BY type;',
-                (minute, minute, date))
-
-            for row in rows:
-                if fleet_size_dict.get(row[0], 0) < row[1]:
-                    fleet_size_dict[row[0]] = row[1]
+        rows = gtfs.conn.cursor().execute(
+            'SELECT type, start_time_ds, end_time_ds '
+            'FROM trips, routes, days '
+            'WHERE trips.route_I = routes.route_I '
+            'AND trips.trip_I=days.trip_I '
+            'AND date = ?;', (date,)).fetchall()
+        if rows:
+            types = numpy.array([row[0] for row in rows])
+            start_times = numpy.array([row[1] for row in rows], dtype=float)
+            end_times = numpy.array([row[2] for row in rows], dtype=float)
+            minutes = numpy.arange(hour * 3600, (hour + 1) * 3600, 60)[:, None]
+            # moving[i, j]: trip j is in movement during the whole minute i
+            moving = (start_times[None, :] <= minutes) & (end_times[None, :] > minutes + 60)
+            n_moving_by_type = {route_type: moving[:, types == route_type].sum(axis=1)
+                                for route_type in numpy.unique(types).tolist()}
+            # types are listed in the order they are first seen in movement
+            first_minutes = {route_type: numpy.flatnonzero(n_moving)[0]
+                             for route_type, n_moving in n_moving_by_type.items() if n_moving.any()}
+            for route_type in sorted(first_minutes, key=lambda t: (first_minutes[t], t)):
+                fleet_size_dict[route_type] = int(n_moving_by_type[route_type].max())
 
     for key in fleet_size_dict.keys():
         fleet_size_list.append(str(key) + ':' + str(fleet_size_dict[key]))
@@ -399,15 +472,17 @@ def _feed_calendar_span(gtfs, stats):
     return stats
 
 
-def update_stats(gtfs):
+def update_stats(gtfs, timings=None):
     """
     Computes stats AND stores them into the underlying gtfs object (i.e. database).
 
     Parameters
     ----------
     gtfs: GTFS
+    timings: dict, optional
+        see get_stats
     """
-    stats = get_stats(gtfs)
+    stats = get_stats(gtfs, timings=timings)
     gtfs.update_stats(stats)
 
 
@@ -429,30 +504,14 @@ def trip_stats(gtfs, results_by_mode=False):
                 [ADD HERE]
     """
     conn = gtfs.conn
+    # the distance and travel time for each complete trip, summed over its stop-to-stop segments
+    segments = _stop_to_stop_segments(conn)
+    segments['distance'] = segments['distance'].astype(int)
+    totals = segments.groupby('trip_I', as_index=False).agg(total_distance=('distance', 'sum'),
+                                                            total_traveltime=('travel_time', 'sum'))
+    trip_types = pd.read_sql_query('SELECT trip_I, type FROM trips JOIN routes USING (route_I)', conn)
+    q_result = pd.merge(trip_types, totals, on='trip_I').sort_values('trip_I').reset_index(drop=True)
 
-    conn.create_function("find_distance", 4, wgs84_distance)
-    cur = conn.cursor()
-    # this query calculates the distance and travel time for each complete trip
-    # stop_data_df = pd.read_sql_query(query, self.conn, params=params)
-
-    query = 'SELECT ' \
-            'startstop.trip_I AS trip_I, ' \
-            'type, ' \
-            'sum(CAST(find_distance(startstop.lat, startstop.lon, endstop.lat, endstop.lon) AS INT)) as total_distance, ' \
-            'sum(endstop.arr_time_ds - startstop.arr_time_ds) as total_traveltime ' \
-            'FROM ' \
-            '(SELECT * FROM stop_times, stops WHERE stop_times.stop_I = stops.stop_I) startstop, ' \
-            '(SELECT * FROM stop_times, stops WHERE stop_times.stop_I = stops.stop_I) endstop, ' \
-            'trips, ' \
-            'routes ' \
-            'WHERE ' \
-            'startstop.trip_I = endstop.trip_I ' \
-            'AND startstop.seq + 1 = endstop.seq ' \
-            'AND startstop.trip_I = trips.trip_I ' \
-            'AND trips.route_I = routes.route_I ' \
-            'GROUP BY startstop.trip_I'
-
-    q_result = pd.read_sql_query(query, conn)
     q_result['avg_speed_kmh'] = 3.6 * q_result['total_distance'] / q_result['total_traveltime']
     q_result['total_distance'] = q_result['total_distance'] / 1000
     q_result['total_traveltime'] = q_result['total_traveltime'] / 60
@@ -503,13 +562,135 @@ def get_section_stats(gtfs, results_by_mode=False):
         return q_result
 
 
-def route_frequencies(gtfs, results_by_mode=False):
+HOURLY_DEPARTURES_SOURCE_TABLES = ['trips', 'stop_times', 'days']
+
+
+def update_hourly_departures(gtfs, force=False):
+    """
+    Build the table of hourly departures, unless it is already up to date.
+
+    The departures are aggregated by (day_type, stop_I, route_I, hour) into table hourly_departures,
+    with columns
+        n_departures: number of stop times departing during the hour
+        n_departures_on_the_hour: number of those departing exactly at the start of the hour
+        n_trip_starts: number of trips starting (start_time_ds) during the hour, counted at their first stop
+    The hours are hours of the service day (dep_time_ds // 3600), and can thus be larger than 23.
+
+    Dates on which exactly the same trips run share a day type.
+    Table hourly_departures_day_types maps each date to its day type.
+
+    The tables are built from one pass over stop_times (and not over days x stop_times), and are
+    rebuilt automatically by the functions using them when the trips, stop_times or days
+    tables have changed (see _source_tables_signature).
+
+    Parameters
+    ----------
+    gtfs: GTFS
+    force: bool, optional
+        rebuild the tables even if they are up to date
+    """
+    source = _source_tables_signature(gtfs, HOURLY_DEPARTURES_SOURCE_TABLES)
+    if not force and gtfs.meta.get('hourly_departures_source') == source:
+        return
+    conn = gtfs.conn
+
+    # Group the trips by the dates they run on. The order of dates in group_concat is arbitrary,
+    # so the distinct concatenations are parsed into sets of dates.
+    trip_Is_by_dates_str = {}
+    for trip_I, dates_str in conn.execute('SELECT trip_I, group_concat(date) FROM days GROUP BY trip_I'):
+        trip_Is_by_dates_str.setdefault(dates_str, []).append(trip_I)
+    trip_Is_by_dates = {}
+    for dates_str, trip_Is in trip_Is_by_dates_str.items():
+        trip_Is_by_dates.setdefault(frozenset(dates_str.split(",")), []).extend(trip_Is)
+    date_sets = list(trip_Is_by_dates.keys())
+
+    # the day type of a date is determined by the sets of dates (i.e. the trips) it belongs to
+    date_set_indices_by_date = {}
+    for i, dates in enumerate(date_sets):
+        for date in dates:
+            date_set_indices_by_date.setdefault(date, []).append(i)
+    day_types = {}
+    day_type_by_date = {}
+    for date in sorted(date_set_indices_by_date):
+        day_type_by_date[date] = day_types.setdefault(tuple(date_set_indices_by_date[date]), len(day_types))
+
+    conn.execute('DROP TABLE IF EXISTS hourly_departures_day_types')
+    conn.execute('CREATE TABLE hourly_departures_day_types (date TEXT PRIMARY KEY, day_type INT)')
+    conn.executemany('INSERT INTO hourly_departures_day_types VALUES (?, ?)', sorted(day_type_by_date.items()))
+
+    conn.execute('DROP TABLE IF EXISTS temp.trip_day_types')
+    conn.execute('CREATE TEMP TABLE trip_day_types (trip_I INT, day_type INT)')
+    conn.executemany('INSERT INTO temp.trip_day_types VALUES (?, ?)',
+                     ((trip_I, day_type)
+                      for date_set_indices, day_type in day_types.items()
+                      for i in date_set_indices
+                      for trip_I in trip_Is_by_dates[date_sets[i]]))
+    conn.execute('CREATE INDEX temp.idx_trip_day_types_tid ON trip_day_types (trip_I)')
+
+    conn.execute('DROP TABLE IF EXISTS hourly_departures')
+    conn.execute('CREATE TABLE hourly_departures '
+                 '(day_type INT, stop_I INT, route_I INT, hour INT, '
+                 'n_departures INT, n_departures_on_the_hour INT, n_trip_starts INT)')
+    conn.execute('INSERT INTO hourly_departures '
+                 'SELECT day_type, stop_I, route_I, hour, '
+                 'sum(n_departures), sum(n_departures_on_the_hour), sum(n_trip_starts) '
+                 'FROM ('
+                 '    SELECT trip_I, stop_I, dep_time_ds / 3600 AS hour, 1 AS n_departures, '
+                 '    dep_time_ds % 3600 = 0 AS n_departures_on_the_hour, 0 AS n_trip_starts '
+                 '    FROM stop_times '
+                 '  UNION ALL '
+                 '    SELECT trip_I, stop_I, start_time_ds / 3600, 0, 0, 1 '
+                 '    FROM stop_times JOIN trips USING (trip_I) '
+                 '    WHERE (trip_I, seq) IN (SELECT trip_I, min(seq) FROM stop_times GROUP BY trip_I) '
+                 '    AND start_time_ds IS NOT NULL AND end_time_ds IS NOT NULL'
+                 ') JOIN trips USING (trip_I) JOIN temp.trip_day_types USING (trip_I) '
+                 'GROUP BY day_type, stop_I, route_I, hour')
+    conn.execute('CREATE INDEX idx_hourly_departures_dt_h ON hourly_departures (day_type, hour)')
+    conn.execute('DROP TABLE temp.trip_day_types')
+    conn.commit()
+    gtfs.meta['hourly_departures_source'] = source
+
+
+def _hourly_departures_up_to_date(gtfs):
+    """
+    Build or rebuild the table hourly_departures when needed (see update_hourly_departures).
+    Returns False if the table is out of date and can not be rebuilt, as the database is read-only.
+    """
+    try:
+        update_hourly_departures(gtfs)
+    except sqlite3.OperationalError as e:
+        if not _is_read_only_error(e):
+            raise
+        gtfs.conn.rollback()
+        return False
+    return True
+
+
+def _is_read_only_error(error):
+    return "readonly database" in str(error)
+
+
+def _day_type(gtfs, date):
+    """The day type of a date in table hourly_departures, or None if no trips run on that date."""
+    row = gtfs.conn.execute('SELECT day_type FROM hourly_departures_day_types WHERE date=?', (date,)).fetchone()
+    return row[0] if row else None
+
+
+def _whole_hours(st, et):
+    """Whether st and et (in seconds) are both at the start of an hour."""
+    return st % 3600 == 0 and et % 3600 == 0
+
+
+def route_frequencies(gtfs, results_by_mode=False, use_hourly_departures=True):
     """
     Return the frequency of all types of routes per day.
 
     Parameters
     -----------
     gtfs: GTFS
+    use_hourly_departures: bool, optional
+        whether to use the precomputed table hourly_departures (see update_hourly_departures).
+        If the table is out of date and can not be rebuilt (read-only database), the tables are queried directly.
 
     Returns
     -------
@@ -517,6 +698,12 @@ def route_frequencies(gtfs, results_by_mode=False):
         route_I, type, frequency
     """
     day = gtfs.get_suitable_date_for_daily_extract()
+    if use_hourly_departures and _hourly_departures_up_to_date(gtfs):
+        return pd.read_sql_query('SELECT route_I, type, sum(n_trip_starts) AS frequency '
+                                 'FROM hourly_departures JOIN routes USING (route_I) '
+                                 'WHERE day_type = ? '
+                                 'GROUP BY route_I HAVING frequency > 0 '
+                                 'ORDER BY frequency DESC', gtfs.conn, params=(_day_type(gtfs, day),))
     query = (
         " SELECT f.route_I, type, frequency FROM routes as r"
         " JOIN"
@@ -533,7 +720,7 @@ def route_frequencies(gtfs, results_by_mode=False):
     return pd.DataFrame(gtfs.execute_custom_query_pandas(query))
 
 
-def hourly_frequencies(gtfs, st, et, route_type):
+def hourly_frequencies(gtfs, st, et, route_type, use_hourly_departures=True):
     """
     Return all the number of vehicles (i.e. busses,trams,etc) that pass hourly through a stop in a time frame.
 
@@ -545,6 +732,10 @@ def hourly_frequencies(gtfs, st, et, route_type):
     et : int
         end time of the time frame in unix time
     route_type: int
+    use_hourly_departures: bool, optional
+        whether to use the precomputed table hourly_departures (see update_hourly_departures),
+        when st and et are both full hours.
+        If the table is out of date and can not be rebuilt (read-only database), the tables are queried directly.
 
     Returns
     -------
@@ -566,7 +757,18 @@ def hourly_frequencies(gtfs, st, et, route_type):
              " GROUP BY stop_I) as y"
              " ON y.stop_I = x.stop_I".format(h=hours, st=st, et=et, day=day))
     try:
-        trips_frequency = gtfs.execute_custom_query_pandas(query).T.drop_duplicates().T
+        if use_hourly_departures and _whole_hours(st, et) and _hourly_departures_up_to_date(gtfs):
+            # departures exactly at st are left out, as st is not included in the time frame
+            trips_frequency = pd.read_sql_query(
+                'SELECT stop_I, (sum(n_departures) - '
+                'sum(CASE WHEN hour = :start_hour THEN n_departures_on_the_hour ELSE 0 END)) / :hours AS frequency '
+                'FROM hourly_departures '
+                'WHERE day_type = :day_type AND hour >= :start_hour AND hour < :end_hour '
+                'GROUP BY stop_I HAVING frequency > 0', gtfs.conn,
+                params={'day_type': _day_type(gtfs, day), 'start_hour': st // 3600, 'end_hour': et // 3600,
+                        'hours': float(hours)})
+        else:
+            trips_frequency = gtfs.execute_custom_query_pandas(query).T.drop_duplicates().T
         df = pd.merge(stops[['stop_I', 'lat', 'lon']], trips_frequency[['stop_I', 'frequency']],
                       on='stop_I', how='inner')
         return df.apply(pd.to_numeric)
@@ -591,8 +793,15 @@ def frequencies_by_generated_route(gtfs, st, et, day=None):
     return df
 
 
-def departure_stops(gtfs, st, et):
+def departure_stops(gtfs, st, et, use_hourly_departures=True):
     day = gtfs.get_suitable_date_for_daily_extract()
+    if use_hourly_departures and _whole_hours(st, et) and _hourly_departures_up_to_date(gtfs):
+        df = pd.read_sql_query('SELECT stop_I, sum(n_trip_starts) AS n_departures '
+                               'FROM hourly_departures '
+                               'WHERE day_type = ? AND hour >= ? AND hour < ? '
+                               'GROUP BY stop_I HAVING sum(n_trip_starts) > 0', gtfs.conn,
+                               params=(_day_type(gtfs, day), st // 3600, et // 3600))
+        return gtfs.add_coordinates_to_df(df)
     query = """select stop_I, count(*) as n_departures from 
                 (select min(seq), * from stop_times, days, trips
                 where stop_times.trip_I = days.trip_I and stop_times.trip_I = trips.trip_I and days.date = '{day}'
@@ -610,16 +819,206 @@ def get_vehicle_hours_by_type(gtfs, route_type):
     """
 
     day = gtfs.get_suitable_date_for_daily_extract()
-    query = (" SELECT * , SUM(end_time_ds - start_time_ds)/3600 as vehicle_hours_type"
-             " FROM"
-             " (SELECT * FROM day_trips as q1"
-             " INNER JOIN"
-             " (SELECT route_I, type FROM routes) as q2"
-             " ON q1.route_I = q2.route_I"
-             " WHERE type = {route_type}"
-             " AND date = '{day}')".format(day=day, route_type=route_type))
-    df = gtfs.execute_custom_query_pandas(query)
-    return df['vehicle_hours_type'].item()
+    return gtfs.conn.execute('SELECT SUM(end_time_ds - start_time_ds)/3600 '
+                             'FROM day_trips2 JOIN trips USING (trip_I) JOIN routes USING (route_I) '
+                             'WHERE type = ? AND date = ?', (route_type, day)).fetchone()[0]
+
+
+def _stop_to_stop_segments(conn):
+    """
+    Straight-line distances and travel times between all consecutive stops (seq, seq + 1) of all trips.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+
+    Returns
+    -------
+    segments: pandas.DataFrame
+        with columns trip_I, distance (in meters) and travel_time (in seconds)
+    """
+    stop_times = numpy.array(conn.execute('SELECT trip_I, seq, arr_time_ds, stop_I '
+                                          'FROM stop_times ORDER BY trip_I, seq').fetchall(), dtype=float)
+    stops = numpy.array(conn.execute('SELECT stop_I, lat, lon FROM stops').fetchall(), dtype=float)
+    if len(stop_times) == 0 or len(stops) == 0:
+        return pd.DataFrame({'trip_I': [], 'distance': [], 'travel_time': []})
+    trip_Is = stop_times[:, 0].astype(numpy.int64)
+    seqs = stop_times[:, 1].astype(numpy.int64)
+    arr_times = stop_times[:, 2]
+    stop_Is = stop_times[:, 3].astype(numpy.int64)
+    stop_lats = numpy.full(int(max(stops[:, 0].max(), stop_Is.max())) + 1, numpy.nan)
+    stop_lons = stop_lats.copy()
+    stop_lats[stops[:, 0].astype(numpy.int64)] = stops[:, 1]
+    stop_lons[stops[:, 0].astype(numpy.int64)] = stops[:, 2]
+    lats = stop_lats[stop_Is]
+    lons = stop_lons[stop_Is]
+    distances = wgs84_distances(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    is_segment = (trip_Is[1:] == trip_Is[:-1]) & (seqs[1:] == seqs[:-1] + 1) & numpy.isfinite(distances)
+    return pd.DataFrame({'trip_I': trip_Is[:-1][is_segment],
+                         'distance': distances[is_segment],
+                         'travel_time': (arr_times[1:] - arr_times[:-1])[is_segment]})
+
+
+def _source_tables_signature(gtfs, tables):
+    """
+    A string identifying the current contents of the tables, used for invalidating results
+    derived from them and stored into the database.
+
+    The signature consists of the data version counter of the database (see gtfs.bump_data_version),
+    which changes whenever the data is modified by gtfspy, and of the number of rows and the largest
+    rowid of each table, which change also when rows are inserted or deleted by other means.
+    """
+    parts = ["%s:%s" % (DATA_VERSION_KEY, gtfs.meta.get(DATA_VERSION_KEY))]
+    for table in tables:
+        max_rowid = gtfs.conn.execute('SELECT max(rowid) FROM ' + table).fetchone()[0]
+        parts.append("%s:%d:%s" % (table, gtfs.get_row_count(table), max_rowid))
+    return " ".join(parts)
+
+
+VEHICLE_TIME_SERIES_SOURCE_TABLES = ['routes', 'trips', 'stop_times', 'days']
+
+
+def vehicle_time_series(gtfs, by="type", use_cache=True):
+    """
+    Hourly vehicle activity for every day of the feed.
+
+    For each hour during which vehicles are in service, and for each route type (or route),
+    the following are computed:
+        max_vehicles: the maximum number of trips (vehicles) running at the same time during the hour
+        vehicle_hours: the total time vehicles are in service during the hour
+        vehicle_km: the distance travelled by vehicles during the hour, assuming straight lines
+        between consecutive stops and a constant speed within each trip
+
+    All days are handled at once, by sweeping over the start and end times of all trips.
+    Hours start at full hours of UTC, which are full hours also in the local time of all
+    but a few time zones. Trips running past midnight are counted on the (calendar) date they
+    are running at, not on their service date.
+
+    Parameters
+    ----------
+    gtfs: GTFS
+    by: str, optional
+        "type" (route type) or "route_I"
+    use_cache: bool, optional
+        If True, the result is stored into the database (table vehicle_time_series_by_<by>)
+        and returned by later calls, as long as the routes, trips, stop_times and days tables
+        have not changed (see _source_tables_signature). Nothing is stored into a read-only database.
+
+    Returns
+    -------
+    time_series: pandas.DataFrame
+        with columns date, hour, hour_start_ut, <by> (and type, if by is "route_I"),
+        max_vehicles, vehicle_hours and vehicle_km
+    """
+    if by not in ("type", "route_I"):
+        raise ValueError("by should be 'type' or 'route_I', got " + str(by))
+    table = "vehicle_time_series_by_" + by
+    source_key = table + "_source"
+    source = _source_tables_signature(gtfs, VEHICLE_TIME_SERIES_SOURCE_TABLES)
+    if use_cache and gtfs.meta.get(source_key) == source:
+        return pd.read_sql_query('SELECT * FROM ' + table, gtfs.conn)
+
+    time_series = _compute_vehicle_time_series(gtfs, by)
+    if use_cache:
+        try:
+            time_series.to_sql(table, gtfs.conn, if_exists='replace', index=False)
+            gtfs.meta[source_key] = source
+        except sqlite3.OperationalError as e:
+            # the result can not be stored into a read-only database
+            if not _is_read_only_error(e):
+                raise
+            gtfs.conn.rollback()
+    return time_series
+
+
+def _compute_vehicle_time_series(gtfs, by):
+    conn = gtfs.conn
+    trips = pd.read_sql_query('SELECT trip_I, start_time_ds, end_time_ds, route_I, type '
+                              'FROM trips JOIN routes USING (route_I) '
+                              'WHERE start_time_ds IS NOT NULL AND end_time_ds >= start_time_ds', conn)
+    trip_lengths = _stop_to_stop_segments(conn).groupby('trip_I')['distance'].sum()
+    trips['length'] = trips['trip_I'].map(trip_lengths).fillna(0)
+    trips = trips.set_index('trip_I')
+
+    # Trips sharing the same days are handled together, so that days x trips needs not to be read row by row.
+    trip_Is_by_days = {}
+    for trip_I, days in conn.execute('SELECT trip_I, group_concat(day_start_ut) FROM days GROUP BY trip_I'):
+        trip_Is_by_days.setdefault(days, []).append(trip_I)
+    starts, ends, lengths, group_labels = [], [], [], []
+    for days, trip_Is in trip_Is_by_days.items():
+        day_start_uts = numpy.array(days.split(","), dtype=numpy.int64)
+        day_trips = trips.loc[trips.index.intersection(trip_Is)]
+        starts.append((day_trips['start_time_ds'].values.astype(numpy.int64)[:, None] + day_start_uts).ravel())
+        ends.append((day_trips['end_time_ds'].values.astype(numpy.int64)[:, None] + day_start_uts).ravel())
+        lengths.append(numpy.repeat(day_trips['length'].values, len(day_start_uts)))
+        group_labels.append(numpy.repeat(day_trips[by].values, len(day_start_uts)))
+    starts = numpy.concatenate(starts) if starts else numpy.array([], dtype=numpy.int64)
+    ends = numpy.concatenate(ends) if ends else numpy.array([], dtype=numpy.int64)
+    lengths = numpy.concatenate(lengths) if lengths else numpy.array([])
+    group_labels = numpy.concatenate(group_labels) if group_labels else numpy.array([], dtype=int)
+    durations = ends - starts
+    group_values, groups = numpy.unique(group_labels, return_inverse=True)
+
+    # Split each trip into the hours it is running in (a zero-length trip occupies its starting hour).
+    first_hours = starts // 3600
+    n_hours = numpy.maximum((ends - 1) // 3600, first_hours) - first_hours + 1
+    trip_index = numpy.repeat(numpy.arange(len(starts)), n_hours)
+    hours = first_hours[trip_index] + (numpy.arange(len(trip_index)) -
+                                       numpy.repeat(numpy.cumsum(n_hours) - n_hours, n_hours))
+    hour_starts = hours * 3600
+    in_service = (numpy.minimum(ends[trip_index], hour_starts + 3600) -
+                  numpy.maximum(starts[trip_index], hour_starts))
+    # share of the trip (and thus of its length) within each hour
+    fractions = numpy.ones(len(trip_index))
+    has_duration = durations[trip_index] > 0
+    fractions[has_duration] = in_service[has_duration] / durations[trip_index][has_duration].astype(float)
+
+    min_hour = hours.min() if len(hours) else 0
+    n_all_hours = (hours.max() - min_hour + 1) if len(hours) else 1
+    keys = groups[trip_index] * n_all_hours + (hours - min_hour)
+    unique_keys, key_index = numpy.unique(keys, return_inverse=True)
+    vehicle_hours = numpy.bincount(key_index, weights=in_service, minlength=len(unique_keys)) / 3600.
+    vehicle_km = numpy.bincount(key_index, weights=lengths[trip_index] * fractions, minlength=len(unique_keys)) / 1000.
+
+    # Sweep line: +1 at each trip start, -1 at each trip end, and a probe (+0) at the start of each hour
+    # a trip is running in, so that also the vehicles running through a whole hour are seen.
+    # At equal times, ends come first, then starts, and then probes.
+    running = durations > 0
+    event_times = numpy.concatenate([ends[running], starts[running], hour_starts])
+    event_kinds = numpy.concatenate([numpy.zeros(running.sum(), dtype=int),
+                                     numpy.ones(running.sum(), dtype=int),
+                                     numpy.full(len(hour_starts), 2)])
+    event_deltas = numpy.array([-1, 1, 0])[event_kinds]
+    event_groups = numpy.concatenate([groups[running], groups[running], groups[trip_index]])
+    # sorting by (group, time, kind) using one integer key is much faster than numpy.lexsort
+    min_time = min_hour * 3600
+    n_all_times = n_all_hours * 3600 + 1
+    order = numpy.argsort((event_groups * n_all_times + (event_times - min_time)) * 3 + event_kinds)
+    # each group starts from and returns to zero, so a single cumulative sum suffices for all groups
+    levels = numpy.cumsum(event_deltas[order])
+    event_keys = event_groups[order] * n_all_hours + (event_times[order] // 3600 - min_hour)
+    # ends at the very end of the last hour of a trip fall to the next hour, which may not otherwise be in use
+    is_used = numpy.isin(event_keys, unique_keys)
+    event_keys = event_keys[is_used]
+    levels = levels[is_used]
+    max_vehicles = numpy.zeros(len(unique_keys), dtype=int)
+    if len(event_keys):
+        group_starts = numpy.flatnonzero(numpy.r_[True, event_keys[1:] != event_keys[:-1]])
+        max_vehicles = numpy.maximum.reduceat(levels, group_starts)
+
+    result_hours = unique_keys % n_all_hours + min_hour
+    local_times = pd.to_datetime(result_hours * 3600, unit='s', utc=True).tz_convert(gtfs.get_timezone_name())
+    time_series = pd.DataFrame({'date': local_times.strftime('%Y-%m-%d'),
+                                'hour': local_times.hour,
+                                'hour_start_ut': result_hours * 3600,
+                                by: group_values[unique_keys // n_all_hours]})
+    if by == "route_I":
+        route_types = trips.drop_duplicates('route_I').set_index('route_I')['type']
+        time_series['type'] = time_series['route_I'].map(route_types).values
+    time_series['max_vehicles'] = max_vehicles
+    time_series['vehicle_hours'] = vehicle_hours
+    time_series['vehicle_km'] = vehicle_km
+    return time_series.sort_values(['hour_start_ut', by]).reset_index(drop=True)
 
 
 def trips_frequencies(gtfs):
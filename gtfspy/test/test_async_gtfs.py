@@ -0,0 +1,107 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from gtfspy.async_gtfs import AsyncGTFS
+from gtfspy.gtfs import GTFS
+from gtfspy.import_gtfs import import_gtfs
+
+
+class TestAsyncGTFS(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.fname = os.path.join(cls.tmp_dir, "test_async_gtfs.sqlite")
+        gtfs_source_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        conn = sqlite3.connect(cls.fname)
+        import_gtfs(gtfs_source_dir, conn, preserve_connection=True, print_progress=False)
+        conn.close()
+        cls.G = GTFS(cls.fname)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.G
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_queries(self):
+        stops = self.G.stops()
+        expected_closest = [self.G.get_closest_stop(lat, lon) for lat, lon in zip(stops.lat, stops.lon)]
+
+        async def run():
+            async with AsyncGTFS(self.fname, max_workers=3) as G:
+                async_stops = await G.stops()
+                closest = await G.gather([("get_closest_stop", (lat, lon)) for lat, lon in zip(stops.lat, stops.lon)])
+                events = await G.get_transit_events()
+                return async_stops, closest, events
+
+        async_stops, closest, events = asyncio.run(run())
+        self.assertTrue(async_stops.equals(stops))
+        self.assertListEqual(list(closest), expected_closest)
+        self.assertEqual(len(events), len(self.G.get_transit_events()))
+
+    def test_coalescing_under_load(self):
+        n_clients = 50
+
+        expected_lats = self.G.stops()["lat"].tolist()
+
+        async def client(G):
+            stops = await G.stops()
+            lats = stops["lat"].tolist()
+            # modifying a coalesced result does not affect the results of the other callers
+            stops["lat"] = 0.
+            return lats, stops
+
+        async def run():
+            async with AsyncGTFS(self.fname, max_workers=2) as G:
+                results = await asyncio.gather(*[client(G) for _ in range(n_clients)])
+                return results, G.n_queries, G.n_coalesced
+
+        results, n_queries, n_coalesced = asyncio.run(run())
+        self.assertTrue(all(lats == expected_lats for lats, _ in results))
+        self.assertEqual(len(set(id(stops) for _, stops in results)), n_clients)
+        self.assertEqual(n_queries + n_coalesced, n_clients)
+        self.assertEqual(n_queries, 1)
+
+    def test_mixed_load(self):
+        stops = self.G.stops()
+        points = list(zip(stops.lat, stops.lon))
+        expected_closest = {point: self.G.get_closest_stop(*point) for point in points}
+        calls = []
+        for i in range(400):
+            if i % 4 == 0:
+                calls.append(("stops", ()))
+            else:
+                calls.append(("get_closest_stop", points[i % len(points)]))
+
+        async def run():
+            async with AsyncGTFS(self.fname, max_workers=4) as G:
+                results = await G.gather(calls)
+                return results, G.n_queries, G.n_coalesced, G.pool.n_open
+
+        results, n_queries, n_coalesced, n_open = asyncio.run(run())
+        for (method_name, args), result in zip(calls, results):
+            if method_name == "stops":
+                self.assertTrue(result.equals(stops))
+            else:
+                self.assertEqual(result, expected_closest[args])
+        self.assertEqual(n_queries + n_coalesced, len(calls))
+        self.assertLessEqual(n_queries, 1 + len(points))
+        self.assertLessEqual(n_open, 4)
+
+    def test_cancellation(self):
+        async def run():
+            async with AsyncGTFS(self.fname, max_workers=1) as G:
+                task = asyncio.ensure_future(G.get_transit_events())
+                await asyncio.sleep(0)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                # the pool is still usable after a cancelled query
+                self.assertEqual(len(G._in_flight), 0)
+                return await G.stops()
+
+        self.assertEqual(len(asyncio.run(run())), len(self.G.stops()))
@@ -1,3 +1,4 @@
+import importlib.util
 import io
 import os
 import unittest
@@ -106,6 +107,27 @@ class ExportsTest(unittest.TestCase):
         for from_node, to_node, data in multi_di_graph.edges(data=True):
             self.assertIn("route_type", data)
 
+    def test_sparse_stop_to_stop_networks(self):
+        walk_net = networks.walk_transfer_stop_to_stop_network(self.gtfs)
+        adjacency, stop_I_to_index = networks.walk_transfer_stop_to_stop_network(self.gtfs, return_sparse=True,
+                                                                                 weight="d")
+        self.assertEqual(adjacency.shape, (len(walk_net.nodes()), len(walk_net.nodes())))
+        self.assertEqual((adjacency != adjacency.T).nnz, 0)
+        for from_node, to_node, data in walk_net.edges(data=True):
+            self.assertEqual(adjacency[stop_I_to_index[from_node], stop_I_to_index[to_node]], data["d"])
+
+        bus_net = networks.stop_to_stop_network_for_route_type(self.gtfs, BUS)
+        adjacency, stop_I_to_index = networks.stop_to_stop_network_for_route_type(self.gtfs, BUS, return_sparse=True,
+                                                                                  weight="n_vehicles")
+        self.assertEqual(set(stop_I_to_index), set(bus_net.nodes()))
+        self.assertEqual(adjacency.nnz, len(bus_net.edges()))
+        for from_node, to_node, data in bus_net.edges(data=True):
+            self.assertEqual(adjacency[stop_I_to_index[from_node], stop_I_to_index[to_node]], data["n_vehicles"])
+
+        multi_di_graph = networks.combined_stop_to_stop_transit_network(self.gtfs)
+        adjacency, stop_I_to_index = networks.combined_stop_to_stop_transit_network(self.gtfs, return_sparse=True)
+        self.assertEqual(adjacency.sum(), len(multi_di_graph.edges()))
+
     def test_temporal_network(self):
         temporal_pd = networks.temporal_network(self.gtfs)
         self.assertGreater(temporal_pd.shape[0], 10)
@@ -120,6 +142,55 @@ class ExportsTest(unittest.TestCase):
         for col in columns_should_exist:
             self.assertIn(col, df.columns.values)
 
+    def test_temporal_network_batches(self):
+        temporal_pd = networks.temporal_network(self.gtfs)
+        batches = list(networks.temporal_network_batches(self.gtfs, batch_duration=7 * 24 * 3600))
+        self.assertGreater(len(batches), 1)
+        batched_pd = pandas.concat(batches)
+        self.assertEqual(list(batched_pd.columns), list(temporal_pd.columns))
+        columns = list(temporal_pd.columns)
+        pandas.testing.assert_frame_equal(temporal_pd.sort_values(columns).reset_index(drop=True),
+                                          batched_pd.sort_values(columns).reset_index(drop=True))
+
+        start_time_ut = self.gtfs.get_day_start_ut_span()[0] + 8 * 3600
+        end_time_ut = start_time_ut + 2 * 24 * 3600
+        temporal_pd = networks.temporal_network(self.gtfs, start_time_ut, end_time_ut, route_type=BUS)
+        batched_pd = pandas.concat(networks.temporal_network_batches(self.gtfs, start_time_ut, end_time_ut,
+                                                                     route_type=BUS, batch_duration=3600))
+        self.assertEqual(len(batched_pd), len(temporal_pd))
+
+    def test_write_temporal_network_gzip(self):
+        path = os.path.join(self.extract_output_dir, "combined.tnet.gz")
+        exports.write_temporal_network(self.gtfs, path)
+        df = pandas.read_csv(path)
+        self.assertEqual(len(df), len(networks.temporal_network(self.gtfs)))
+        self.assertEqual(list(df.columns), networks.TEMPORAL_NETWORK_COLUMNS)
+
+        # an empty time span still produces a header
+        path = os.path.join(self.extract_output_dir, "empty.tnet")
+        exports.write_temporal_network(self.gtfs, path, start_time_ut=10, end_time_ut=20)
+        self.assertEqual(list(pandas.read_csv(path).columns), networks.TEMPORAL_NETWORK_COLUMNS)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_write_temporal_network_parquet(self):
+        path = os.path.join(self.extract_output_dir, "combined.parquet")
+        exports.write_temporal_network(self.gtfs, path, batch_duration=7 * 24 * 3600)
+        df = pandas.read_parquet(path)
+        temporal_pd = networks.temporal_network(self.gtfs)
+        self.assertEqual(list(df.columns), networks.TEMPORAL_NETWORK_COLUMNS)
+        self.assertTrue(all(dtype == numpy.int64 for dtype in df.dtypes))
+        columns = networks.TEMPORAL_NETWORK_COLUMNS
+        pandas.testing.assert_frame_equal(df.sort_values(columns).reset_index(drop=True),
+                                          temporal_pd.sort_values(columns).reset_index(drop=True),
+                                          check_dtype=False)
+
+        # an empty time span still produces a file with all columns
+        path = os.path.join(self.extract_output_dir, "empty.parquet")
+        exports.write_temporal_network(self.gtfs, path, start_time_ut=10, end_time_ut=20)
+        df = pandas.read_parquet(path)
+        self.assertEqual(list(df.columns), networks.TEMPORAL_NETWORK_COLUMNS)
+        self.assertEqual(len(df), 0)
+
     def test_write_temporal_networks_by_route_type(self):
         exports.write_temporal_networks_by_route_type(self.gtfs, self.extract_output_dir)
         self.assertTrue(os.path.exists(os.path.join(self.extract_output_dir + "bus.tnet")))
@@ -236,6 +307,35 @@ class ExportsTest(unittest.TestCase):
                 else:
                     os.remove(test_output_dir + ending)
 
+    def test_write_gtfs_round_trip(self):
+        from gtfspy.import_gtfs import import_gtfs
+        stop_times_query = "SELECT trip_id, stop_id, seq, arr_time_ds, dep_time_ds " \
+                           "FROM stop_times JOIN trips USING(trip_I) JOIN stops USING(stop_I) " \
+                           "ORDER BY trip_id, seq"
+        tables = ["agencies", "routes", "trips", "stops", "stop_times", "calendar", "calendar_dates", "shapes"]
+
+        first_zip = os.path.join(self.extract_output_dir, "first.zip")
+        first_sqlite = os.path.join(self.extract_output_dir, "first.sqlite")
+        exports.write_gtfs(self.gtfs, first_zip)
+        import_gtfs(first_zip, first_sqlite, print_progress=False)
+        first = GTFS(first_sqlite)
+        for table in tables:
+            self.assertEqual(first.get_row_count(table), self.gtfs.get_row_count(table), table)
+        self.assertEqual(first.execute_custom_query(stop_times_query).fetchall(),
+                         self.gtfs.execute_custom_query(stop_times_query).fetchall())
+        self.assertEqual(first.get_table("calendar_dates")["date"].tolist(),
+                         self.gtfs.get_table("calendar_dates")["date"].tolist())
+
+        # a database on disk is written in parallel, with identical results
+        for output in ["second.zip", "second"]:
+            output = os.path.join(self.extract_output_dir, output)
+            second_sqlite = output + ".sqlite"
+            exports.write_gtfs(first, output, n_threads=3)
+            import_gtfs(output, second_sqlite, print_progress=False)
+            second = GTFS(second_sqlite)
+            for table in tables:
+                pandas.testing.assert_frame_equal(second.get_table(table), first.get_table(table))
+
     def test_write_stops_geojson(self):
         in_memory_file = io.StringIO()
         exports.write_stops_geojson(self.gtfs, in_memory_file)
@@ -283,6 +383,18 @@ class ExportsTest(unittest.TestCase):
         self.assertIn("route_I", gjson_properties.keys())
         self.assertIn("route_name", gjson_properties.keys())
 
+    def test_write_trip_trajectories_geojson_lines(self):
+        in_memory_file = io.StringIO()
+        start_ut, end_ut = self.gtfs.get_approximate_schedule_time_span_in_ut()
+        n_trips = exports.write_trip_trajectories_geojson_lines(self.gtfs, in_memory_file, start_ut, start_ut + 24 * 3600)
+        in_memory_file.seek(0)
+        lines = in_memory_file.read(-1).splitlines()
+        self.assertGreater(n_trips, 0)
+        self.assertEqual(len(lines), n_trips)
+        feature = geojson.loads(lines[0])
+        self.assertTrue(feature.is_valid)
+        self.assertEqual(len(feature['geometry']['coordinates']), len(feature['properties']['times']))
+
 
 
         # def test_clustered_stops_network(self):
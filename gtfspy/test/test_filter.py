@@ -1,12 +1,13 @@
 import os
+import shutil
 import unittest
 import sqlite3
 import datetime
 import pandas
 
-from gtfspy.gtfs import GTFS
-from gtfspy.filter import FilterExtract
-from gtfspy.filter import remove_all_trips_fully_outside_buffer
+from gtfspy.gtfs import GTFS, DATA_VERSION_KEY
+from gtfspy.filter import FilterExtract, create_filtered_copies, update_secondary_data_copies
+from gtfspy.filter import remove_all_trips_fully_outside_buffer, _assert_sqlite_version
 
 from gtfspy.import_gtfs import import_gtfs
 import hashlib
@@ -209,18 +210,141 @@ class TestGTFSFilter(unittest.TestCase):
             max_values = pandas.read_sql("SELECT max(seq) FROM stop_times GROUP BY trip_I ORDER BY trip_I", G_copy.conn)
             self.assertTrue((counts.values == max_values.values).all())
 
+    def test_assert_sqlite_version(self):
+        _assert_sqlite_version(self.G.conn, (3, 0, 0), "Anything")
+        with self.assertRaises(RuntimeError):
+            _assert_sqlite_version(self.G.conn, (99, 0, 0), "Anything")
+
     def test_remove_all_trips_fully_outside_buffer(self):
         stops = self.G.stops()
         stop_1 = stops[stops['stop_I'] == 1]
 
         n_trips_before = len(self.G.get_table("trips"))
 
-        remove_all_trips_fully_outside_buffer(self.G.conn, float(stop_1.lat), float(stop_1.lon), 100000)
+        remove_all_trips_fully_outside_buffer(self.G.conn, stop_1.lat.iloc[0], stop_1.lon.iloc[0], 100000)
         self.assertEqual(len(self.G.get_table("trips")), n_trips_before)
 
         # 0.002 (=max 2 meters from the stop), rounding errors can take place...
-        remove_all_trips_fully_outside_buffer(self.G.conn, float(stop_1.lat), float(stop_1.lon), 0.002)
+        remove_all_trips_fully_outside_buffer(self.G.conn, stop_1.lat.iloc[0], stop_1.lon.iloc[0], 0.002)
         self.assertEqual(len(self.G.get_table("trips")), 2)  # value "2" comes from the data
 
 
 
+
+    def _assert_same_extracts(self, fname_1, fname_2, msg):
+        conn_1 = sqlite3.connect(fname_1)
+        conn_2 = sqlite3.connect(fname_2)
+        schema_sql = "SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY name"
+        schema = conn_1.execute(schema_sql).fetchall()
+        self.assertEqual(schema, conn_2.execute(schema_sql).fetchall())
+        for type_, table in schema:
+            if type_ != "table":
+                continue
+            query = "SELECT * FROM " + table
+            if table == "metadata":
+                # the number of modifications differs depending on how the extract was made
+                query += " WHERE key <> '" + DATA_VERSION_KEY + "'"
+            rows_1 = sorted(conn_1.execute(query).fetchall(), key=str)
+            rows_2 = sorted(conn_2.execute(query).fetchall(), key=str)
+            self.assertEqual(rows_1, rows_2, "%s differs with %s" % (table, msg))
+        conn_1.close()
+        conn_2.close()
+
+    def test_build_forward_equals_copy_and_delete(self):
+        fname_forward = self.gtfs_source_dir + "/test_gtfs_forward_copy.sqlite"
+        paris_lat = 48.832781
+        paris_lon = 2.360734
+        filter_kwargs_list = [
+            (self.G, {}),
+            (self.G, dict(agency_ids_to_preserve=['DTA'])),
+            (self.G, dict(start_date="2007-01-02", end_date="2010-12-31")),
+            (self.G, dict(start_date="2007-01-02", end_date="2007-01-09", agency_ids_to_preserve=['DTA'])),
+            (self.G, dict(buffer_lat=36.914893, buffer_lon=-116.76821, buffer_distance_km=50)),
+            (self.G, dict(buffer_lat=36.914893, buffer_lon=-116.76821, buffer_distance_km=50,
+                          start_date="2007-01-02", end_date="2010-12-31", agency_ids_to_preserve=['DTA'])),
+            (self.G_filter_test, dict(buffer_lat=paris_lat, buffer_lon=paris_lon, buffer_distance_km=1000)),
+            (self.G_filter_test, dict(buffer_lat=paris_lat, buffer_lon=paris_lon, buffer_distance_km=3000)),
+        ]
+        try:
+            for G, filter_kwargs in filter_kwargs_list:
+                for fname in [self.fname_copy, fname_forward]:
+                    if os.path.exists(fname):
+                        os.remove(fname)
+                FilterExtract(G, self.fname_copy, update_metadata=False, **filter_kwargs).create_filtered_copy()
+                FilterExtract(G, fname_forward, update_metadata=False, build_forward=True,
+                              **filter_kwargs).create_filtered_copy()
+                self._assert_same_extracts(self.fname_copy, fname_forward, str(filter_kwargs))
+        finally:
+            if os.path.exists(fname_forward):
+                os.remove(fname_forward)
+
+    def test_create_filtered_copies(self):
+        extract_specs = [
+            dict(buffer_lat=36.914893, buffer_lon=-116.76821, buffer_distance_km=50),
+            dict(start_date="2007-01-02", end_date="2007-01-09", agency_ids_to_preserve=['DTA']),
+            dict(buffer_lat=36.914893, buffer_lon=-116.76821, buffer_distance_km=5,
+                 start_date="2007-01-02", end_date="2010-12-31"),
+        ]
+        fnames = [self.gtfs_source_dir + "/test_gtfs_multi_extract_%d.sqlite" % i for i in range(len(extract_specs))]
+        try:
+            for n_processes in [1, 2]:
+                for fname in fnames + [self.fname_copy]:
+                    if os.path.exists(fname):
+                        os.remove(fname)
+                specs = [dict(spec, copy_db_path=fname, update_metadata=False)
+                         for spec, fname in zip(extract_specs, fnames)]
+                copy_db_paths = create_filtered_copies(self.G, specs, n_processes=n_processes)
+                self.assertEqual(copy_db_paths, fnames)
+                for spec, fname in zip(extract_specs, fnames):
+                    if os.path.exists(self.fname_copy):
+                        os.remove(self.fname_copy)
+                    FilterExtract(self.G, self.fname_copy, update_metadata=False, **spec).create_filtered_copy()
+                    self._assert_same_extracts(self.fname_copy, fname, str(spec))
+            with self.assertRaises(ValueError):
+                create_filtered_copies(self.G, [dict(copy_db_path=self.fname_copy + "_x"),
+                                                dict(copy_db_path=self.fname_copy + "_x")])
+        finally:
+            for fname in fnames:
+                if os.path.exists(fname):
+                    os.remove(fname)
+
+    def test_incremental_secondary_data_update(self):
+        # the secondary data of the extracts should equal fully recomputed secondary data
+        fname_full = self.gtfs_source_dir + "/test_gtfs_full_update.sqlite"
+        paris_lat = 48.832781
+        paris_lon = 2.360734
+        filter_kwargs_list = [
+            (self.G, dict(agency_ids_to_preserve=['DTA'])),
+            (self.G, dict(start_date="2007-01-02", end_date="2007-01-09")),
+            (self.G, dict(buffer_lat=36.914893, buffer_lon=-116.76821, buffer_distance_km=5,
+                          start_date="2007-01-02", end_date="2010-12-31")),
+            (self.G_filter_test, dict(buffer_lat=paris_lat, buffer_lon=paris_lon, buffer_distance_km=3000)),
+        ]
+        try:
+            for G, filter_kwargs in filter_kwargs_list:
+                for fname in [self.fname_copy, fname_full]:
+                    if os.path.exists(fname):
+                        os.remove(fname)
+                FilterExtract(G, self.fname_copy, update_metadata=False, **filter_kwargs).create_filtered_copy()
+                shutil.copy(self.fname_copy, fname_full)
+                conn = sqlite3.connect(fname_full)
+                update_secondary_data_copies(conn)
+                conn.close()
+                self._assert_same_extracts(self.fname_copy, fname_full, str(filter_kwargs))
+
+            # modifying the stop_times of one trip
+            shutil.copy(self.fname, fname_full)
+            os.remove(self.fname_copy)
+            shutil.copy(self.fname, self.fname_copy)
+            for fname, trip_Is in [(self.fname_copy, [1]), (fname_full, None)]:
+                conn = sqlite3.connect(fname)
+                conn.execute("DELETE FROM stop_times WHERE trip_I=1 AND seq=1")
+                conn.commit()
+                update_secondary_data_copies(conn, trip_Is=trip_Is)
+                conn.close()
+            self._assert_same_extracts(self.fname_copy, fname_full, "modified trip")
+            self.assertEqual(sqlite3.connect(self.fname_copy).execute(
+                "SELECT min(seq) FROM stop_times WHERE trip_I=1").fetchone(), (1,))
+        finally:
+            if os.path.exists(fname_full):
+                os.remove(fname_full)
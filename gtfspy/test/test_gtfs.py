@@ -167,6 +167,45 @@ class TestGTFS(unittest.TestCase):
         self.assertGreater(len(res), 0)
         self.assertIsNotNone(res, "this is a 'it compiles' test")
 
+    def _stop_and_segment_counts_per_trip(self, start, end):
+        # reference: count the stop times of each active trip separately
+        stop_counts = {}
+        segment_counts = {}
+        for row in self.gtfs.get_tripIs_active_in_range(start, end).itertuples():
+            stop_times = self.gtfs.get_trip_stop_time_data(row.trip_I, row.day_start_ut)
+            stop_Is = stop_times["stop_I"].values
+            dep_time_uts = stop_times["dep_time_ut"].values
+            for i in range(len(stop_times)):
+                if start <= dep_time_uts[i] <= end:
+                    stop_counts[stop_Is[i]] = stop_counts.get(stop_Is[i], 0) + 1
+                if i + 1 < len(stop_times) and dep_time_uts[i] >= start and dep_time_uts[i + 1] <= end:
+                    seg = (stop_Is[i], stop_Is[i + 1])
+                    segment_counts[seg] = segment_counts.get(seg, 0) + 1
+        return stop_counts, segment_counts
+
+    def test_stop_and_segment_counts_match_per_trip_counts(self):
+        windows = [(datetime.datetime(2007, 1, 1, 6, 10), datetime.datetime(2007, 1, 1, 7, 10)),
+                   (datetime.datetime(2007, 1, 1, 8, 5), datetime.datetime(2007, 1, 1, 12, 0)),
+                   (datetime.datetime(2007, 1, 1, 7, 59, 59), datetime.datetime(2007, 1, 2, 10, 2, 1))]
+        for dt_start, dt_end in windows:
+            start = self.gtfs.unlocalized_datetime_to_ut_seconds(dt_start)
+            end = self.gtfs.unlocalized_datetime_to_ut_seconds(dt_end)
+            trips = self.gtfs.get_tripIs_active_in_range(start, end)
+            # the window cuts some of the trips
+            self.assertTrue(((trips["start_time_ut"] < start) | (trips["end_time_ut"] > end)).any())
+            stop_counts, segment_counts = self._stop_and_segment_counts_per_trip(start, end)
+            self.assertGreater(len(segment_counts), 0)
+
+            df = self.gtfs.get_stop_count_data(start, end)
+            self.assertDictEqual({stop_I: count for stop_I, count in zip(df["stop_I"], df["count"]) if count > 0},
+                                 stop_counts)
+
+            seg_data = self.gtfs.get_segment_count_data(start, end, use_shapes=False)
+            stop_names = self.gtfs.stops().set_index("stop_I")["name"].to_dict()
+            expected = sorted((stop_names[stop_I] + "-" + stop_names[stop_J], count)
+                              for (stop_I, stop_J), count in segment_counts.items())
+            self.assertListEqual(sorted((seg["name"], seg["count"]) for seg in seg_data), expected)
+
     def test_get_tripIs_active_in_range(self):
         dt_start_query = datetime.datetime(2007, 1, 1, 7, 59, 59)
         dt_end_query = datetime.datetime(2007, 1, 1, 8, 2, 1)
@@ -299,3 +338,69 @@ class TestGTFS(unittest.TestCase):
             download_date_override=first_day + datetime.timedelta(days=10))
         end_monday = self.G.get_weekly_extract_start_date(download_date_override=last_day - datetime.timedelta(days=5))
         assert first_monday < early_monday < end_monday
+
+    def test_metadata_cache(self):
+        G = GTFS.from_directory_as_inmemory_db(self.gtfs_source_dir)
+        stops = G.stops()
+        trip_Is = [row[0] for row in G.conn.execute("SELECT trip_I FROM trips")]
+        expected_routes = [G.get_route_name_and_type_of_tripI(trip_I) for trip_I in trip_Is]
+        expected_coordinates = [G.get_stop_coordinates(stop_I) for stop_I in stops.stop_I]
+        ut = G.get_day_start_ut("2016-03-07") + 3600
+        expected_day_start = G.day_start_ut(ut)
+
+        G.enable_cache(time_cache_size=2)
+        self.assertTrue(G.stops().equals(stops))
+        self.assertListEqual([G.get_route_name_and_type_of_tripI(trip_I) for trip_I in trip_Is], expected_routes)
+        self.assertListEqual([G.get_stop_coordinates(stop_I) for stop_I in stops.stop_I], expected_coordinates)
+        for _ in range(2):
+            self.assertEqual(G.day_start_ut(ut), expected_day_start)
+        self.assertEqual(G.increment_day_start_ut(expected_day_start), G.get_day_start_ut("2016-03-08"))
+        self.assertLessEqual(len(G._lookup_cache.times), 2)
+
+        names, types = G.get_route_names_and_types_of_tripIs(trip_Is + [10 ** 6])
+        self.assertListEqual(list(zip(names[:-1], types[:-1])), expected_routes)
+        self.assertEqual(types[-1], -1)
+        lats, lons = G.get_stop_coordinates_of_stop_Is(stops.stop_I)
+        numpy.testing.assert_allclose(lats, stops.lat)
+
+        # modifications of stops invalidate the cache
+        G.add_stop("new_stop", "NS", "New stop", "", 1.0, 2.0)
+        self.assertEqual(len(G.stops()), len(stops) + 1)
+        new_stop_I = G.stops().stop_I.max()
+        self.assertEqual(G.get_stop_coordinates(new_stop_I), (1.0, 2.0))
+        G.update_stop_coordinates(pandas.DataFrame({"stop_id": ["new_stop"], "lat": [3.0], "lon": [4.0]}))
+        self.assertEqual(G.get_stop_coordinates(new_stop_I), (3.0, 4.0))
+        G.disable_cache()
+        self.assertEqual(G.get_stop_coordinates(new_stop_I), (3.0, 4.0))
+
+    def test_get_tripIs_within_range_by_dsut_across_dst(self):
+        def reference(start_ut, end_ut):
+            # day starts computed day by day, one query per day start
+            start_day_ut = self.gtfs.day_start_ut(start_ut)
+            if start_ut - start_day_ut < 7:
+                start_day_ut = self.gtfs.increment_day_start_ut(start_day_ut, n_days=-1)
+            end_day_ut = self.gtfs.day_start_ut(end_ut)
+            day_starts = [start_day_ut]
+            while day_starts[-1] < end_day_ut:
+                day_starts.append(self.gtfs.increment_day_start_ut(day_starts[-1]))
+            result = {}
+            for dsut in day_starts:
+                trip_Is = [row[0] for row in self.gtfs.conn.execute(
+                    "SELECT DISTINCT trip_I FROM days JOIN trips USING(trip_I) "
+                    "WHERE days.day_start_ut = ? AND trips.start_time_ds <= ? AND trips.end_time_ds >= ? "
+                    "ORDER BY trip_I", (dsut, end_ut - dsut, max(0, start_ut - dsut)))]
+                if trip_Is:
+                    result[dsut] = trip_Is
+            return result
+
+        # America/Los_Angeles: DST started on 2008-03-09 and ended on 2008-11-02
+        for date, hours, duration in [("2008-03-08", 20, 3600 * 10), ("2008-03-09", 1, 3600 * 30),
+                                      ("2008-11-01", 22, 3600 * 5), ("2008-11-02", 0, 600),
+                                      ("2008-11-01", 12, 7 * 24 * 3600)]:
+            start_ut = self.gtfs.get_day_start_ut(date) + hours * 3600
+            end_ut = start_ut + duration
+            result = self.gtfs.get_tripIs_within_range_by_dsut(start_ut, end_ut)
+            self.assertDictEqual(result, reference(start_ut, end_ut))
+            df = self.gtfs.get_tripIs_within_range_by_dsut(start_ut, end_ut, as_dataframe=True)
+            self.assertEqual(len(df), sum(len(trip_Is) for trip_Is in result.values()))
+            self.assertListEqual(list(df.columns), ["day_start_ut", "trip_I"])
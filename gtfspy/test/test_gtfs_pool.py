@@ -0,0 +1,77 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from gtfspy.gtfs import GTFS
+from gtfspy.gtfs_pool import GTFSPool, connect_read_only
+from gtfspy.import_gtfs import import_gtfs
+
+
+class TestGTFSPool(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.fname = os.path.join(cls.tmp_dir, "test_gtfs_pool.sqlite")
+        gtfs_source_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        conn = sqlite3.connect(cls.fname)
+        import_gtfs(gtfs_source_dir, conn, preserve_connection=True, print_progress=False)
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_read_only(self):
+        conn = connect_read_only(self.fname)
+        self.assertGreater(conn.execute("SELECT count(*) FROM stops").fetchone()[0], 0)
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM stops")
+        conn.close()
+        with self.assertRaises(FileNotFoundError):
+            GTFSPool(os.path.join(self.tmp_dir, "missing.sqlite"))
+
+    def test_reuse_and_threads(self):
+        expected = GTFS(self.fname).stops()
+        with GTFSPool(self.fname, size=2) as pool:
+            with pool.gtfs() as G:
+                first = G
+            with pool.gtfs() as G:
+                self.assertIs(G, first)
+            self.assertEqual(pool.n_open, 1)
+            self.assertEqual(pool.get_timezone_name(), first.get_timezone_name())
+
+            def query(_):
+                with pool.gtfs() as G:
+                    return len(G.stops())
+
+            with ThreadPoolExecutor(max_workers=6) as executor:
+                results = list(executor.map(query, range(30)))
+            self.assertTrue(all(n == len(expected) for n in results))
+            self.assertLessEqual(pool.n_open, 2)
+
+    def test_shared_cache(self):
+        with GTFSPool(self.fname, size=2) as pool:
+            G1 = pool.acquire()
+            G2 = pool.acquire()
+            self.assertIsNot(G1, G2)
+            stops = G1.stops()
+            # the second object is served from the lookup tables loaded through the first one
+            G1.conn.close()
+            self.assertEqual(len(G2.stops()), len(stops))
+            self.assertEqual(G2.get_timezone_name(), pool.get_timezone_name())
+        with GTFSPool(self.fname, size=2, enable_cache=False) as pool:
+            with pool.gtfs() as G:
+                self.assertIsNone(G._lookup_cache)
+
+    def test_timeout(self):
+        pool = GTFSPool(self.fname, size=1)
+        G = pool.acquire()
+        with self.assertRaises(TimeoutError):
+            pool.acquire(timeout=0.01)
+        pool.release(G)
+        self.assertIs(pool.acquire(timeout=0.01), G)
+        pool.close()
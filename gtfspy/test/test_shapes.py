@@ -78,3 +78,20 @@ class ShapesTest(unittest.TestCase):
         result = shapes.interpolate_shape_times(shape_distances, shape_breaks, stop_times)
         assert len(result) == len(result_should_be)
         np.testing.assert_array_equal(result, result_should_be)
+
+    def test_interpolate_shape_times_vectorized(self):
+        shape_distances = [0, 2, 5, 10, 20, 100, 120, 130]
+        for shape_breaks, stop_times in [([0, 2, 5], [0, 1, 20]),
+                                         ([1, 3, 3, 6], [5, 10, 12, 30]),
+                                         ([2, 2], [7, 9])]:
+            expected = shapes.interpolate_shape_times(shape_distances, shape_breaks, stop_times)
+            times, first_break, last_break = shapes.interpolate_shape_times_vectorized(shape_distances,
+                                                                                       shape_breaks, stop_times)
+            self.assertEqual((first_break, last_break), (shape_breaks[0], shape_breaks[-1]))
+            np.testing.assert_allclose(times, expected[first_break:last_break + 1])
+
+        self.assertIsNone(shapes.interpolate_shape_times_vectorized(shape_distances, [0, None], [0, 1]))
+        self.assertIsNone(shapes.interpolate_shape_times_vectorized(shape_distances, [3, 1], [0, 1]))
+        self.assertIsNone(shapes.interpolate_shape_times_vectorized([], [0, 1], [0, 1]))
+        # duplicated shape point between two stops:
+        self.assertIsNone(shapes.interpolate_shape_times_vectorized([0, 5, 5, 10], [1, 2], [0, 1]))
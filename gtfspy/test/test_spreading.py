@@ -1,8 +1,16 @@
+import io
 import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
+from contextlib import redirect_stdout
+
+import numpy
 
 from gtfspy.spreading.event import Event
-from gtfspy.spreading.spreader import Spreader
+from gtfspy.spreading.fast_spreader import FastSpreader, spread_many
+from gtfspy.spreading.spreader import Spreader, get_infection_events_dataframe
 from gtfspy.spreading.spreading_stop import SpreadingStop
 
 from gtfspy.gtfs import GTFS
@@ -63,8 +71,8 @@ class SpreadingTest(unittest.TestCase):
         gtfs = GTFS.from_directory_as_inmemory_db(gtfs_source_dir)
         first_day_start_ut, last_day_start_ut = gtfs.get_day_start_ut_span()
         stop_1_info = gtfs.stop(1)
-        lat = stop_1_info.get("lat")
-        lon = stop_1_info.get("lon")
+        lat = float(stop_1_info["lat"].iloc[0])
+        lon = float(stop_1_info["lon"].iloc[0])
         spreader = Spreader(gtfs, first_day_start_ut + 8 * 3600, lat, lon, 24 * 3600, 30, True, 0.5)
         trips = spreader.spread()
         assert isinstance(trips, dict)
@@ -75,4 +83,138 @@ class SpreadingTest(unittest.TestCase):
         for key in keys:
             assert key in el, el
 
+    def test_get_infection_events(self):
+        gtfs_source_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        gtfs = GTFS.from_directory_as_inmemory_db(gtfs_source_dir)
+        start_time_ut = gtfs.conn.execute("SELECT min(start_time_ut) FROM day_trips2").fetchone()[0] - 600
+        stop = gtfs.stops().iloc[0]
+        spreader = Spreader(gtfs, start_time_ut, stop.lat, stop.lon, 24 * 3600, 30, True, 0.5)
+        with redirect_stdout(io.StringIO()):
+            trips = spreader.spread()
+        events = spreader.get_infection_events()
+        self.assertEqual(len(events), len(trips["trips"]))
+        self.assertGreater(len(events), 1)
+        for (_, event), trip in zip(events.iterrows(), trips["trips"]):
+            self.assertEqual(gtfs.get_stop_coordinates(event.stop_I), (trip["lats"][1], trip["lons"][1]))
+            self.assertEqual(gtfs.get_stop_coordinates(event.from_stop_I), (trip["lats"][0], trip["lons"][0]))
+            if event.trip_I == -1:
+                self.assertEqual((trip["name"], trip["route_type"]), ("walk", -1))
+            else:
+                self.assertEqual((trip["name"], trip["route_type"]),
+                                 gtfs.get_route_name_and_type_of_tripI(event.trip_I))
+        geojson = spreader.get_shortest_path_geojson()
+        self.assertEqual(geojson["type"], "FeatureCollection")
+        self.assertEqual(len(geojson["features"]), len(events))
+
+    def test_fast_spreader_matches_spreader(self):
+        gtfs_source_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        gtfs = GTFS.from_directory_as_inmemory_db(gtfs_source_dir)
+        start_time_ut = gtfs.conn.execute("SELECT min(start_time_ut) FROM day_trips2").fetchone()[0] - 600
+        fast_spreader = FastSpreader(gtfs, start_time_ut, 24 * 3600, 30, 0.5)
+        stops = gtfs.stops()
+        for lat, lon in zip(stops.lat, stops.lon):
+            spreader = Spreader(gtfs, start_time_ut, lat, lon, 24 * 3600, 30, True, 0.5)
+            with redirect_stdout(io.StringIO()):
+                spreader._initialize()
+                spreader._run()
+            expected = {}
+            for stop_I, spreading_stop in spreader._stop_I_to_spreading_stop.items():
+                event = spreading_stop.get_min_event()
+                if event is not None:
+                    expected[stop_I] = (event.arr_time_ut, event.dep_time_ut, event.from_stop_I, event.trip_I)
+            result = fast_spreader.spread(lat, lon)
+            found = {stop_I: (arr, dep, from_stop_I, trip_I) for stop_I, arr, dep, from_stop_I, trip_I in
+                     zip(result.stop_I, result.arr_time_ut, result.dep_time_ut, result.from_stop_I, result.trip_I)}
+            self.assertDictEqual(found, expected)
+
+        trips = fast_spreader.get_shortest_path_trips(result)
+        self.assertEqual(len(trips["trips"]), len(result.stop_I))
+        for key in "lats lons times route_type name".split():
+            self.assertIn(key, trips["trips"][0])
+        self.assertEqual(trips["trips"][0]["name"], "walk")
+
+    def test_infection_events_with_missing_route_name(self):
+        gtfs = GTFS.from_directory_as_inmemory_db(os.path.join(os.path.dirname(__file__), "test_data"))
+        trip_I, route_I = gtfs.conn.execute("SELECT trip_I, route_I FROM trips LIMIT 1").fetchone()
+        gtfs.conn.execute("UPDATE routes SET name = NULL WHERE route_I = ?", (route_I,))
+        stop_Is = [row[0] for row in gtfs.conn.execute("SELECT stop_I FROM stops LIMIT 2")]
+        events = get_infection_events_dataframe(gtfs, stop_Is, [10, 20], [0, 5], stop_Is[::-1], [-1, trip_I])
+        self.assertListEqual(events["name"].tolist(), ["walk", ""])
+
+    def test_spread_many(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, "test_spread_many.sqlite")
+            conn = sqlite3.connect(fname)
+            from gtfspy.import_gtfs import import_gtfs
+            import_gtfs(os.path.join(os.path.dirname(__file__), "test_data"), conn,
+                        preserve_connection=True, print_progress=False)
+            conn.close()
+            gtfs = GTFS(fname)
+            start_time_ut = gtfs.conn.execute("SELECT min(start_time_ut) FROM day_trips2").fetchone()[0] - 600
+            stops = gtfs.stops()
+            seeds = list(zip(stops.lat, stops.lon))
+            results = spread_many(fname, start_time_ut, seeds, 24 * 3600, n_processes=2)
+            fast_spreader = FastSpreader(gtfs, start_time_ut, 24 * 3600)
+            self.assertEqual(len(results), len(seeds))
+            for (lat, lon), result in zip(seeds, results):
+                expected = fast_spreader.spread(lat, lon)
+                self.assertEqual(result.seed_stop_I, expected.seed_stop_I)
+                self.assertListEqual(list(result.arr_time_ut), list(expected.arr_time_ut))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_compute_travel_time_matrix(self):
+        from gtfspy.import_gtfs import import_gtfs
+        from gtfspy.spreading.isochrones import compute_travel_time_matrix, load_travel_time_matrix, \
+            compute_isochrone_areas
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, "test_isochrones.sqlite")
+            conn = sqlite3.connect(fname)
+            import_gtfs(os.path.join(os.path.dirname(__file__), "test_data"), conn,
+                        preserve_connection=True, print_progress=False)
+            conn.close()
+            gtfs = GTFS(fname)
+            start_time_ut = gtfs.conn.execute("SELECT min(start_time_ut) FROM day_trips2").fetchone()[0] - 600
+            stops = gtfs.stops()
+            seeds = list(zip(stops.lat, stops.lon))
+            fname_prefix = os.path.join(tmp_dir, "travel_times")
+            matrix, stop_Is = compute_travel_time_matrix(fname, start_time_ut, seeds, 24 * 3600,
+                                                         fname_prefix=fname_prefix, n_processes=2)
+            in_process_matrix, _ = compute_travel_time_matrix(fname, start_time_ut, seeds, 24 * 3600, n_processes=1)
+            loaded_matrix, loaded_stop_Is = load_travel_time_matrix(fname_prefix)
+            numpy.testing.assert_array_equal(loaded_matrix, in_process_matrix)
+            numpy.testing.assert_array_equal(loaded_stop_Is, sorted(stops.stop_I))
+            self.assertEqual(matrix.shape, (len(seeds), len(stops)))
+
+            fast_spreader = FastSpreader(gtfs, start_time_ut, 24 * 3600)
+            for seed_index, (lat, lon) in enumerate(seeds):
+                result = fast_spreader.spread(lat, lon)
+                for stop_I, arr_time_ut in zip(result.stop_I, result.arr_time_ut):
+                    column = list(stop_Is).index(stop_I)
+                    self.assertEqual(loaded_matrix[seed_index, column], arr_time_ut - (start_time_ut - 1))
+                self.assertEqual(numpy.isfinite(loaded_matrix[seed_index]).sum(), len(result.stop_I))
+
+            # walking to nearby stops can only make travel times shorter (apart from the access walk to the seed)
+            access_matrix, _ = compute_travel_time_matrix(fname, start_time_ut, seeds, 24 * 3600, n_processes=1,
+                                                          max_access_distance=1000)
+            self.assertGreaterEqual(numpy.isfinite(access_matrix).sum(), numpy.isfinite(loaded_matrix).sum())
+
+            areas = compute_isochrone_areas(gtfs, loaded_matrix, loaded_stop_Is, [600, 3600, 24 * 3600], 100)
+            self.assertEqual(areas.shape, (len(seeds), 3))
+            self.assertTrue((numpy.diff(areas, axis=1) >= 0).all())
+            self.assertTrue((areas[:, 0] > 0).all())
+            del loaded_matrix, matrix
 
+            # before any transit runs, the stops within max_access_distance are reached by the access walks only
+            early_start_time_ut = start_time_ut - 3 * 3600
+            seed = seeds[list(stops.stop_I).index(5)]
+            access_stop_Is, access_times = FastSpreader(gtfs, early_start_time_ut, 3600).get_access_stops(*seed, 1000)
+            self.assertGreater(len(access_stop_Is), 1)
+            access_matrix, _ = compute_travel_time_matrix(fname, early_start_time_ut, [seed], 3600, n_processes=1,
+                                                          max_access_distance=1000)
+            for stop_I, access_time in zip(access_stop_Is, access_times):
+                self.assertEqual(access_matrix[0, list(stop_Is).index(stop_I)], access_time)
+        finally:
+            shutil.rmtree(tmp_dir)
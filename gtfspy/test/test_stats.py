@@ -1,11 +1,15 @@
 import os
+import shutil
+import sqlite3
 import unittest
 import tempfile as temp
 
+import numpy
 import pandas as pd
 
-from gtfspy.gtfs import GTFS
+from gtfspy.gtfs import GTFS, bump_data_version
 from gtfspy import stats
+from gtfspy.gtfs_pool import connect_read_only
 
 
 class StatsTest(unittest.TestCase):
@@ -37,6 +41,42 @@ class StatsTest(unittest.TestCase):
         d = stats.get_stats(self.gtfs)
         self.assertTrue(isinstance(d, dict))
 
+    def test_get_stats_values(self):
+        timings = {}
+        d = stats.get_stats(self.gtfs, timings=timings)
+        for table in ['agencies', 'routes', 'stops', 'stop_times', 'trips', 'calendar', 'shapes', 'calendar_dates',
+                      'days', 'stop_distances', 'frequencies', 'feed_info', 'transfers']:
+            self.assertEqual(d["n_" + table], self.gtfs.get_row_count(table))
+        for table, column in [('routes', 'type'), ('calendar_dates', 'exception_type'), ('agencies', 'lang'),
+                              ('stops', 'location_type'), ('transfers', 'transfer_type')]:
+            self.assertEqual(d[table + '__' + column + '__dist'], stats._distribution(self.gtfs, table, column))
+        self.assertEqual(d['start_date'], self.gtfs.get_min_date())
+        self.assertEqual(d['end_date'], self.gtfs.get_max_date())
+        self.assertEqual(d['start_time_ut'], self.gtfs.get_day_start_ut_span()[0])
+
+        max_activity_date = self.gtfs.execute_custom_query(
+            'SELECT date FROM days GROUP BY date ORDER BY count(*) DESC, date LIMIT 1').fetchone()[0]
+        self.assertEqual(d['max_activity_date'], max_activity_date)
+        hour_counts = dict(self.gtfs.conn.execute(
+            'SELECT arr_time_hour, count(*) FROM day_stop_times WHERE date=? GROUP BY arr_time_hour',
+            (max_activity_date,)).fetchall())
+        self.assertEqual(hour_counts[d['max_activity_hour']], max(hour_counts.values()))
+
+        self.assertIn('days', timings)
+        self.assertIn('fleet_size', timings)
+        self.assertTrue(all(t >= 0 for t in timings.values()))
+
+    def test_max_activity_hour_ignores_missing_arrival_times(self):
+        d = stats.get_stats(self.gtfs)
+        # make the stop times without an arrival time the largest group on the max activity date
+        self.gtfs.conn.execute('UPDATE stop_times SET arr_time_hour=NULL WHERE arr_time_hour<>?',
+                               (d['max_activity_hour'],))
+        self.gtfs.conn.execute('UPDATE stop_times SET arr_time_hour=NULL WHERE rowid IN '
+                               '(SELECT rowid FROM stop_times WHERE arr_time_hour IS NOT NULL LIMIT 1)')
+        max_activity_hour = stats.get_stats(self.gtfs)['max_activity_hour']
+        self.assertEqual(max_activity_hour, d['max_activity_hour'])
+        self.assertIsInstance(max_activity_hour, int)
+
     def test_calc_and_store_stats(self):
         self.gtfs.meta['stats_calc_at_ut'] = None
         stats.update_stats(self.gtfs)
@@ -66,6 +106,100 @@ class StatsTest(unittest.TestCase):
         # assuming test data only has one mode type
         self.assertTrue(len(df.keys()) == 2)
 
+    def test_vehicle_time_series(self):
+        by_type = stats.vehicle_time_series(self.gtfs)
+        self.assertEqual(list(by_type.columns), ['date', 'hour', 'hour_start_ut', 'type',
+                                                 'max_vehicles', 'vehicle_hours', 'vehicle_km'])
+        total_seconds = self.gtfs.conn.execute('SELECT sum(end_time_ut - start_time_ut) FROM day_trips2').fetchone()[0]
+        self.assertAlmostEqual(by_type['vehicle_hours'].sum(), total_seconds / 3600.)
+        self.assertTrue((by_type['max_vehicles'] >= 1).all())
+        self.assertTrue((by_type['vehicle_hours'] <= by_type['max_vehicles'] + 1e-9).all())
+
+        by_route = stats.vehicle_time_series(self.gtfs, by="route_I")
+        self.assertIn('route_I', by_route.columns)
+        summed = by_route.groupby(['hour_start_ut', 'type'])[['vehicle_hours', 'vehicle_km']].sum().reset_index()
+        merged = by_type.merge(summed, on=['hour_start_ut', 'type'], suffixes=('', '_routes'))
+        self.assertEqual(len(merged), len(by_type))
+        self.assertTrue(numpy.allclose(merged['vehicle_hours'], merged['vehicle_hours_routes']))
+        self.assertTrue(numpy.allclose(merged['vehicle_km'], merged['vehicle_km_routes']))
+        max_by_route = by_route.groupby(['hour_start_ut', 'type'])['max_vehicles'].max()
+        max_by_type = by_type.set_index(['hour_start_ut', 'type'])['max_vehicles']
+        self.assertTrue((max_by_route <= max_by_type.loc[max_by_route.index]).all())
+
+        # results are cached into the database
+        self.assertIn('vehicle_time_series_by_type_source', self.gtfs.meta)
+        cached = stats.vehicle_time_series(self.gtfs)
+        pd.testing.assert_frame_equal(cached, by_type, check_dtype=False)
+        # the cache is invalidated by in-place updates of the data
+        stop = self.gtfs.stops().iloc[0]
+        self.gtfs.update_stop_coordinates(pd.DataFrame({'stop_id': [stop['stop_id']],
+                                                        'lat': [stop['lat'] + 0.1], 'lon': [stop['lon']]}))
+        updated = stats.vehicle_time_series(self.gtfs)
+        self.assertNotAlmostEqual(updated['vehicle_km'].sum(), by_type['vehicle_km'].sum())
+        pd.testing.assert_frame_equal(updated, stats.vehicle_time_series(self.gtfs, use_cache=False),
+                                      check_dtype=False)
+        with self.assertRaises(ValueError):
+            stats.vehicle_time_series(self.gtfs, by="agency_I")
+
+    def test_hourly_departures(self):
+        stats.update_hourly_departures(self.gtfs)
+        n_departures = self.gtfs.conn.execute('SELECT sum(n_departures) FROM hourly_departures '
+                                              'JOIN hourly_departures_day_types USING (day_type)').fetchone()[0]
+        self.assertEqual(n_departures, self.gtfs.conn.execute(
+            'SELECT count(*) FROM days JOIN stop_times USING (trip_I)').fetchone()[0])
+
+        results = []
+        for use_hourly_departures in [False, True]:
+            route_freqs = stats.route_frequencies(self.gtfs, use_hourly_departures=use_hourly_departures)
+            results.append((route_freqs.sort_values('route_I').reset_index(drop=True),
+                            stats.hourly_frequencies(self.gtfs, 6 * 3600, 10 * 3600, 3,
+                                                     use_hourly_departures=use_hourly_departures),
+                            stats.departure_stops(self.gtfs, 7 * 3600, 9 * 3600,
+                                                  use_hourly_departures=use_hourly_departures)))
+        for from_sql, from_hourly_departures in zip(*results):
+            self.assertTrue(len(from_sql) > 0)
+            pd.testing.assert_frame_equal(from_hourly_departures, from_sql, check_dtype=False)
+
+        # the table is rebuilt when the underlying data changes
+        self.gtfs.conn.execute('DELETE FROM stop_times WHERE trip_I = (SELECT min(trip_I) FROM stop_times)')
+        stats.update_hourly_departures(self.gtfs)
+        n_departures = self.gtfs.conn.execute('SELECT sum(n_departures) FROM hourly_departures '
+                                              'JOIN hourly_departures_day_types USING (day_type)').fetchone()[0]
+        self.assertEqual(n_departures, self.gtfs.conn.execute(
+            'SELECT count(*) FROM days JOIN stop_times USING (trip_I)').fetchone()[0])
+
+        # and also when rows are updated in place
+        max_hour = self.gtfs.conn.execute('SELECT max(hour) FROM hourly_departures').fetchone()[0]
+        self.gtfs.conn.execute('UPDATE stop_times SET dep_time_ds = dep_time_ds + 3600')
+        bump_data_version(self.gtfs.conn)
+        stats.update_hourly_departures(self.gtfs)
+        self.assertEqual(self.gtfs.conn.execute('SELECT max(hour) FROM hourly_departures').fetchone()[0],
+                         max_hour + 1)
+
+    def test_frequencies_on_read_only_database(self):
+        db_fname = os.path.join(temp.mkdtemp(), "read_only.sqlite")
+        try:
+            file_conn = sqlite3.connect(db_fname)
+            self.gtfs.conn.backup(file_conn)
+            file_conn.close()
+            G = GTFS(connect_read_only(db_fname))
+            route_freqs = stats.route_frequencies(G)
+            pd.testing.assert_frame_equal(route_freqs.sort_values('route_I').reset_index(drop=True),
+                                          stats.route_frequencies(G, use_hourly_departures=False)
+                                          .sort_values('route_I').reset_index(drop=True), check_dtype=False)
+            pd.testing.assert_frame_equal(stats.hourly_frequencies(G, 6 * 3600, 10 * 3600, 3),
+                                          stats.hourly_frequencies(G, 6 * 3600, 10 * 3600, 3,
+                                                                   use_hourly_departures=False), check_dtype=False)
+            pd.testing.assert_frame_equal(stats.departure_stops(G, 7 * 3600, 9 * 3600),
+                                          stats.departure_stops(G, 7 * 3600, 9 * 3600, use_hourly_departures=False),
+                                          check_dtype=False)
+            pd.testing.assert_frame_equal(stats.vehicle_time_series(G), stats.vehicle_time_series(self.gtfs),
+                                          check_dtype=False)
+            self.assertNotIn('hourly_departures_source', G.meta)
+            G.conn.close()
+        finally:
+            shutil.rmtree(os.path.dirname(db_fname))
+
     def test_hourly_frequencies(self):
         # Selectiong a randome time frame
         df = stats.hourly_frequencies(self.gtfs, st=21600, et=45000, route_type=3)
@@ -29,6 +29,17 @@ class TestUtil(unittest.TestCase):
         d = util.wgs84_distance(lat, lon, lat2, lon)
         self.assertTrue(self._approximately_equal(d, 100))
 
+    def test_wgs84_distances(self):
+        lats = [60.4192161560059, 60.2, 36.914893, 60.4192161560059]
+        lons = [25.3302955627441, 24.9, -116.76821, 25.3302955627441]
+        distances = util.wgs84_distances(lats, lons, 60.17, 24.94)
+        self.assertEqual(len(distances), len(lats))
+        for lat, lon, d in zip(lats, lons, distances):
+            self.assertTrue(self._approximately_equal(d, util.wgs84_distance(lat, lon, 60.17, 24.94)))
+        pairwise = util.wgs84_distances(lats[:-1], lons[:-1], lats[1:], lons[1:])
+        for i, d in enumerate(pairwise):
+            self.assertTrue(self._approximately_equal(d, util.wgs84_distance(lats[i], lons[i], lats[i + 1], lons[i + 1])))
+
     def test_day_seconds_to_str_time(self):
         str_time = util.day_seconds_to_str_time(25 * 3600 + 59 * 60 + 10)
         self.assertTrue(str_time == "25:59:10", "the times can also go over 24 hours")
@@ -0,0 +1,69 @@
+import os
+import unittest
+
+import numpy
+
+from gtfspy.gtfs import GTFS
+from gtfspy.vehicle_positions import VehiclePositions
+
+
+class VehiclePositionsTest(unittest.TestCase):
+
+    def test_positions_at(self):
+        trips = [{'trip_I': 1, 'route_type': 3, 'times': [0, 10, 20], 'lats': [0, 1, 1], 'lons': [0, 0, 2]},
+                 {'trip_I': 2, 'route_type': 0, 'times': [5, 5, 15], 'lats': [5, 6, 7], 'lons': [5, 5, 5]}]
+        positions = VehiclePositions(trips)
+        self.assertEqual(len(positions), 2)
+
+        at_5 = positions.positions_at(5)
+        numpy.testing.assert_array_equal(at_5['trip_Is'], [1, 2])
+        numpy.testing.assert_allclose(at_5['lats'], [0.5, 6])
+        numpy.testing.assert_allclose(at_5['lons'], [0, 5])
+
+        at_15 = positions.positions_at(15)
+        numpy.testing.assert_allclose(at_15['lats'], [1, 7])
+        numpy.testing.assert_allclose(at_15['lons'], [1, 5])
+
+        at_20 = positions.positions_at(20)
+        numpy.testing.assert_array_equal(at_20['trip_Is'], [1])
+        numpy.testing.assert_array_equal(at_20['route_types'], [3])
+        numpy.testing.assert_allclose(at_20['lons'], [2])
+
+        self.assertEqual(len(positions.positions_at(25)['trip_Is']), 0)
+
+        snapshots = list(positions.positions_over(0, 20, 10))
+        self.assertListEqual([t for t, _ in snapshots], [0, 10, 20])
+
+    def test_trips_with_missing_times_are_left_out_with_a_warning(self):
+        trips = [{'trip_I': 1, 'route_type': 3, 'times': [0, 10], 'lats': [0, 1], 'lons': [0, 0]},
+                 {'trip_I': 2, 'route_type': 3, 'times': [0, float('nan')], 'lats': [0, 1], 'lons': [0, 0]}]
+        with self.assertWarns(UserWarning):
+            positions = VehiclePositions(trips)
+        numpy.testing.assert_array_equal(positions.trip_Is, [1])
+
+    def test_get_vehicle_positions(self):
+        G = GTFS.from_directory_as_inmemory_db(os.path.join(os.path.dirname(__file__), "test_data"))
+        start_ut, end_ut = G.get_approximate_schedule_time_span_in_ut()
+        positions = G.get_vehicle_positions(start_ut, start_ut + 24 * 3600)
+        self.assertGreater(len(positions), 0)
+        t = positions.start_times[0] + 1
+        snapshot = positions.positions_at(t)
+        self.assertGreater(len(snapshot['trip_Is']), 0)
+        self.assertEqual(len(snapshot['lats']), len(snapshot['trip_Is']))
+
+    def test_duplicated_shape_point_falls_back_to_stop_times(self):
+        G = GTFS.from_directory_as_inmemory_db(os.path.join(os.path.dirname(__file__), "test_data"))
+        # trip 12 has shape breaks 0 and 3: make all of its shape points duplicates of the first one
+        G.conn.execute("UPDATE shapes SET d = 0, "
+                       "lat = (SELECT lat FROM shapes WHERE shape_id = 'EXT1_shape' AND seq = 0), "
+                       "lon = (SELECT lon FROM shapes WHERE shape_id = 'EXT1_shape' AND seq = 0) "
+                       "WHERE shape_id = 'EXT1_shape'")
+        start_ut, end_ut = G.get_approximate_schedule_time_span_in_ut()
+        trip = [trip for trip in G.iter_trip_trajectories_within_timespan(start_ut, start_ut + 24 * 3600)
+                if trip['trip_I'] == 12][0]
+        stop_times = G.get_trip_stop_time_data(12, G.execute_custom_query(
+            "SELECT day_start_ut FROM day_trips2 WHERE trip_I = 12 LIMIT 1").fetchone()[0])
+        self.assertListEqual(trip['times'], stop_times['dep_time_ut'].astype(float).tolist())
+        self.assertTrue(numpy.isfinite(trip['times']).all())
+        positions = G.get_vehicle_positions(start_ut, start_ut + 24 * 3600)
+        self.assertIn(12, positions.trip_Is)
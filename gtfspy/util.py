@@ -75,6 +75,21 @@ def wgs84_distance(lat1, lon1, lat2, lon2):
     return d
 
 
+def wgs84_distances(lats, lons, lat, lon):
+    """Distances (in meters) from the points (lats, lons) to the point (lat, lon), as an array.
+
+    lat and lon can also be arrays of the same length as lats and lons,
+    in which case the pairwise distances are returned."""
+    lats = numpy.radians(numpy.asarray(lats, dtype=float))
+    lons = numpy.radians(numpy.asarray(lons, dtype=float))
+    lat = numpy.radians(numpy.asarray(lat, dtype=float))
+    lon = numpy.radians(numpy.asarray(lon, dtype=float))
+    a = (numpy.sin((lat - lats) / 2) ** 2 +
+         numpy.cos(lats) * numpy.cos(lat) * numpy.sin((lon - lons) / 2) ** 2)
+    c = 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+    return EARTH_RADIUS * c
+
+
 def wgs84_height(meters):
     return meters / (EARTH_RADIUS * TORADIANS)
 
@@ -0,0 +1,113 @@
+import warnings
+
+import numpy
+
+
+class VehiclePositions(object):
+    """
+    Positions of vehicles as a function of time, built from trip trajectories
+    (see GTFS.iter_trip_trajectories_within_timespan and GTFS.get_vehicle_positions).
+
+    The trajectories of all trips are stored as flat numpy arrays, so that the positions of all vehicles
+    at a given time are obtained with a single binary search and linear interpolation.
+    """
+
+    def __init__(self, trips):
+        """
+        Parameters
+        ----------
+        trips: iterable of dicts
+            each with keys 'times', 'lats', 'lons', 'trip_I', and 'route_type'.
+            Trips with missing or decreasing times are left out, with a warning.
+        """
+        times = []
+        lats = []
+        lons = []
+        trip_Is = []
+        route_types = []
+        skipped_trip_Is = []
+        for trip in trips:
+            trip_times = numpy.asarray(trip['times'], dtype=float)
+            if len(trip_times) == 0 or not numpy.isfinite(trip_times).all() or (numpy.diff(trip_times) < 0).any():
+                skipped_trip_Is.append(trip['trip_I'])
+                continue
+            times.append(trip_times)
+            lats.append(numpy.asarray(trip['lats'], dtype=float))
+            lons.append(numpy.asarray(trip['lons'], dtype=float))
+            trip_Is.append(trip['trip_I'])
+            route_types.append(trip['route_type'])
+        if skipped_trip_Is:
+            warnings.warn("Left out %d trips with missing or decreasing times (trip_Is %s)"
+                          % (len(skipped_trip_Is), ", ".join(str(trip_I) for trip_I in skipped_trip_Is[:10])))
+
+        self.trip_Is = numpy.array(trip_Is, dtype=int)
+        self.route_types = numpy.array(route_types, dtype=int)
+        lengths = numpy.array([len(x) for x in times], dtype=int)
+        # trip k occupies indices offsets[k]...offsets[k + 1] - 1 of the flat arrays
+        self.offsets = numpy.r_[0, numpy.cumsum(lengths)]
+        self.times = numpy.concatenate(times) if times else numpy.zeros(0)
+        self.lats = numpy.concatenate(lats) if lats else numpy.zeros(0)
+        self.lons = numpy.concatenate(lons) if lons else numpy.zeros(0)
+        self.start_times = self.times[self.offsets[:-1]] if times else numpy.zeros(0)
+        self.end_times = self.times[self.offsets[1:] - 1] if times else numpy.zeros(0)
+
+        # Composite key: all times of trip k are shifted to the range [k * span, (k + 1) * span),
+        # which makes the flat time array sorted and searchable with a single searchsorted call.
+        if times:
+            self._t_min = self.times.min()
+            self._span = self.times.max() - self._t_min + 1.
+        else:
+            self._t_min = 0.
+            self._span = 1.
+        trip_index_of_point = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        self._keys = trip_index_of_point * self._span + (self.times - self._t_min)
+
+    def __len__(self):
+        return len(self.trip_Is)
+
+    def positions_at(self, t):
+        """
+        Get the positions of all vehicles operating at time t.
+
+        Parameters
+        ----------
+        t: float
+            unix time
+
+        Returns
+        -------
+        positions: dict
+            with numpy arrays 'lats', 'lons', 'trip_Is', and 'route_types'
+        """
+        active = numpy.nonzero((self.start_times <= t) & (t <= self.end_times))[0]
+        query_keys = active * self._span + (t - self._t_min)
+        # index of the last trajectory point with time <= t:
+        before = numpy.searchsorted(self._keys, query_keys, side="right") - 1
+        after = numpy.minimum(before + 1, self.offsets[active + 1] - 1)
+        dt = self.times[after] - self.times[before]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            fraction = numpy.where(dt > 0, (t - self.times[before]) / dt, 0.)
+        lats = self.lats[before] + fraction * (self.lats[after] - self.lats[before])
+        lons = self.lons[before] + fraction * (self.lons[after] - self.lons[before])
+        return {"lats": lats,
+                "lons": lons,
+                "trip_Is": self.trip_Is[active],
+                "route_types": self.route_types[active]}
+
+    def positions_over(self, t0, t1, step):
+        """
+        Get vehicle positions at times t0, t0 + step, ..., up to t1.
+
+        Parameters
+        ----------
+        t0: float
+        t1: float
+        step: float
+
+        Yields
+        ------
+        (t, positions): tuple
+            positions as returned by positions_at(t)
+        """
+        for t in numpy.arange(t0, t1 + step / 2., step):
+            yield t, self.positions_at(t)